@@ -0,0 +1,67 @@
+# Helpers shared by the benchmarks: loading color-converter.py, deterministic synthetic color codes
+# and timing.
+import os
+import time
+import random
+import importlib.util
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'color-converter.py')
+FORMATS = ['hex', 'rgb', 'cmy', 'cmyk', 'hsl', 'hsv', 'xyz', 'lab', 'lch']
+
+
+# Loads color-converter.py as a module (its file name isn't importable)
+def loadConverter() :
+    spec = importlib.util.spec_from_file_location('color_converter', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Returns a random color code in the given format, in one of a few spellings
+def syntheticColor(rand, colorFormat) :
+    if colorFormat == 'hex' :
+        return '#%06x' % rand.randrange(1 << 24)
+    elif colorFormat == 'rgb' :
+        return rand.choice(['rgb(%d, %d, %d)', 'RGB: %d %d %d']) % tuple(rand.randrange(256) for _ in range(3))
+    elif colorFormat == 'cmy' :
+        return 'cmy(%.2f, %.2f, %.2f)' % tuple(rand.uniform(0, 100) for _ in range(3))
+    elif colorFormat == 'cmyk' :
+        return 'cmyk(%.2f, %.2f, %.2f, %.2f)' % tuple(rand.uniform(0, 100) for _ in range(4))
+    elif colorFormat == 'xyz' :
+        return 'xyz(%.2f, %.2f, %.2f)' % (rand.uniform(0, 95), rand.uniform(0, 100), rand.uniform(0, 108))
+    elif colorFormat == 'lab' :
+        return rand.choice(['lab(%.2f, %.2f, %.2f)', 'LAB: %.2f %.2f %.2f']) % (rand.uniform(0, 100), rand.uniform(-128, 127), rand.uniform(-128, 127))
+    elif colorFormat == 'lch' :
+        return 'lch(%.2f, %.2f, %.2f)' % (rand.uniform(0, 100), rand.uniform(0, 150), rand.uniform(0, 360))
+    return rand.choice(['%s(%d, %.2f, %.2f)', '%s: %d %.2f %.2f']) % (rand.choice([colorFormat, colorFormat.upper()]), rand.randrange(361), rand.uniform(0, 100), rand.uniform(0, 100))
+
+# Returns a deterministic list of color codes
+# ARGS
+# count: how many color codes to return
+# seed: the random seed (the same seed always gives the same colors)
+# colorFormat: the format of every color, or None to mix all of them
+# distinct: how many different colors to draw from (repeating them), or None for all different
+# formats: the formats to mix when colorFormat is None (default: FORMATS)
+def syntheticColors(count, seed = 0, colorFormat = None, distinct = None, formats = None) :
+    rand = random.Random(seed)
+    pool = None
+    if distinct is not None :
+        pool = syntheticColors(distinct, seed + 1, colorFormat, formats=formats)
+        return [rand.choice(pool) for _ in range(count)]
+    return [syntheticColor(rand, colorFormat or rand.choice(formats or FORMATS)) for _ in range(count)]
+
+# Returns the best (lowest) time in seconds of a few calls of run()
+def bestTime(run, repeats = 3) :
+    best = None
+    for _ in range(repeats) :
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if (best is None) or (elapsed < best) else best
+    return best
+
+# Returns the lines/second of parse() over colors (best of a few repeats)
+def measure(parse, colors, repeats = 3) :
+    def run() :
+        for color in colors :
+            parse(color)
+    return len(colors) / bestTime(run, repeats)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# Compares the throughput (lines/second) of the compiled tokenizer against the character-by-character
+# parser it replaced, on the same synthetic color codes.
+#
+# usage: python benchmarks/parser_benchmark.py [number of lines]
+import sys
+
+from common import loadConverter, syntheticColors, measure
+
+
+'''
+# PREVIOUS PARSER (for comparison)
+'''
+
+HEX_LETTERS = ['a', 'b', 'c', 'd', 'e', 'f']
+# the formats the previous parser knew (the CIE formats came later)
+LEGACY_FORMATS = ['hex', 'rgb', 'cmy', 'cmyk', 'hsl', 'hsv']
+
+def legacyDetectFormat(color) :
+    if 'rgb' in color.lower() :
+        return 'rgb'
+    elif 'cmyk' in color.lower() :
+        return 'cmyk'
+    elif 'cmy' in color.lower() :
+        return 'cmy'
+    elif 'hsl' in color.lower() :
+        return 'hsl'
+    elif 'hsv' in color.lower() :
+        return 'hsv'
+    elif '#' in color :
+        return 'hex'
+    return None
+
+def legacyExtractValues(color, numValues, isHex = False) :
+    i = 0
+    tempValue = ''
+    extractedValues = []
+
+    if isHex :
+        while i < len(color) :
+            if (color[i].isnumeric()) or (color[i] in HEX_LETTERS) :
+                tempValue += color[i]
+            else :
+                tempValue = ''
+            if len(tempValue) == 6 :
+                extractedValues.append(tempValue)
+                tempValue = ''
+            if len(extractedValues) == numValues :
+                break
+            i = i + 1
+
+        if (len(extractedValues) != numValues) and (len(tempValue) == 6) :
+            extractedValues.append(tempValue)
+
+    else :
+        while i < len(color) :
+            if color[i].isnumeric() or color[i] == '.' :
+                tempValue += color[i]
+            elif len(tempValue) > 0 and tempValue != '.' :
+                extractedValues.append(tempValue)
+                tempValue = ''
+            else :
+                tempValue = ''
+            if len(extractedValues) == numValues :
+                break
+            i = i + 1
+
+        if (len(extractedValues) != numValues) and (len(tempValue) > 0) :
+            extractedValues.append(tempValue)
+
+    if len(extractedValues) != numValues :
+        return False
+    return extractedValues
+
+# detection, extraction and the string -> number conversion the validators used to do
+def legacyParse(converter, color) :
+    colorFormat = legacyDetectFormat(color)
+    if colorFormat == 'hex' :
+        return colorFormat, legacyExtractValues(color, 1, True)
+    values = legacyExtractValues(color, 4 if colorFormat == 'cmyk' else 3)
+    if colorFormat == 'rgb' :
+        return colorFormat, [converter.smartRound(value) for value in values]
+    if colorFormat in ('hsl', 'hsv') :
+        return colorFormat, [converter.smartRound(values[0]), float(values[1]), float(values[2])]
+    return colorFormat, [float(value) for value in values]
+
+
+# the same work through the compiled tokenizer
+def tokenizedParse(converter, color) :
+    colorFormat, tokens = converter.tokenizeColor(color)
+    return colorFormat, converter.validateColor(color, colorFormat, tokens)
+
+
+'''
+# BENCHMARK
+'''
+
+def main() :
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    converter = loadConverter()
+    colors = syntheticColors(count, formats=LEGACY_FORMATS)
+
+    # both parsers have to agree before their speed means anything
+    for color in colors :
+        expected = legacyParse(converter, color)
+        colorFormat, validated = tokenizedParse(converter, color)
+        if (colorFormat, validated if colorFormat != 'hex' else [validated]) != expected :
+            sys.exit(f'parsers disagree on "{color}": {expected} vs {(colorFormat, validated)}')
+
+    legacy = measure(lambda color : legacyParse(converter, color), colors)
+    tokenized = measure(lambda color : tokenizedParse(converter, color), colors)
+    print(f'{count} lines')
+    print(f'previous parser:  {legacy:12,.0f} lines/s')
+    print(f'tokenizer:        {tokenized:12,.0f} lines/s  ({tokenized / legacy:.1f}x)')
+
+
+if __name__ == '__main__' :
+    main()
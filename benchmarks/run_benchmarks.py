@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# Benchmark suite for color-converter.py, on deterministic synthetic inputs:
+#   conversions  ns/conversion for every source -> target format pair, and every source -> all formats,
+#                after checking the conversion plans convert directly where they can
+#   parser       lines/second of detecting and validating each source format
+#   output       lines/second of formatting converted colors in each --format
+#   files        end-to-end lines/second of converting files (per format, mixed and heavy-duplicate)
+#                to stdout and to a file, and of converting packed records
+#   palette      ns/lookup of finding the nearest palette color (--nearest) with the k-d tree, and by
+#                comparing against every palette color, for a few palette sizes
+#   quantize     colors/second of counting colors into a ColorHistogram (--quantize), and ms of working
+#                out a palette from it with each method, for 1M and 10M colors (needs NumPy), after
+#                checking the median-cut palette is the same without NumPy
+#   startup      ms of starting the script cold: the bare interpreter, compiling the script, its imports
+#                (from -X importtime) and whole runs converting one or a few colors, with and without
+#                flags, and as an installed module (with cached bytecode)
+#
+# Results can be saved as a JSON baseline, and compared against one to flag regressions.
+#
+# usage: python benchmarks/run_benchmarks.py [--save FILE] [--compare FILE] [--threshold PERCENT]
+import os
+import sys
+import json
+import math
+import random
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import py_compile
+import subprocess
+
+from common import SCRIPT, FORMATS, loadConverter, syntheticColors, bestTime
+
+BASELINE_VERSION = 1
+SUITES = ['conversions', 'parser', 'output', 'files', 'palette', 'quantize', 'startup']
+PALETTE_SIZES = [100, 1000, 10000, 100000]
+QUANTIZE_SIZES = [1000000, 10000000]
+QUANTIZE_COLORS = 16
+
+
+def main() :
+    parser = argparse.ArgumentParser(description='Benchmark suite for color-converter.py.')
+    parser.add_argument('--suite', choices=SUITES, action='append', help='only run this suite (can be repeated)')
+    parser.add_argument('--lines', type=int, default=20000, help='number of color codes per input (default: 20000)')
+    parser.add_argument('--repeats', type=int, default=3, help='number of times to repeat each measurement, keeping the best (default: 3)')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results against a JSON baseline, exiting with 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=10, help='percentage a result can be worse than its baseline before it\'s a regression (default: 10)')
+    args = parser.parse_args()
+
+    converter = loadConverter()
+    results = {}
+    for suite in args.suite or SUITES :
+        for name, value, unit in SUITE_FUNCTIONS[suite](converter, args.lines, args.repeats) :
+            results[name] = {'value': value, 'unit': unit}
+            print(f'{name:<36} {value:>14,.1f} {unit}', flush=True)
+
+    if args.save :
+        with open(args.save, 'w', encoding='utf-8') as file :
+            json.dump({'version': BASELINE_VERSION, 'python': platform.python_version(), 'machine': platform.machine(),
+                       'lines': args.lines, 'results': results}, file, indent=2, sort_keys=True)
+            file.write('\n')
+        print(f'SAVED BASELINE: {args.save}')
+
+    if args.compare :
+        with open(args.compare, 'r', encoding='utf-8') as file :
+            baseline = json.load(file)
+        regressions = compareResults(baseline['results'], results, args.threshold)
+        if regressions :
+            print(f'{regressions} regression(s) beyond {args.threshold:g}%')
+            return 1
+        print(f'no regressions beyond {args.threshold:g}%')
+    return 0
+
+# Prints how each result changed from its baseline
+# RETURNS
+# the number of results that got worse by more than threshold percent
+def compareResults(baseline, results, threshold) :
+    regressions = 0
+    print()
+    for name, result in results.items() :
+        if name not in baseline :
+            continue
+        before = baseline[name]['value']
+        # lower is better for times, higher is better for rates
+        if result['unit'].startswith(('ns', 'ms')) :
+            worse = ((result['value'] - before) / before) * 100
+        else :
+            worse = ((before - result['value']) / before) * 100
+        flag = 'REGRESSION' if worse > threshold else ''
+        regressions += 1 if flag else 0
+        print(f'{name:<36} {before:>14,.1f} -> {result["value"]:>14,.1f} {result["unit"]:<16} {-worse:+7.1f}%  {flag}')
+    return regressions
+
+
+'''
+# SUITES
+'''
+
+# Each suite takes the converter module, the number of lines and repeats, and returns a list of
+# (name, value, unit) results.
+
+# Time of converting validated values from each format to each other format (and to all of them at
+# once) with the scalar functions
+def benchConversions(converter, lines, repeats) :
+    checkPlans(converter)
+    results = []
+    for sourceFormat in FORMATS :
+        rows = [converter.validateColor(color, sourceFormat) for color in syntheticColors(lines, 1, sourceFormat)]
+        for targetFormat in FORMATS + ['all'] :
+            if targetFormat == sourceFormat :
+                continue
+            outputFormats = FORMATS if targetFormat == 'all' else [targetFormat]
+            run = lambda : [converter.convertValues(sourceFormat, row, outputFormats) for row in rows]
+            results.append((f'conversion.{sourceFormat}->{targetFormat}', (bestTime(run, repeats) / len(rows)) * 1e9, 'ns/conversion'))
+    return results
+
+# Converting HSL, HSV, CMY or CMYK to the default formats has to take fewer conversions than going
+# through RGB for every format (the direct HSL <-> HSV and CMY <-> CMYK edges), and each format has to
+# be converted the same way whatever else is output, before the conversion times mean anything
+def checkPlans(converter) :
+    def path(plan, sourceFormat, targetFormat) :
+        sources = {target : source for source, target, _ in plan}
+        steps = [targetFormat]
+        while steps[-1] != sourceFormat :
+            steps.append(sources[steps[-1]])
+        return steps[::-1]
+
+    for sourceFormat in ['hsl', 'hsv', 'cmy', 'cmyk'] :
+        outputFormats = converter.DEFAULT_TYPES
+        plan = converter.planConversions(sourceFormat, outputFormats)
+        steps = sum(len(path(plan, sourceFormat, targetFormat)) - 1 for targetFormat in outputFormats)
+        # (one conversion to RGB, then one from it to each other format)
+        pivotSteps = sum(1 if targetFormat == 'rgb' else 2 for targetFormat in outputFormats if targetFormat != sourceFormat)
+        if steps >= pivotSteps :
+            sys.exit(f'{sourceFormat} -> all takes {steps} conversions, going through RGB takes {pivotSteps}: {plan}')
+        for targetFormat in outputFormats :
+            alone = path(converter.planConversions(sourceFormat, [targetFormat]), sourceFormat, targetFormat)
+            if path(plan, sourceFormat, targetFormat) != alone :
+                sys.exit(f'{sourceFormat} -> {targetFormat} is converted through {alone} alone, but not with the other formats')
+
+# Throughput of detecting and validating color codes of each format
+def benchParser(converter, lines, repeats) :
+    results = []
+    for sourceFormat in FORMATS + [None] :
+        colors = syntheticColors(lines, 2, sourceFormat)
+        def run() :
+            for color in colors :
+                colorFormat, tokens = converter.tokenizeColor(color)
+                converter.validateColor(color, colorFormat, tokens)
+        results.append((f'parser.{sourceFormat or "mixed"}', lines / bestTime(run, repeats), 'lines/s'))
+    return results
+
+# Throughput of formatting converted colors (all formats) for each --format
+def benchOutput(converter, lines, repeats) :
+    results = []
+    rows = [converter.validateColor(color, 'hex') for color in syntheticColors(lines, 3, 'hex')]
+    converted = converter.convertRows('hex', rows, FORMATS)
+    for outputFormat in converter.OUTPUT_FORMATTERS :
+        _, formatColor, _ = converter.OUTPUT_FORMATTERS[outputFormat](FORMATS, 2)
+        run = lambda : [formatColor(results) for results in converted]
+        results.append((f'output.{outputFormat}', lines / bestTime(run, repeats), 'lines/s'))
+    return results
+
+# End-to-end throughput of running the script on input files (including its startup)
+def benchFiles(converter, lines, repeats) :
+    results = []
+    inputs = [(sourceFormat, syntheticColors(lines, 4, sourceFormat)) for sourceFormat in FORMATS]
+    inputs.append(('mixed', syntheticColors(lines, 5)))
+    inputs.append(('duplicates', syntheticColors(lines, 6, distinct=max(lines // 100, 1))))
+
+    with tempfile.TemporaryDirectory() as directory :
+        output = os.path.join(directory, 'output.txt')
+        for name, colors in inputs :
+            path = os.path.join(directory, name + '.txt')
+            with open(path, 'w', encoding='utf-8') as file :
+                file.write('\n'.join(colors) + '\n')
+
+            toStdout = lambda : subprocess.run([sys.executable, SCRIPT, '-i', path], stdout=subprocess.DEVNULL, check=True)
+            toFile = lambda : subprocess.run([sys.executable, SCRIPT, '-i', path, '-o', output], check=True)
+            results.append((f'file.{name}.stdout', lines / bestTime(toStdout, repeats), 'lines/s'))
+            results.append((f'file.{name}.file', lines / bestTime(toFile, repeats), 'lines/s'))
+
+        # packed records (--in-binary/--out-binary) of the same colors, converted to packed records
+        for sourceFormat, targetFormat in [('rgb', 'hsl'), ('hsl', 'rgb')] :
+            packed = os.path.join(directory, sourceFormat + '.bin')
+            subprocess.run([sys.executable, SCRIPT, '-i', os.path.join(directory, sourceFormat + '.txt'), '-' + sourceFormat, '--out-binary', '-o', packed], check=True)
+            toPacked = lambda : subprocess.run([sys.executable, SCRIPT, '--in-binary', '-i', packed, '-' + targetFormat, '--out-binary', '-o', output], check=True)
+            results.append((f'file.packed.{sourceFormat}->{targetFormat}', lines / bestTime(toPacked, repeats), 'lines/s'))
+    return results
+
+# Time of finding the nearest palette color of L*a*b* values with the k-d tree, and by brute force
+# (which only gets a sample of them, as it's much slower on large palettes)
+def benchPalette(converter, lines, repeats) :
+    results = []
+    queries = [converter.convertValues('hex', converter.validateColor(color, 'hex'), ['lab'])['lab'] for color in syntheticColors(lines, 7, 'hex')]
+    for size in PALETTE_SIZES :
+        index = converter.buildPaletteIndex('\n'.join(syntheticColors(size, 8)), None)
+        run = lambda : [index.nearest(labValues) for labValues in queries]
+        results.append((f'palette.{size}.kdtree', (bestTime(run, repeats) / len(queries)) * 1e9, 'ns/lookup'))
+
+        sample = queries[:max(min(lines, 1000000 // size), 1)]
+        run = lambda : [scanNearest(index, labValues) for labValues in sample]
+        results.append((f'palette.{size}.scan', (bestTime(run, repeats) / len(sample)) * 1e9, 'ns/lookup'))
+    return results
+
+# The brute force counterpart of PaletteIndex.nearest(), comparing against every palette color
+def scanNearest(index, labValues) :
+    coordinates = index.coordinates
+    best = (math.inf, -1)
+    for node, entry in enumerate(index.nodeEntries) :
+        dl = labValues[0] - coordinates[node * 3]
+        da = labValues[1] - coordinates[(node * 3) + 1]
+        db = labValues[2] - coordinates[(node * 3) + 2]
+        best = min(best, ((dl * dl) + (da * da) + (db * db), entry))
+    return index.entries[best[1]], math.sqrt(best[0])
+
+# Time of counting many colors (clustered around a few, like the colors of a photo) into a histogram,
+# and of quantizing it with each method. The sizes are fixed rather than --lines, as the point is that
+# the palette only takes as long as there are distinct colors, however many colors were counted.
+def benchQuantize(converter, lines, repeats) :
+    np = converter.loadNumpy()
+    if not np :
+        print('quantize: skipped (needs NumPy)')
+        return []
+    checkQuantize(converter)
+    results = []
+    rng = np.random.default_rng(9)
+    centers = rng.integers(0, 256, size=(64, 3))
+    for size in QUANTIZE_SIZES :
+        rgb = np.clip(centers[rng.integers(0, len(centers), size=size)] + rng.normal(0, 12, size=(size, 3)), 0, 255).astype(np.int64)
+        codes = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+        del rgb
+        histogram = None
+        def count() :
+            nonlocal histogram
+            histogram = converter.ColorHistogram()
+            for start in range(0, size, converter.QUANTIZE_BUFFER_SIZE) :
+                histogram.addCodes(codes[start : start + converter.QUANTIZE_BUFFER_SIZE])
+            histogram.items()
+        results.append((f'quantize.{size}.histogram', size / bestTime(count, repeats), 'colors/s'))
+        for method in converter.QUANTIZE_METHODS :
+            run = lambda : converter.quantizeColors(histogram, QUANTIZE_COLORS, method)
+            results.append((f'quantize.{size}.{method}', bestTime(run, repeats) * 1e3, 'ms'))
+    return results
+
+# The median-cut palette of a few repeated colors, half of them grays (which tie on a* and b*), has to
+# come out the same with and without NumPy, and in whatever order the colors were counted, before its
+# speed means anything
+def checkQuantize(converter) :
+    rand = random.Random(10)
+    pool = [rand.randrange(1 << 24) for _ in range(25)] + [rand.randrange(256) * 0x010101 for _ in range(25)]
+    codes = [rand.choice(pool) for _ in range(20000)]
+    palettes = []
+    for numpy in (False, None) :
+        for order in (codes, rand.sample(codes, len(codes))) :
+            converter.NUMPY = numpy
+            histogram = converter.ColorHistogram()
+            histogram.addCodes(order)
+            clusters = converter.quantizeColors(histogram, QUANTIZE_COLORS, 'median-cut')
+            palettes.append([([round(value, 6) for value in mean], int(count)) for mean, count in clusters])
+    converter.NUMPY = None
+    if any(palette != palettes[0] for palette in palettes) :
+        sys.exit(f'median-cut palettes disagree: {palettes}')
+
+# Cold start times of the script, which is most of the time of converting a single color. Each
+# process is started a few more times than other measurements are repeated, as they vary more.
+def benchStartup(converter, lines, repeats) :
+    results = []
+    starts = repeats * 5
+    with open(SCRIPT, 'r', encoding='utf-8') as file :
+        source = file.read()
+    results.append(('startup.interpreter', startTime([sys.executable, '-c', 'pass'], starts), 'ms'))
+    # a script isn't cached as bytecode, so every run compiles it
+    results.append(('startup.compile', bestTime(lambda : compile(source, SCRIPT, 'exec'), starts) * 1e3, 'ms'))
+    results.append(('startup.imports', min(importTime([SCRIPT, '#85feab']) for _ in range(starts)), 'ms'))
+
+    results.append(('startup.one-color', startTime([sys.executable, SCRIPT, '#85feab'], starts), 'ms'))
+    results.append(('startup.few-colors', startTime([sys.executable, SCRIPT, '#85feab', 'rgb(50, 100, 200)', 'hsl(210, 40, 60)'], starts), 'ms'))
+    results.append(('startup.flags', startTime([sys.executable, SCRIPT, '-hsl', '-f', 'csv', '#85feab'], starts), 'ms'))
+
+    # installed as a module, the compiled script comes from its cached bytecode
+    with tempfile.TemporaryDirectory() as directory :
+        module = os.path.join(directory, 'color_converter.py')
+        shutil.copyfile(SCRIPT, module)
+        py_compile.compile(module, doraise=True)
+        environment = dict(os.environ, PYTHONPATH=directory)
+        results.append(('startup.module', startTime([sys.executable, '-m', 'color_converter', '#85feab'], starts, environment), 'ms'))
+    return results
+
+# Returns the best time in milliseconds of running a command to completion (with no output)
+def startTime(command, repeats, environment = None) :
+    best = None
+    for _ in range(repeats) :
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, env=environment, check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if (best is None) or (elapsed < best) else best
+    return best * 1e3
+
+# Returns the time in milliseconds that running the script with arguments spends importing modules the
+# bare interpreter doesn't (the sum of -X importtime's self times)
+def importTime(arguments) :
+    baseline = importedModules(['-c', 'pass'])
+    return sum(selfTime for name, selfTime in importedModules(arguments).items() if name not in baseline) / 1e3
+
+# Returns a map of each module imported by running the interpreter with arguments to its import time
+# in microseconds (not counting the modules it imports)
+def importedModules(arguments) :
+    stderr = subprocess.run([sys.executable, '-X', 'importtime'] + arguments, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True).stderr
+    modules = {}
+    for line in stderr.splitlines() :
+        if not line.startswith('import time:') :
+            continue
+        selfTime, _, name = line[len('import time:'):].split('|')
+        # (skipping the header line)
+        if selfTime.strip().isdigit() :
+            modules[name.strip()] = int(selfTime)
+    return modules
+
+SUITE_FUNCTIONS = {
+    'conversions': benchConversions,
+    'parser':      benchParser,
+    'output':      benchOutput,
+    'files':       benchFiles,
+    'palette':     benchPalette,
+    'quantize':    benchQuantize,
+    'startup':     benchStartup,
+}
+
+
+if __name__ == '__main__' :
+    sys.exit(main())
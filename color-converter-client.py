@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Thin client for `color-converter.py --serve ADDRESS`: forwards its command line (and stdin, if the
+# request reads it) to the server and streams back the output, so converting doesn't pay for starting
+# up the converter every time. It takes the same arguments as color-converter.py.
+#
+# usage: color-converter-client.py [--connect ADDRESS] [color-converter arguments...]
+# (ADDRESS defaults to the COLOR_CONVERTER_ADDRESS environment variable, and the token a TCP server
+# needs is taken from COLOR_CONVERTER_TOKEN)
+import os
+import sys
+import json
+import socket
+import struct
+import threading
+
+FRAME_HEADER = struct.Struct('>cI')
+
+
+def main() :
+    argv = sys.argv[1:]
+    address = os.environ.get('COLOR_CONVERTER_ADDRESS')
+    if argv[:1] == ['--connect'] :
+        address = argv[1] if len(argv) > 1 else None
+        argv = argv[2:]
+    if not address :
+        print('ERROR: No server address, use --connect ADDRESS or set COLOR_CONVERTER_ADDRESS', file=sys.stderr)
+        return 2
+
+    try :
+        connection = connect(address)
+    except OSError as error :
+        print(f'ERROR: Could not connect to "{address}": {error.strerror or error}', file=sys.stderr)
+        return 2
+
+    interactive = sys.stdin is not None and sys.stdin.isatty()
+    request = {'argv': argv, 'cwd': os.getcwd(), 'interactive': interactive, 'token': os.environ.get('COLOR_CONVERTER_TOKEN')}
+    connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+    responses = connection.makefile('rb')
+    while True :
+        header = responses.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size :
+            print('ERROR: Lost connection to the server', file=sys.stderr)
+            return 1
+        kind, length = FRAME_HEADER.unpack(header)
+        payload = responses.read(length)
+        if kind == b'o' :
+            sys.stdout.buffer.write(payload)
+            sys.stdout.buffer.flush()
+        elif kind == b'e' :
+            sys.stderr.buffer.write(payload)
+            sys.stderr.buffer.flush()
+        elif kind == b'i' :
+            threading.Thread(target=sendInput, args=(connection,), daemon=True).start()
+        elif kind == b'x' :
+            return int(payload)
+
+# Opens a connection to a server address (see parseServeAddress() in color-converter.py)
+def connect(address) :
+    host, _, port = address.rpartition(':')
+    if port.isdigit() and ('/' not in host) :
+        return socket.create_connection((host or '127.0.0.1', int(port)))
+    connection = socket.socket(socket.AF_UNIX)
+    connection.connect(address)
+    return connection
+
+# Sends stdin to the server as it comes in, then lets it know there's no more
+def sendInput(connection) :
+    try :
+        while True :
+            data = os.read(sys.stdin.fileno(), 1 << 16)
+            if not data :
+                break
+            connection.sendall(data)
+        connection.shutdown(socket.SHUT_WR)
+    except OSError :
+        pass
+
+
+''' init '''
+if __name__ == '__main__' :
+    try :
+        sys.exit(main())
+    except BrokenPipeError :
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    except KeyboardInterrupt :
+        sys.exit(130)
@@ -1,28 +1,62 @@
 #!/usr/bin/env python3
+import io
+import os
+import re
+import sys
 import math
-import argparse
+import mmap
+import stat
+import time
+import zlib
+import array
+import heapq
+import bisect
+import random
+import struct
+import functools
+import itertools
+import contextlib
+import collections
 
 VERSION = 1.0
-TYPES = ['hex', 'rgb', 'cmy', 'cmyk', 'hsl', 'hsv']
-# look into LAB
+TYPES = ['hex', 'rgb', 'cmy', 'cmyk', 'hsl', 'hsv', 'xyz', 'lab', 'lch']
+# the formats converted to when no output format flag is given (the CIE formats have to be asked for)
+DEFAULT_TYPES = ['hex', 'rgb', 'cmy', 'cmyk', 'hsl', 'hsv']
 
 HEX_LETTERS = ['a', 'b', 'c', 'd', 'e', 'f']
 
-OUTPUT_DESTINATION  = 'stdout'
 VERBOSE = False
+# how many colors the bulk pipeline converts at once
+BATCH_SIZE = 4096
 
 
-def main():
+# ARGS
+# argv: the command line arguments (defaults to sys.argv)
+# serving: true when answering a request forwarded by color-converter-client.py
+# RETURNS
+# the exit status, or None for success
+def main(argv = None, serving = False):
+    argv = sys.argv[1:] if argv is None else argv
+
+    # FAST PATH: nothing but color codes (the most common use) doesn't need the argument parser or any
+    # of the optional parts
+    if argv and not any(arg.startswith('-') for arg in argv) :
+        return convertArguments(argv)
 
     ''' ESTABLISH ARGS '''
+    # only needed past the fast path
+    import argparse
     parser = argparse.ArgumentParser(prog='color-converter', description='Color code converting utility written in Python.', epilog='Hope this helps :)')
     
     parser.add_argument('-hex',  action='store_true', help='convert/output to Hex')
     parser.add_argument('-rgb',  action='store_true', help='convert/output to RGB')
-    parser.add_argument('-cmy',  action='store_true', help='convert/output to CMY')
-    parser.add_argument('-cmyk', action='store_true', help='convert/output to CMYK (CMYK conversions are uncalibrated)')
-    parser.add_argument('-hsl',  action='store_true', help='convert/output to HSL')
-    parser.add_argument('-hsv',  action='store_true', help='convert/output to HSV')
+    parser.add_argument('-cmy',  action='store_true', help='convert/output to CMY (converted directly from CMYK)')
+    parser.add_argument('-cmyk', action='store_true', help='convert/output to CMYK (CMYK conversions are uncalibrated; converted directly from CMY)')
+    parser.add_argument('-hsl',  action='store_true', help='convert/output to HSL (converted directly from HSV)')
+    parser.add_argument('-hsv',  action='store_true', help='convert/output to HSV (converted directly from HSL)')
+    parser.add_argument('-xyz',  action='store_true', help='convert/output to CIE XYZ (D65)')
+    parser.add_argument('-lab',  action='store_true', help='convert/output to CIE L*a*b* (D65)')
+    parser.add_argument('-lch',  action='store_true', help='convert/output to CIE LCh (D65)')
         
     parser.add_argument('-isHex',  action='store_true', help='indicate that inputted value(s) will be hex')
     parser.add_argument('-isRgb',  action='store_true', help='indicate that inputted value(s) will be sets of RGB codes')
@@ -30,15 +64,55 @@ def main():
     parser.add_argument('-isCmyk', action='store_true', help='indicate that inputted value(s) will be sets of CMYK codes')
     parser.add_argument('-isHsl',  action='store_true', help='indicate that inputted value(s) will be sets of HSL codes')
     parser.add_argument('-isHsv',  action='store_true', help='indicate that inputted value(s) will be sets of HSL codes')
+    parser.add_argument('-isXyz',  action='store_true', help='indicate that inputted value(s) will be sets of XYZ codes')
+    parser.add_argument('-isLab',  action='store_true', help='indicate that inputted value(s) will be sets of L*a*b* codes')
+    parser.add_argument('-isLch',  action='store_true', help='indicate that inputted value(s) will be sets of LCh codes')
     
-    parser.add_argument('--input',   '-i', help='name of the input file containing color codes to process')
+    parser.add_argument('--input',   '-i', action='extend', nargs=1, help='name of an input file containing color codes to process, a directory (every file under it) or a glob pattern, can be given several times (\'-\' reads from stdin, as does piping colors in)')
     parser.add_argument('--output',  '-o', help='the name of a file to store output in (will create file if doesn\'t exist, will OVERWRITE existing file\'s contents)')
+    parser.add_argument('--follow', action='store_true', help='after converting --input, keep converting lines appended to it until interrupted (like tail -f), starting over if it\'s truncated or replaced')
+    parser.add_argument('--checkpoint', metavar='FILE', help='with --follow, save how far the input has been converted to FILE, and resume from there (appending to --output) when started again')
+    parser.add_argument('--output-dir', metavar='DIR', help='write the output of each input file to a file of the same name in DIR (mirroring the layout of input directories) rather than merging it')
+    parser.add_argument('--jobs',    '-j', type=int, default=1, help='number of processes to convert a single input file with, or to answer --serve requests with (default: 1, not available for --format css, --out-binary, --cache-dir, --quantize or table queries)')
     parser.add_argument('--append',  '-a', action='store_true', help='append rather than overwrite when outputting to file rather than stdout')
+    parser.add_argument('--format',  '-f', choices=OUTPUT_FORMATTERS.keys(), default='text', help='output format (default: text)')
+    parser.add_argument('--precision', type=int, default=2, help='number of decimals to display (default: 2)')
+    parser.add_argument('--image', metavar='FILE', help='convert the distinct colors of a PPM, PGM or PAM image, with how many pixels have each one (most common first)')
+    parser.add_argument('--top', type=int, metavar='K', help='with --image, only convert the K most common colors')
+    parser.add_argument('--palette', metavar='FILE', help='a file of color codes (one per line, in any format) for --nearest to match colors against')
+    parser.add_argument('--nearest', action='store_true', help='also output the nearest color of --palette to each color, and its CIE76 distance (in L*a*b*)')
+    parser.add_argument('--contrast', action='store_true', help='output the WCAG contrast ratio of every pair of the input colors as a CSV matrix, rather than converting them')
+    parser.add_argument('--min-ratio', type=float, metavar='R', help='with --contrast, only output the pairs of colors with a contrast ratio of at least R (e.g. 4.5), one per line')
+    parser.add_argument('--quantize', type=int, metavar='K', help='output a palette of K colors representing the input colors (in L*a*b*), with how many input colors each one stands for (most common first)')
+    parser.add_argument('--quantize-method', choices=QUANTIZE_METHODS, help='how --quantize picks the palette colors (default: median-cut)')
+    parser.add_argument('--unique', action='store_true', help='only output the first of each distinct color (by the values of the output formats)')
+    parser.add_argument('--sort', metavar='COLUMNS', help='sort the output by comma separated columns like hsl.h (a - in front sorts in descending order, e.g. --sort=-hsv.v,hex)')
+    parser.add_argument('--where', metavar='CONDITION', action='append', help='only output colors matching a condition like "hsv.v < 20" (with <, <=, >, >=, = or !=, can be given several times)')
+    parser.add_argument('--rewrite', metavar='FILE', help='convert the color literals (e.g. "#85feab" or "rgb(133, 254, 171)") inside a CSS, SVG, JSON or other text document to the --to format, rewriting it in place')
+    parser.add_argument('--to', choices=TYPES, help='the format --rewrite converts color literals to')
+    parser.add_argument('--errors', metavar='FILE', help='write color codes that can\'t be converted to FILE as JSON lines (line, input, error, reason, detail) rather than as messages on stderr')
+    parser.add_argument('--max-errors', type=int, metavar='N', help='stop after N color codes couldn\'t be converted (exit status 3)')
+    parser.add_argument('--fail-fast', action='store_true', help='stop at the first color code that can\'t be converted (same as --max-errors 1)')
+    parser.add_argument('--in-binary', action='store_true', help='the input (--input or stdin) is packed records rather than color codes, as written by --out-binary')
+    parser.add_argument('--out-binary', action='store_true', help='write packed records (a header, then 3 bytes per Hex/RGB color or little-endian float32s for the other formats) instead of text, needs exactly one output format flag')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE, help=f'number of repeated color codes to remember the output of when processing input files (default: {CACHE_SIZE})')
+    parser.add_argument('--no-cache', action='store_true', help='don\'t remember the output of repeated color codes')
+    parser.add_argument('--cache-dir', metavar='DIR', help='also keep the output of input files in a database in DIR, and reuse it for files (and parts of files) that haven\'t changed')
+    parser.add_argument('--cache-dir-size', type=int, default=PERSISTENT_CACHE_SIZE, metavar='MB', help=f'megabytes of output --cache-dir keeps, evicting the least recently used (default: {PERSISTENT_CACHE_SIZE})')
+    parser.add_argument('--clear-cache', action='store_true', help='empty --cache-dir first')
+    parser.add_argument('--cache-stats', action='store_true', help='print cache hits, misses and evictions to stderr when done')
+    parser.add_argument('--stats', action='store_true', help='print the time spent in each stage and what was processed to stderr when done')
+    parser.add_argument('--stats-json', metavar='FILE', help='write the statistics of --stats to FILE as JSON')
+    parser.add_argument('--profile', metavar='FILE', help='save a cProfile profile of the conversions to FILE')
     parser.add_argument('--verbose', '-v', action='store_true', help='print when performing conversions')
     parser.add_argument('--version', action='store_true', help='print current version')
+    parser.add_argument('--lut', metavar='DIR', help='answer Hex/RGB conversions from the precomputed lookup tables in DIR (falls back to computing if a table is missing)')
+    parser.add_argument('--build-lut', metavar='DIR', help='precompute lookup tables for every output format into DIR (needs ~100MB of disk per format)')
+    parser.add_argument('--serve', metavar='ADDRESS', help='keep running and answer requests from color-converter-client.py on ADDRESS (a Unix socket path, or [host:]port on localhost)')
+    parser.add_argument('--queue-size', type=int, default=SERVE_QUEUE_SIZE, help=f'number of --serve requests to hold while every worker is busy (default: {SERVE_QUEUE_SIZE})')
     
-    parser.add_argument('color', nargs='*', help='a color in Hex, RGB, CMY, CMYK, HSL or HSV format')
-    args = parser.parse_args()
+    parser.add_argument('color', nargs='*', help='a color in Hex, RGB, CMY, CMYK, HSL, HSV, XYZ, Lab or LCh format')
+    args = parser.parse_args(argv)
 
 
     ''' PROCESS ARGS '''
@@ -55,201 +129,745 @@ def main():
         if (vars(args).get(flag, False)) and (flag in TYPES) :
             flagsActive += 1
             outputFormats.append(flag)   
-    # if no conversion flags specified, perform every format conversion
+    # if no conversion flags specified, perform every default format conversion
     if flagsActive == 0 :
-        for colorFormat in TYPES :
+        for colorFormat in DEFAULT_TYPES :
             outputFormats.append(colorFormat)
         
-    # determine if output should be (over?)written to file
-    if args.output :
-        global OUTPUT_DESTINATION
-        OUTPUT_DESTINATION = args.output
-        if not args.append :
-            output_file = open(OUTPUT_DESTINATION, 'w')
-            output_file.write('')
-            output_file.close()
-
     # print conversion updates? 
-    if args.verbose : 
-        global VERBOSE
-        VERBOSE = True
-
-
-    ''' PARSE INPUTTED COLORS '''
-    colorCodes = []
-    # if provided a file of values
-    if args.input :
-        with open(args.input, 'r', encoding='utf-8') as file :
-            for line in file :
-                line = line.strip()
-                if line != '' :
-                    colorCodes.append(line)
-    # else grab from stdin
+    global VERBOSE
+    VERBOSE = args.verbose
+
+    # (a negative number of decimals isn't a format specifier, and --jobs and --top need at least one process or color)
+    if args.precision < 0 :
+        print('ERROR: --precision needs a number of decimals of at least 0', file=sys.stderr)
+        return 2
+    elif args.jobs < 1 :
+        print('ERROR: --jobs needs a number of processes of at least 1', file=sys.stderr)
+        return 2
+    elif (args.top is not None) and (args.top < 1) :
+        print('ERROR: --top needs a number of colors of at least 1', file=sys.stderr)
+        return 2
+
+    # packed records hold a single format
+    if args.out_binary and (flagsActive != 1) :
+        print('ERROR: --out-binary needs exactly one output format flag (e.g. -rgb)', file=sys.stderr)
+        return 2
+
+    # matching colors to a palette needs the palette, and packed records can't hold the match
+    if args.nearest != bool(args.palette) :
+        print('ERROR: --nearest and --palette FILE need each other', file=sys.stderr)
+        return 2
+    elif args.nearest and args.out_binary :
+        print('ERROR: --nearest can\'t be used with --out-binary', file=sys.stderr)
+        return 2
+
+    # several input files are merged into --output, or each get a file in --output-dir
+    if args.output_dir and (args.output or args.out_binary or not args.input) :
+        print('ERROR: --output-dir needs --input, and can\'t be used with --output or --out-binary', file=sys.stderr)
+        return 2
+    elif args.in_binary and args.input and (len(args.input) > 1) :
+        print('ERROR: --in-binary takes a single input file', file=sys.stderr)
+        return 2
+
+    # following an input file needs exactly one (seekable) file of color codes
+    if args.follow and ((not args.input) or (len(args.input) > 1) or (args.input[0] == '-') or args.in_binary or args.output_dir or args.image) :
+        print('ERROR: --follow needs a single --input file, and can\'t be used with --in-binary, --output-dir or --image', file=sys.stderr)
+        return 2
+    elif args.checkpoint and not args.follow :
+        print('ERROR: --checkpoint needs --follow', file=sys.stderr)
+        return 2
+
+    # query a table of the converted colors before outputting them (or their contrast ratios)?
+    steps = None
+    if (args.unique or args.sort or args.where or args.contrast) and (args.follow or args.output_dir) :
+        print('ERROR: --unique, --sort, --where and --contrast can\'t be used with --follow or --output-dir', file=sys.stderr)
+        return 2
+    elif args.contrast and (args.out_binary or args.nearest or (args.format not in ('text', 'csv'))) :
+        print('ERROR: --contrast writes CSV, and can\'t be used with --out-binary, --nearest or another --format', file=sys.stderr)
+        return 2
+    elif (args.min_ratio is not None) and not args.contrast :
+        print('ERROR: --min-ratio needs --contrast', file=sys.stderr)
+        return 2
+    elif args.unique or args.sort or args.where or args.contrast :
+        try :
+            # (contrast ratios come from RGB, and are labelled with Hex codes)
+            steps, tableFormats = parseTableQuery(args.unique, args.sort, args.where, ['hex', 'rgb'] if args.contrast else outputFormats)
+        except ColorError as error :
+            print(describeColorError(error), end='', file=sys.stderr)
+            return 2
+
+    # reduce the colors to a palette?
+    if (args.quantize_method is not None) and (args.quantize is None) :
+        print('ERROR: --quantize-method needs --quantize', file=sys.stderr)
+        return 2
+    elif (args.quantize is not None) and ((args.quantize < 1) or args.follow or args.output_dir or args.nearest or (steps is not None)) :
+        print('ERROR: --quantize needs a number of at least 1, and can\'t be used with --follow, --output-dir, --nearest, --unique, --sort, --where or --contrast', file=sys.stderr)
+        return 2
+
+    # rewrite the color literals of a document rather than converting color codes?
+    if bool(args.rewrite) != bool(args.to) :
+        print('ERROR: --rewrite FILE and --to FORMAT need each other', file=sys.stderr)
+        return 2
+    elif args.rewrite and (args.input or args.color or args.image or args.in_binary or args.output or args.output_dir or args.out_binary
+                           or args.nearest or (steps is not None) or (args.quantize is not None)) :
+        print('ERROR: --rewrite changes its file in place, and can\'t be used with other input (--input, --image, --in-binary or color codes), --output, --output-dir, --out-binary, --nearest, --quantize, --unique, --sort, --where or --contrast', file=sys.stderr)
+        return 2
+
+    # stop after a number of color codes couldn't be converted?
+    if (args.max_errors is not None) and (args.fail_fast or (args.max_errors < 1)) :
+        print('ERROR: --max-errors needs a number of at least 1, and can\'t be used with --fail-fast', file=sys.stderr)
+        return 2
+
+    # answer requests forwarded by color-converter-client.py rather than converting
+    if args.serve and serving :
+        print('ERROR: --serve can\'t be forwarded to a server', file=sys.stderr)
+        return 2
+    # (a served request runs as the server's user, so it only gets to write to the client's stdout and stderr)
+    elif serving and (args.output or args.output_dir or args.rewrite or args.errors or args.stats_json or args.build_lut
+                      or args.profile or args.checkpoint or args.cache_dir or args.clear_cache) :
+        print('ERROR: Requests to a server can\'t write files (--output, --output-dir, --rewrite, --errors, --stats-json, --build-lut, --profile, --checkpoint or --cache-dir), redirect the client\'s output instead', file=sys.stderr)
+        return 2
+    # (and only gets to read files under the server's directory)
+    elif serving and any(not servedPathAllowed(path) for path in (args.input or []) + [args.image, args.palette, args.lut] if path and (path != '-')) :
+        print(f'ERROR: Requests to a server can only read files under "{SERVE_ROOT}" (--input, --image, --palette and --lut)', file=sys.stderr)
+        return 2
+    elif args.serve :
+        return serve(args.serve, args.jobs, args.queue_size, args.lut)
+
+    # build lookup tables rather than converting
+    if args.build_lut :
+        for colorFormat in outputFormats :
+            if colorFormat in LUT_TYPES :
+                print('BUILT LOOKUP TABLE: ' + buildLookupTable(args.build_lut, colorFormat))
+        return
+
+    # answer conversions from lookup tables?
+    LOOKUP_TABLES.clear()
+    if args.lut and (args.precision != LUT_DECIMALS) :
+        print(f'WARNING: Lookup tables only hold {LUT_DECIMALS} decimals, ignoring --lut for --precision {args.precision}', file=sys.stderr)
+    elif args.lut :
+        loadLookupTables(args.lut, outputFormats)
+
+    # remember the output of repeated color codes?
+    global CONVERSION_CACHE
+    if args.no_cache or (args.cache_size <= 0) :
+        CONVERSION_CACHE = None
+    elif (CONVERSION_CACHE is None) or (CONVERSION_CACHE.maxSize != args.cache_size) :
+        CONVERSION_CACHE = ConversionCache(args.cache_size)
+
+    # keep the output of input files between runs?
+    global PERSISTENT_CACHE
+    PERSISTENT_CACHE = None
+    if args.clear_cache and not args.cache_dir :
+        print('ERROR: --clear-cache needs --cache-dir', file=sys.stderr)
+        return 2
+    elif args.clear_cache :
+        PersistentCache.clear(args.cache_dir)
+        print(f'CLEARED CACHE: {args.cache_dir}', file=sys.stderr)
+        if not (args.input or args.color) :
+            return
+    if args.cache_dir :
+        try :
+            PERSISTENT_CACHE = PersistentCache(args.cache_dir, args.cache_dir_size * (1 << 20))
+        except Exception as error :
+            # (OSError or sqlite3.Error, which isn't imported yet to name it)
+            print(f'WARNING: Not using the persistent cache in "{args.cache_dir}" ({error})', file=sys.stderr)
+
+    # match colors to the nearest color of a palette?
+    global PALETTE_INDEX
+    PALETTE_INDEX = None
+    if args.nearest :
+        try :
+            # (a served request runs as the server's user, so it doesn't get to save the index next to the palette)
+            PALETTE_INDEX = loadPaletteIndex(args.palette, save=not serving)
+        except ColorError as error :
+            print(describeColorError(error), end='', file=sys.stderr)
+            return 1
+        except OSError as error :
+            print(f'ERROR: Could not read palette "{args.palette}": {error.strerror or error}', file=sys.stderr)
+            return 1
+
+    # determine if output should be (over?)written to file, and in what format
+    global OUTPUT_SINK
+    # resuming from a checkpoint carries on with the output of the previous run
+    append = args.append or bool(args.checkpoint and os.path.exists(args.checkpoint))
+    if args.out_binary :
+        try :
+            OUTPUT_SINK = PackedSink(args.output or 'stdout', append, outputFormats[0], args.precision)
+        except ColorError as error :
+            print(describeColorError(error), end='', file=sys.stderr)
+            return 1
     else :
-        colorCodes = args.color    
-
-
-    ''' PROCESS COLORS '''
-    for color in colorCodes :
-        # first check if input override has been provided 
-        if args.isHex :
-            handleHex(color, outputFormats)
-        elif args.isRgb :
-            handleRGB(color, outputFormats)
-        elif args.isCmy :
-            handleCMY(color, outputFormats)
-        elif args.isCmyk :
-            handleCMYK(color, outputFormats)
-        elif args.isHsl :
-            handleHSVorHSL(color, 'hsl', outputFormats)
-        elif args.isHsv :
-            handleHSVorHSL(color, 'hsv', outputFormats)
-        # otherwise, attempt to automatically handle value 
-        elif detectColorFormat(color, outputFormats) :
-            continue
+        # image colors come with how many pixels have them, and --nearest adds the matching palette color
+        sinkFormats = outputFormats + (['count'] if (args.image or (args.quantize is not None)) else []) + (['nearest'] if args.nearest else [])
+        # (with --output-dir, each file gets its own sink and this one goes unused)
+        OUTPUT_SINK = OutputSink(args.output or 'stdout', append, 'text' if (args.output_dir or args.contrast) else args.format, sinkFormats, args.precision)
+    # (the formats a query needs get converted too, but only the requested ones are output)
+    if args.contrast :
+        OUTPUT_SINK = ContrastSink(OUTPUT_SINK, tableFormats, steps, args.min_ratio, args.precision)
+        outputFormats = tableFormats
+    elif steps is not None :
+        OUTPUT_SINK = TableSink(OUTPUT_SINK, tableFormats, steps)
+        outputFormats = tableFormats
+    elif args.quantize is not None :
+        # (only RGB is needed to count the colors, the palette is converted to the output formats)
+        OUTPUT_SINK = QuantizeSink(OUTPUT_SINK, args.quantize, args.quantize_method or 'median-cut', outputFormats)
+        outputFormats = ['rgb']
+
+    # report color codes that can't be converted to stderr, or to --errors
+    global ERROR_CHANNEL
+    try :
+        ERROR_CHANNEL = ErrorChannel(args.errors, append, 1 if args.fail_fast else args.max_errors)
+    except OSError as error :
+        OUTPUT_SINK.close()
+        print(f'ERROR: Could not write "{args.errors}": {error.strerror or error}', file=sys.stderr)
+        return 1
+
+    # (some output has to be written by a single process, see handleInput())
+    if (args.jobs > 1) and args.input and serialOutputReason(args) :
+        print(f'WARNING: Ignoring --jobs {args.jobs} for {serialOutputReason(args)}, converting in a single process', file=sys.stderr)
+
+    # record how long each stage takes?
+    global RUN_STATS
+    RUN_STATS = RunStats() if (args.stats or args.stats_json) else None
+    cacheBefore = CONVERSION_CACHE.counts() if CONVERSION_CACHE is not None else None
+    started = time.perf_counter()
+    stopped = False
+    try :
+        if args.profile :
+            status = profileCall(args.profile, processColors, args, outputFormats)
         else :
-            print('ERROR: Could not detect inputted color format and no override format flag was provided. See --help for more information on usage.')
-            return
+            status = processColors(args, outputFormats)
+    except ErrorLimitReached :
+        status = False
+        stopped = True
+    finally :
+        stageFunction(OUTPUT_SINK.close, 'write')()
+        ERROR_CHANNEL.close()
+        if PERSISTENT_CACHE is not None :
+            PERSISTENT_CACHE.close()
+
+    if args.cache_stats and (CONVERSION_CACHE is not None) :
+        print(CONVERSION_CACHE.report(), file=sys.stderr)
+    if args.cache_stats and (PERSISTENT_CACHE is not None) :
+        print(PERSISTENT_CACHE.report(), file=sys.stderr)
+    if RUN_STATS is not None :
+        wall = time.perf_counter() - started
+        cacheCounts = None
+        if cacheBefore is not None :
+            cacheCounts = tuple(after - before for after, before in zip(CONVERSION_CACHE.counts(), cacheBefore))
+        if args.stats :
+            print(RUN_STATS.report(wall, cacheCounts), file=sys.stderr)
+        if args.stats_json :
+            import json
+            with open(args.stats_json, 'w', encoding='utf-8') as file :
+                json.dump(RUN_STATS.summary(wall, cacheCounts), file, indent=2)
+                file.write('\n')
+
+    if ERROR_CHANNEL.count and (ERROR_CHANNEL.destination is not None) :
+        print(f'ERRORS: {ERROR_CHANNEL.count:,} color codes could not be converted, see "{ERROR_CHANNEL.destination}"', file=sys.stderr)
+    if stopped :
+        print(f'STOPPED: reached --max-errors {ERROR_CHANNEL.maxErrors}', file=sys.stderr)
+        return 3
+    # (a file that couldn't be read or written reports False)
+    elif (status is False) or ERROR_CHANNEL.count :
+        return 1
+
+
+# Runs the conversions requested by the parsed command line arguments
+# RETURNS
+# false if an input couldn't be read (or an output file written), None or truth otherwise
+def processColors(args, outputFormats) :
+
+    ''' PROCESS STREAMED COLORS '''
+    override = None
+    for colorFormat in TYPES :
+        if vars(args).get('is' + colorFormat.capitalize(), False) :
+            override = colorFormat
+            break
+
+    inputs = args.input or []
+    inputPath = inputs[0] if inputs else None
+
+    # a document gets its color literals rewritten
+    if args.rewrite :
+        return rewriteDocument(args.rewrite, args.to, args.precision)
+    # an image gets its distinct colors converted
+    elif args.image :
+        return handleImage(args.image, outputFormats, args.top)
+    # packed records (from a file or stdin) get converted without parsing any text
+    elif args.in_binary :
+        return handlePacked(inputPath, outputFormats)
+    # a followed file gets converted, then every line appended to it
+    elif args.follow :
+        return handleFollow(inputPath, override, outputFormats, args.checkpoint)
+    # several files (or directories, glob patterns, or --output-dir) get converted one file at a time
+    elif (len(inputs) > 1) or args.output_dir or (inputs and (inputPath != '-') and (not os.path.isfile(inputPath))
+                                                  and (os.path.isdir(inputPath) or GLOB_PATTERN.search(inputPath))) :
+        started = time.perf_counter()
+        files, unmatched = expandInputs(inputs, args.output_dir)
+        sinkOptions = {'append': args.append, 'format': args.format, 'precision': args.precision,
+                       'sinkFormats': outputFormats + (['nearest'] if args.nearest else [])}
+        failed, colorCodes = handleFiles(files, override, outputFormats, args.output_dir, sinkOptions)
+        print(f'FILES: {len(files) - failed} of {len(files)} converted ({failed} failed), {colorCodes:,} color codes in {time.perf_counter() - started:.3f}s', file=sys.stderr)
+        return (failed + unmatched) == 0
+    # if provided a file of values (or '-'/a pipe for stdin), stream it through the bulk pipeline
+    elif inputPath or ((not args.color) and (not sys.stdin.isatty())) :
+        try :
+            handleInput(args, inputPath, override, outputFormats)
+        except BrokenPipeError :
+            raise
+        except (OSError, UnicodeDecodeError) as error :
+            print(f'ERROR: Could not convert "{inputPath if inputPath not in (None, "-") else "stdin"}": {describeFileError(error)}', file=sys.stderr)
+            return False
+        return
+
+
+    ''' PROCESS ARGUMENT COLORS '''
+    handleArguments(args.color, override, outputFormats)
     return
 
+# Converts a single input file (or stdin) for processColors()
+# RAISES
+# OSError or UnicodeDecodeError if the input can't be read, or isn't UTF-8 text
+def handleInput(args, inputPath, override, outputFormats) :
+    if inputPath in (None, '-') :
+        # an interactive terminal gets every line converted as soon as it's entered
+        chunkSize = 1 if sys.stdin.isatty() else BATCH_SIZE
+        handleBulk(readColorCodes(sys.stdin), override, outputFormats, chunkSize)
+    elif (args.jobs > 1) and (serialOutputReason(args) is None) :
+        options = {'verbose': VERBOSE, 'lut': args.lut if LOOKUP_TABLES else None, 'lutFormats': list(LOOKUP_TABLES), 'format': args.format,
+                   'precision': args.precision, 'cacheSize': CONVERSION_CACHE.maxSize if CONVERSION_CACHE else 0,
+                   'stats': RUN_STATS is not None, 'palette': args.palette if args.nearest else None}
+        handleParallel(inputPath, override, outputFormats, args.jobs, options)
+    elif (PERSISTENT_CACHE is not None) and (outputSink().cacheKey is not None) :
+        with open(inputPath, 'rb') as file :
+            handleCachedFile(file, override, outputFormats)
+    else :
+        with open(inputPath, 'r', encoding='utf-8') as file :
+            handleBulk(readColorCodes(file), override, outputFormats)
+
+# Returns what keeps --jobs from converting an input file in several processes (whose output is merged
+# as formatted text), or None if nothing does
+def serialOutputReason(args) :
+    if args.format == 'css' :
+        return '--format css'
+    elif args.out_binary :
+        return '--out-binary'
+    elif PERSISTENT_CACHE is not None :
+        return '--cache-dir'
+    elif isinstance(OUTPUT_SINK, ContrastSink) :
+        return '--contrast'
+    elif isinstance(OUTPUT_SINK, TableSink) :
+        return '--unique, --sort or --where'
+    elif isinstance(OUTPUT_SINK, QuantizeSink) :
+        return '--quantize'
+    return None
+
+# Converts color codes given as arguments to the default formats, for main()'s fast path (it's
+# what main() does with no flags, minus parsing the arguments)
+# RETURNS
+# the exit status: None, or 1 if a color code couldn't be converted
+def convertArguments(colors) :
+    global VERBOSE, PALETTE_INDEX, OUTPUT_SINK, ERROR_CHANNEL, RUN_STATS
+    VERBOSE = False
+    PALETTE_INDEX = None
+    RUN_STATS = None
+    LOOKUP_TABLES.clear()
+    OUTPUT_SINK = OutputSink()
+    ERROR_CHANNEL = ErrorChannel()
+    try :
+        handleArguments(colors, None, list(DEFAULT_TYPES))
+    finally :
+        OUTPUT_SINK.close()
+    if ERROR_CHANNEL.count :
+        return 1
+
+# Handles color codes given as arguments, one at a time
+# ARGS
+# colors: list of color code strings
+# override: string indicating the format of every color code, or None to detect each one
+# outputFormats: list indicating which conversions to perform
+def handleArguments(colors, override, outputFormats) :
+    for color in colors :
+        # an override format flag takes precedence, otherwise attempt to detect the format
+        colorFormat = override or identifyColorFormat(color)
+        if colorFormat is None :
+            if RUN_STATS is not None :
+                RUN_STATS.counts['undetected'] += 1
+            errorChannel().report('line', None, color, 'ColorFormatError', UNDETECTED_MESSAGE)
+            continue
+        handleColor(color, colorFormat, outputFormats)
+
+
+'''
+# LIBRARY API
+'''
+# Nothing in this section prints or depends on module state, so other programs can convert colors
+# in-process instead of running the script: load this file as a module (e.g. installed as
+# color_converter.py) and call parseColor() and convertColor().
+
+# Raised for color codes that can't be parsed or converted. It's a ValueError, so existing
+# `except ValueError` handling still applies.
+class ColorError(ValueError) :
+    pass
+
+# Raised when a color code doesn't indicate its format and none was given
+class ColorFormatError(ColorError) :
+    pass
+
+# Raised when a color code doesn't contain the right number of well-formed values for its format
+# (detail: a description of the values that were found, when too few were)
+class ColorParseError(ColorError) :
+    def __init__(self, message, detail = None) :
+        super().__init__(message)
+        self.detail = detail
+
+# Raised when a value is out of range for its format
+class ColorRangeError(ColorError) :
+    pass
+
+# Color values are compact immutable tuples (one class per format) which str() like the CLI's
+# output, e.g. str(Hsl(138, 98.37, 75.88)) == 'hsl(138, 98.37, 75.88)'
+class ColorValue :
+    __slots__ = ()
+
+    def __str__(self) :
+        return self.format + '(' + ', '.join([f'{value:.2f}' if type(value) == float else str(value) for value in self]) + ')'
+
+class Hex(ColorValue, collections.namedtuple('Hex', ['code'])) :
+    __slots__ = ()
+    format = 'hex'
+
+    def __str__(self) :
+        return '#' + self.code
+
+class Rgb(ColorValue, collections.namedtuple('Rgb', ['r', 'g', 'b'])) :
+    __slots__ = ()
+    format = 'rgb'
+
+class Cmy(ColorValue, collections.namedtuple('Cmy', ['c', 'm', 'y'])) :
+    __slots__ = ()
+    format = 'cmy'
+
+class Cmyk(ColorValue, collections.namedtuple('Cmyk', ['c', 'm', 'y', 'k'])) :
+    __slots__ = ()
+    format = 'cmyk'
+
+class Hsl(ColorValue, collections.namedtuple('Hsl', ['h', 's', 'l'])) :
+    __slots__ = ()
+    format = 'hsl'
+
+class Hsv(ColorValue, collections.namedtuple('Hsv', ['h', 's', 'v'])) :
+    __slots__ = ()
+    format = 'hsv'
+
+class Xyz(ColorValue, collections.namedtuple('Xyz', ['x', 'y', 'z'])) :
+    __slots__ = ()
+    format = 'xyz'
+
+class Lab(ColorValue, collections.namedtuple('Lab', ['l', 'a', 'b'])) :
+    __slots__ = ()
+    format = 'lab'
+
+class Lch(ColorValue, collections.namedtuple('Lch', ['l', 'c', 'h'])) :
+    __slots__ = ()
+    format = 'lch'
+
+COLOR_TYPES = {'hex': Hex, 'rgb': Rgb, 'cmy': Cmy, 'cmyk': Cmyk, 'hsl': Hsl, 'hsv': Hsv, 'xyz': Xyz, 'lab': Lab, 'lch': Lch}
+
+# Parses a color code, as leniently as the CLI does
+# ARGS
+# color: a string containing a color code, e.g. "rgb(50, 100, 200)" or "#85feab"
+# colorFormat: the format of the color code (one of TYPES), or None to detect it
+# RETURNS
+# the color as a Hex, Rgb, Cmy, Cmyk, Hsl, Hsv, Xyz, Lab or Lch
+# RAISES
+# ColorFormatError, ColorParseError or ColorRangeError (all ColorErrors)
+def parseColor(color, colorFormat = None) :
+    if (colorFormat is not None) and (colorFormat not in COLOR_TYPES) :
+        raise ColorFormatError(f'Unknown color format: {colorFormat}')
+    colorFormat, tokens = tokenizeColor(color, colorFormat)
+    if colorFormat is None :
+        raise ColorFormatError(f'Could not detect the format of "{color}"')
+    return toColorValue(colorFormat, validateColor(color, colorFormat, tokens))
+
+# Converts a color to another format
+# ARGS
+# color: a Hex, Rgb, Cmy, Cmyk, Hsl, Hsv, Xyz, Lab or Lch (or a color code string, which gets parsed first)
+# colorFormat: the format to convert to (one of TYPES)
+# RETURNS
+# the converted color, as the Color type of colorFormat
+# RAISES
+# ColorError if the color is invalid or the format is unknown
+def convertColor(color, colorFormat) :
+    if colorFormat not in COLOR_TYPES :
+        raise ColorFormatError(f'Unknown color format: {colorFormat}')
+    if isinstance(color, str) :
+        color = parseColor(color)
+    elif not isinstance(color, ColorValue) :
+        raise ColorFormatError(f'Not a color: {color!r}')
+    if color.format == colorFormat :
+        return color
+
+    converted = convertValues(color.format, validateColorValue(color), [colorFormat])
+    return toColorValue(colorFormat, converted[colorFormat])
+
+# Checks the values of a color that wasn't made by parseColor()
+# RETURNS
+# the color's validated values, in the form the conversion functions take
+def validateColorValue(color) :
+    if color.format == 'hex' :
+        if (type(color.code) != str) or (not HEX_PATTERN.fullmatch(color.code)) :
+            raise ColorParseError('Improper format for hex code (see --help)')
+        return color.code
+    try :
+        tokens = [float(value) for value in color]
+    except (TypeError, ValueError) :
+        raise ColorParseError(f'Improper format for {color.format.upper()} (see --help)') from None
+    return validateColor(repr(color), color.format, tokens)
+
+# Wraps validated/converted values of a format in that format's Color type
+def toColorValue(colorFormat, values) :
+    if colorFormat == 'hex' :
+        return Hex(values)
+    return COLOR_TYPES[colorFormat](*values)
+
 
 '''
 # FORMAT HANDLERS
 '''
-# Handles a hex value's conversion and output
+# Handles a color code's validation, conversion and output
 # ARGS
-# color: string containing hex code
+# color: string containing a color code
+# colorFormat: string (one of TYPES) indicating the format of the color code
 # outputFormats: list indicating which conversions to perform
-def handleHex(color, outputFormats) :
-    # validate/sanitize input
-    hexcode = validateHex(color)
-    if hexcode is None :
+def handleColor(color, colorFormat, outputFormats) :
+    if RUN_STATS is not None :
+        RUN_STATS.counts['lines'] += 1
+    try :
+        validated = stageFunction(validateColor, 'validate')(color, colorFormat)
+    except ColorError as error :
+        countInvalid(error)
+        errorChannel().report(*errorRecord(error, None, color))
         return
 
-    # convert and collect results
-    results = {}
-    if VERBOSE :
-        results['verbose-msg'] = 'CONVERTING HEX: ' + hexcode
-
-    rgbValues = HEXtoRGB(hexcode)
-    for colorFormat in TYPES :
-        if colorFormat in outputFormats and colorFormat == 'hex' :
-            results['hex'] = hexcode
-        elif colorFormat in outputFormats and colorFormat == 'rgb' :
-            results['rgb'] = rgbValues
-        elif colorFormat in outputFormats :
-            results[colorFormat] = rgbTo(colorFormat, rgbValues)
+    resultRows = stageFunction(convertRows, 'convert')(colorFormat, [validated], outputFormats)
+    if PALETTE_INDEX is not None :
+        stageFunction(matchNearest, 'convert')(colorFormat, [validated], resultRows)
+    stageFunction(printConversions, 'write')(resultRows[0])
+    if RUN_STATS is not None :
+        RUN_STATS.counts['converted.' + colorFormat] += 1
 
-    printConversions(results)
 
 
-# Handles an RGB value's conversion and output
+# Handles a stream of color values, one small chunk at a time, so memory use doesn't depend on how
+# many there are. Output (and errors, see ERROR CHANNEL) comes out in the same order as handling each
+# value one by one. The work is split into generator stages:
+#   readColorCodes() -> parseColors() -> convertColors() -> writeConversions()
 # ARGS
-# color: string containing RGB code
-# outputFormats: list indicating which conversions to perform 
-def handleRGB(color, outputFormats) :
-    # validate/sanitize input
-    rgbValues = validateRGB(color)
-    if rgbValues is None :
-        return
+# colorCodes: iterable of (line number, color code string) tuples
+# override: string indicating the format of every color code, or None to detect each one
+# outputFormats: list indicating which conversions to perform
+# chunkSize: how many colors to convert at once
+def handleBulk(colorCodes, override, outputFormats, chunkSize = BATCH_SIZE) :
+    sink = outputSink()
 
-    # convert and collect results
-    results = {}
-    if VERBOSE :
-        results['verbose-msg'] = 'CONVERTING RGB: ' + str(rgbValues)
-    
-    for colorFormat in TYPES :
-        if colorFormat in outputFormats and colorFormat == 'rgb' :
-            results['rgb'] = rgbValues
-        elif colorFormat in outputFormats :
-            results[colorFormat] = rgbTo(colorFormat, rgbValues)
-    
-    printConversions(results)
+    # cached output is only valid for the same override, conversions, output settings and palette
+    keySuffix = None
+    if (CONVERSION_CACHE is not None) and (sink.cacheKey is not None) :
+        keySuffix = (override, tuple(outputFormats), VERBOSE, sink.cacheKey, PALETTE_INDEX.key if PALETTE_INDEX is not None else None)
 
-# Handles a CMY value's conversion and output
+    if RUN_STATS is not None :
+        colorCodes = timedRead(colorCodes, chunkSize)
+    parsed = parseColors(colorCodes, override, keySuffix)
+    writeConversions(convertColors(parsed, outputFormats, chunkSize))
+
+# Yields the line number and stripped contents of each non-empty line of an open file
 # ARGS
-# color: string containing CMY code
-# outputFormats: list indicating which conversions to perform 
-def handleCMY(color, outputFormats) :
-    # validate/sanitize input
-    cmyValues = validateCMYorCMYK(color, False) 
-    if cmyValues is None :
-        return
+# file: an open file (or any iterable of lines)
+# firstLine: the line number of the first line
+def readColorCodes(file, firstLine = 1) :
+    for lineNumber, line in enumerate(file, firstLine) :
+        line = line.strip()
+        if line != '' :
+            yield lineNumber, line
 
-    # convert and collect results
-    results = {}
-    if VERBOSE :
-        results['verbose-msg'] = 'CONVERTING CMY: ' + str(cmyValues)
+# Detects and validates each color code, errors are labelled with the line they came from
+# ARGS
+# colorCodes: iterable of (line number, color code string) tuples
+# override: string indicating the format of every color code, or None to detect each one
+# keySuffix: what to add to a color code to make its CONVERSION_CACHE key, or None to not use the cache
+# RETURNS
+# yields (format, validated values, cache key) for valid colors, (None, error record, None) for
+# invalid ones (see errorRecord()) and ('formatted', output, None) for colors whose output was cached
+def parseColors(colorCodes, override, keySuffix = None) :
+    # with --stats, the time of each step is added up here (and only recorded once at the end)
+    timing = RUN_STATS is not None
+    perfCounter = time.perf_counter
+    cacheTime = detectTime = validateTime = 0.0
+    cachedCount = 0
+    try :
+        for lineNumber, color in colorCodes :
+            if timing :
+                started = perfCounter()
+            key = None
+            if keySuffix is not None :
+                key = (color,) + keySuffix
+                cached = CONVERSION_CACHE.get(key)
+                if timing :
+                    now = perfCounter()
+                    cacheTime += now - started
+                    started = now
+                if cached is not None :
+                    isError, value = cached
+                    cachedCount += 1
+                    if isError :
+                        yield None, ('line', lineNumber, color) + value, None
+                    else :
+                        yield 'formatted', value, None
+                    continue
 
-    rgbValues = CMYtoRGB(cmyValues)
-    for colorFormat in TYPES :
-        if colorFormat in outputFormats and colorFormat == 'rgb' :
-            results['rgb'] = rgbValues
-        elif colorFormat in outputFormats and colorFormat == 'cmy' :
-            results['cmy'] = cmyValues
-        elif colorFormat in outputFormats :
-            results[colorFormat] = rgbTo(colorFormat, rgbValues)
-
-    printConversions(results)
-
-# Handles a CMYK value's conversion and output
-# ARGS
-# color: string containing CMYK code
-# outputFormats: list indicating which conversions to perform 
-def handleCMYK(color, outputFormats) :
-    # validate/sanitize input
-    cmykValues = validateCMYorCMYK(color, True) 
-    if cmykValues is None :
-        return
+            colorFormat, tokens = tokenizeColor(color, override)
+            if timing :
+                now = perfCounter()
+                detectTime += now - started
+                started = now
+            if colorFormat is None :
+                if timing :
+                    RUN_STATS.counts['undetected'] += 1
+                if key is not None :
+                    CONVERSION_CACHE.put(key, (True, ('ColorFormatError', UNDETECTED_MESSAGE, None)))
+                yield None, ('line', lineNumber, color, 'ColorFormatError', UNDETECTED_MESSAGE, None), None
+                continue
 
-    # convert and collect results
-    results = {}
-    if VERBOSE :
-        results['verbose-msg'] = 'CONVERTING CMYK: ' + str(cmykValues)
- 
-    rgbValues = CMYKtoRGB(cmykValues)
-    for colorFormat in TYPES :
-        if (colorFormat in outputFormats) and (colorFormat == 'rgb') :
-            results['rgb'] = rgbValues
-        elif (colorFormat in outputFormats) and (colorFormat == 'cmyk') :
-            results['cmyk'] = cmykValues
-        elif colorFormat in outputFormats :
-            results[colorFormat] = rgbTo(colorFormat, rgbValues)
-
-    printConversions(results)
-
-# Handles either an HSV or HSL value's conversion and output
-# ARGS
-# color: string containing CMY code
-# outputFormats: list indicating which conversions to perform 
-# handle: string ('hsl' or 'hsv'), indicating which format to handle 
-def handleHSVorHSL(color, handle, outputFormats) :
-    # sanitize/validate input
-    validated = validateHSLorHSV(color)
-    if validated is None :
-        return
+            try :
+                validated = validateColor(color, colorFormat, tokens)
+            except ColorError as error :
+                if timing :
+                    validateTime += perfCounter() - started
+                countInvalid(error)
+                record = errorRecord(error, lineNumber, color)
+                if key is not None :
+                    CONVERSION_CACHE.put(key, (True, record[3:]))
+                yield None, record, None
+                continue
+            if timing :
+                validateTime += perfCounter() - started
+            yield colorFormat, validated, key
+    finally :
+        if timing :
+            RUN_STATS.times.update(cache=cacheTime, detect=detectTime, validate=validateTime)
+            RUN_STATS.counts['cached'] += cachedCount
 
-    # convert and collect results
-    results = {}
-    if VERBOSE :
-        if handle == 'hsl' :
-            results['verbose-msg'] = 'CONVERTING HSL: ' + str(validated)
+# Converts parsed colors in chunks, using the batch engine when numpy is available
+# RETURNS
+# yields (format, results map, cache key) for each converted color and passes everything else
+# through, in their original order
+def convertColors(parsed, outputFormats, chunkSize = BATCH_SIZE) :
+    pending = []
+    for item in parsed :
+        pending.append(item)
+        if len(pending) >= chunkSize :
+            yield from convertChunk(pending, outputFormats)
+            pending = []
+    yield from convertChunk(pending, outputFormats)
+
+# Converts a chunk of parsed colors (grouped by format), see convertColors()
+def convertChunk(pending, outputFormats) :
+    started = time.perf_counter() if RUN_STATS is not None else None
+    groups = {}
+    for i, (colorFormat, validated, _) in enumerate(pending) :
+        if colorFormat in TYPES :
+            groups.setdefault(colorFormat, []).append((i, validated))
+
+    ordered = [None] * len(pending)
+    for colorFormat, group in groups.items() :
+        rows = [validated for _, validated in group]
+        if ((colorFormat in ('hex', 'rgb')) and LOOKUP_TABLES) or (not loadNumpy()) :
+            resultRows = convertRows(colorFormat, rows, outputFormats)
         else :
-            results['verbose-msg'] = 'CONVERTING HSV: ' + str(validated)
-    
-    rgbValues = HSLorHSVToRGB(validated, handle)
-    for colorFormat in TYPES :
-        if (colorFormat in outputFormats) and (colorFormat == 'rgb') :
-            results['rgb'] = rgbValues
-        elif (colorFormat in outputFormats) and (colorFormat == 'hsl') and (handle == 'hsl') :
-            results['hsl'] = validated
-        elif (colorFormat in outputFormats) and (colorFormat == 'hsv') and (handle == 'hsv'):
-            results['hsv'] = validated
-        elif colorFormat in outputFormats :
-            results[colorFormat] = rgbTo(colorFormat, rgbValues)
+            resultRows = batchConvertRows(colorFormat, rows, outputFormats)
+        if PALETTE_INDEX is not None :
+            matchNearest(colorFormat, rows, resultRows)
+        for (i, _), results in zip(group, resultRows) :
+            ordered[i] = results
+        if started is not None :
+            countConverted(colorFormat, len(rows), outputFormats)
+
+    if started is not None :
+        RUN_STATS.times['convert'] += time.perf_counter() - started
+
+    for (colorFormat, value, key), results in zip(pending, ordered) :
+        yield (colorFormat, value, key) if results is None else (colorFormat, results, key)
+
+# Delivers converted colors through the output sink (caching their formatted output), and errors
+# through the error channel
+def writeConversions(converted) :
+    sink = outputSink()
+    channel = errorChannel()
+    # with --stats, the time of each step is added up here (see parseColors())
+    timing = RUN_STATS is not None
+    perfCounter = time.perf_counter
+    formatTime = writeTime = 0.0
+    try :
+        for colorFormat, value, key in converted :
+            if timing :
+                started = perfCounter()
+            if colorFormat is None :
+                channel.report(*value)
+            elif colorFormat == 'formatted' :
+                sink.writeFormatted(value)
+            else :
+                text = sink.formatColor(value)
+                if timing :
+                    now = perfCounter()
+                    formatTime += now - started
+                    started = now
+                sink.writeFormatted(text)
+                if key is not None :
+                    CONVERSION_CACHE.put(key, (False, text))
+            if timing :
+                writeTime += perfCounter() - started
+    finally :
+        if timing :
+            RUN_STATS.times.update(format=formatTime, write=writeTime)
+
+# convertRows() is the scalar counterpart of batchConvertRows(), answering Hex/RGB conversions from
+# the lookup tables when they're loaded
+# ARGS
+# sourceFormat: a string (one of TYPES) indicating the format of the values
+# rows: a list of validated values, as returned by the validators
+# outputFormats: list indicating which conversions to perform
+# RETURNS
+# a list of results maps, one per row
+def convertRows(sourceFormat, rows, outputFormats) :
+    # conversions from RGB answer from the lookup tables, when they're loaded
+    steps = []
+    for source, target, edge in planConversions(sourceFormat, outputFormats) :
+        if (source == 'rgb') and (target in LOOKUP_TABLES) :
+            steps.append((source, target, functools.partial(lookupRgbTo, target)))
+        else :
+            steps.append((source, target, edge.function))
 
-    printConversions(results)
+    resultRows = []
+    for validated in rows :
+        results = {}
+        if VERBOSE :
+            if sourceFormat == 'hex' :
+                results['verbose-msg'] = 'CONVERTING HEX: ' + validated
+            else :
+                results['verbose-msg'] = 'CONVERTING ' + sourceFormat.upper() + ': ' + str(validated)
 
+        converted = {sourceFormat : validated}
+        for source, target, function in steps :
+            converted[target] = function(converted[source])
+        for colorFormat in TYPES :
+            if colorFormat in outputFormats :
+                results[colorFormat] = converted[colorFormat]
+        resultRows.append(results)
+    return resultRows
 
 
 '''
@@ -446,228 +1064,4002 @@ def HSLorHSVToRGB(values, convertFrom) :
         B = x + m
         return [smartRound(R * 255), smartRound(G * 255), smartRound(B * 255)]
     else :
-        print('RGB to HSV/HSL conversion failed')
-        return
+        raise ColorRangeError('RGB to HSV/HSL conversion failed')
 
 
-'''
-# INPUT VALIDATION 
-'''
+##
+# DIRECT CONVERSIONS SECTION
+##
+# Conversions between closely related formats that don't need to round to RGB integers on the way.
+# Like the RGB conversions, they return a plain 0 for the hue of grays and for C, M and Y of black,
+# and a hue of 360 as 0.
 
-# Takes in a string. 
-# If string contains a valid Hex color code, it gets returned as a string.
-def validateHex(value) :
-    # attempt to extract hex code
-    hexcode = extractValues(value, 1, True)
+# Takes in a list with 1 integer and 2 floats (HSL), returns a list of 3 floats (HSV)
+def HSLtoHSV(hslValues) :
+    normalSaturation = hslValues[1] / 100
+    normalLightness = hslValues[2] / 100
 
-    if not hexcode :
-        print('ERROR: Improper format for hex code (see --help)')
-        return 
+    chroma = (1 - math.fabs((2 * normalLightness) - 1)) * normalSaturation
+    value = normalLightness + (chroma / 2)
+    saturation = 0.0
+    if value != 0 :
+        saturation = chroma / value
+    if saturation == 0 :
+        return [0, saturation * 100, value * 100]
+    return [float(hslValues[0]) % 360, saturation * 100, value * 100]
 
-    return hexcode[0]
+# Takes in a list with 1 integer and 2 floats (HSV), returns a list of 3 floats (HSL)
+def HSVtoHSL(hsvValues) :
+    normalSaturation = hsvValues[1] / 100
+    normalValue = hsvValues[2] / 100
 
-# Takes in a string. Returns same list as integers if valid RGB values. 
-def validateRGB(color) :
-    # extract 3 numbers from the provided values
-    rgbValues = extractValues(color, 3)
+    chroma = normalValue * normalSaturation
+    lightness = normalValue - (chroma / 2)
+    saturation = 0.0
+    if (lightness != 0) and (lightness != 1) :
+        saturation = (normalValue - lightness) / min(lightness, 1 - lightness)
+    if saturation == 0 :
+        return [0, saturation * 100, lightness * 100]
+    return [float(hsvValues[0]) % 360, saturation * 100, lightness * 100]
 
-    if not rgbValues : 
-        print('ERROR: Improper format for RGB (see --help)')
-        return
+# Takes in a list of 3 floats (CMY), returns a list of 4 floats (CMYK)
+def CMYtoCMYK(cmyValues) :
+    cyan    = cmyValues[0] / 100
+    magenta = cmyValues[1] / 100
+    yellow  = cmyValues[2] / 100
 
-    intValues = []
-    for value in rgbValues :
-        value = smartRound(value)
-        if (value < 0) or (value > 255) :
-            print(f'ERROR: Each RBG value must be between 0-255, was {value}')
-            return 
-        intValues.append(value)
-    
-    return intValues
+    black = min(cyan, magenta, yellow)
+    x     = 1 - black
+    if x == 0 :
+        return [0, 0, 0, round(black * 100, 2)]
+    return [((cyan - black) / x) * 100, ((magenta - black) / x) * 100, ((yellow - black) / x) * 100, black * 100]
 
-# Takes in a list of 3 or 4 strings. Returns same list as integers if valid CMYK values.
-def validateCMYorCMYK(color, include_K) :
-    k = ''
-    if include_K :
-        k = 'K'
-        values = extractValues(color, 4)
-    else :
-        values = extractValues(color, 3)
-    if not values :
-        print(f'ERROR: Improper format for CMY{k} (see --help)') 
-        return
+# Takes in a list of 4 floats (CMYK), returns a list of 3 floats (CMY)
+def CMYKtoCMY(cmykValues) :
+    black = cmykValues[3] / 100
+    return [(((cmykValues[0] / 100) * (1 - black)) + black) * 100,
+            (((cmykValues[1] / 100) * (1 - black)) + black) * 100,
+            (((cmykValues[2] / 100) * (1 - black)) + black) * 100]
 
-    floatValues = []
-    for value in values :
-        value = float(value)
-        if (value < 0) or (value > 100) :
-            print(f'ERROR: Each CMY{k} value must be between 0.0-100.0, was {value}')
-            return
-        floatValues.append(value)
-    
-    return floatValues
 
-# Takes in a list of 3 strings. Returns same list as 1 integer and 2 floats
-def validateHSLorHSV(color) :
-    color = extractValues(color, 3)
-    if color is None :
-        print(f'ERROR: Improper format for HSL/V (see --help)') 
-        return
+##
+# CIE FORMATS SECTION
+##
+# CIE XYZ (D65, scaled so white has Y = 100), CIE L*a*b* and LCh (L*a*b* in polar coordinates)
+# convert through each other, and XYZ <-> RGB goes through linear light. The sRGB curve only ever
+# needs evaluating for the 256 8-bit values: SRGB_TO_LINEAR decodes each of them, and encoding finds
+# where a linear value falls among SRGB_THRESHOLDS (the linear values halfway between neighbouring
+# 8-bit values), which gives the nearest RGB integer without a pow() per color.
 
-    for i in range(3) :
-        if i == 0 :
-            color[i] = smartRound(color[i])
-        else :
-            color[i] = float(color[i])
+# linear sRGB <-> XYZ matrices (as in CSS Color 4)
+XYZ_MATRIX = [[0.41239079926595934, 0.357584339383878,   0.1804807884018343],
+              [0.21263900587151027, 0.715168678767756,   0.07219231536073371],
+              [0.01933081871559182, 0.11919477979462598, 0.9505321522496607]]
+RGB_MATRIX = [[3.2409699419045226,  -1.537383177570094,   -0.4986107602930034],
+              [-0.9692436362808796,  1.8759675015077202,   0.04155505740717559],
+              [0.05563007969699366, -0.20397695888897652,  1.0569715142428786]]
+# L*a*b* constants: f(t) is a cube root above LAB_DELTA^3, and a line below it
+LAB_DELTA = 6 / 29
+LAB_DELTA_CUBED = LAB_DELTA * LAB_DELTA * LAB_DELTA
+LAB_SLOPE = 3 * LAB_DELTA * LAB_DELTA
+LAB_OFFSET = 4 / 29
+# a and b closer than this to 0 are rounding noise (of grays), and are snapped to 0
+LAB_EPSILON = 1e-9
 
-    if (color[0] < 0) or (color[0] > 360) :
-        print(f'ERROR: Invalid H value (should be 0-360, was {color[0]})')
-        return
-    if (color[1] < 0) or (color[1] > 100) :
-        print(f'ERROR: Invalid S value (should be 0.0-100.0, was {color[1]})')
-        return
-    if (color[2] < 0) or (color[2] > 100) :
-        print(f'ERROR: Invalid V/L value (should be 0.0-100.0, was {color[2]})')
-        return
+# Takes in an sRGB value (0-1), returns it as linear light (0-1)
+def decodeSRGB(value) :
+    if value <= 0.04045 :
+        return value / 12.92
+    return ((value + 0.055) / 1.055) ** 2.4
 
-    return [color[0], color[1], color[2]]
+SRGB_TO_LINEAR = [decodeSRGB(value / 255) for value in range(256)]
+SRGB_THRESHOLDS = [decodeSRGB((value + 0.5) / 255) for value in range(255)]
+
+# Takes in a list of 3 integers, returns a list of 3 floats (XYZ)
+def RGBtoXYZ(rgbValues) :
+    red   = SRGB_TO_LINEAR[rgbValues[0]]
+    green = SRGB_TO_LINEAR[rgbValues[1]]
+    blue  = SRGB_TO_LINEAR[rgbValues[2]]
+    return [((row[0] * red) + (row[1] * green) + (row[2] * blue)) * 100 for row in XYZ_MATRIX]
+
+# the XYZ of RGB white, which L*a*b* is relative to
+D65_WHITE = RGBtoXYZ([255, 255, 255])
+
+# Takes in a list of 3 floats (XYZ), returns a list of 3 integers (out of gamut colors are clipped)
+def XYZtoRGB(xyzValues) :
+    x = xyzValues[0] / 100
+    y = xyzValues[1] / 100
+    z = xyzValues[2] / 100
+    return [bisect.bisect_left(SRGB_THRESHOLDS, (row[0] * x) + (row[1] * y) + (row[2] * z)) for row in RGB_MATRIX]
+
+# Takes in a list of 3 floats (XYZ), returns a list of 3 floats (L*a*b*)
+def XYZtoLAB(xyzValues) :
+    fx = labF(xyzValues[0] / D65_WHITE[0])
+    fy = labF(xyzValues[1] / D65_WHITE[1])
+    fz = labF(xyzValues[2] / D65_WHITE[2])
+    a = 500 * (fx - fy)
+    b = 200 * (fy - fz)
+    return [(116 * fy) - 16, 0.0 if abs(a) < LAB_EPSILON else a, 0.0 if abs(b) < LAB_EPSILON else b]
+
+# Takes in a list of 3 floats (L*a*b*), returns a list of 3 floats (XYZ)
+def LABtoXYZ(labValues) :
+    fy = (labValues[0] + 16) / 116
+    fx = fy + (labValues[1] / 500)
+    fz = fy - (labValues[2] / 200)
+    return [labFInverse(fx) * D65_WHITE[0], labFInverse(fy) * D65_WHITE[1], labFInverse(fz) * D65_WHITE[2]]
+
+# Takes in a list of 3 floats (L*a*b*), returns a list of 3 floats (LCh), with a plain 0 for the hue of grays
+def LABtoLCH(labValues) :
+    a = labValues[1]
+    b = labValues[2]
+    chroma = math.sqrt((a * a) + (b * b))
+    if chroma == 0 :
+        return [labValues[0], chroma, 0]
+    hue = math.atan2(b, a) * (180 / math.pi)
+    return [labValues[0], chroma, hue + 360 if hue < 0 else hue]
+
+# Takes in a list of 3 floats (LCh), returns a list of 3 floats (L*a*b*)
+def LCHtoLAB(lchValues) :
+    hue = lchValues[2] * (math.pi / 180)
+    a = lchValues[1] * math.cos(hue)
+    b = lchValues[1] * math.sin(hue)
+    return [lchValues[0], 0.0 if abs(a) < LAB_EPSILON else a, 0.0 if abs(b) < LAB_EPSILON else b]
+
+# The L*a*b* companding function, takes in a value relative to white (XYZ / D65_WHITE)
+def labF(value) :
+    if value > LAB_DELTA_CUBED :
+        return cubeRoot(value)
+    return (value / LAB_SLOPE) + LAB_OFFSET
+
+# Inverse of labF()
+def labFInverse(value) :
+    if value > LAB_DELTA :
+        return value * value * value
+    return LAB_SLOPE * (value - LAB_OFFSET)
+
+# Takes in a positive float, returns its cube root
+def cubeRoot(value) :
+    return value ** (1 / 3)
 
 
 '''
-# GENERAL UTILITIES
+# BATCH CONVERSIONS
 '''
 
+# numpy is optional; it's only imported the first time a batch conversion is requested
+NUMPY = None
+# every possible byte as a two character hex string (for vectorized RGB -> Hex), built on first use
+HEX_PAIRS = None
+# SRGB_TO_LINEAR as an array (for vectorized RGB -> XYZ), built on first use
+SRGB_TO_LINEAR_ARRAY = None
+
+# Returns the numpy module, or None if it isn't installed
+def loadNumpy() :
+    global NUMPY
+    if NUMPY is None :
+        try :
+            import numpy
+            NUMPY = numpy
+        except ImportError :
+            NUMPY = False
+    return NUMPY or None
+
+# batchConvert() is the vectorized counterpart of convertValues(): it converts many colors of a
+# single format at once, following the same plan and producing exactly the same numbers as the
+# scalar conversion functions
 # ARGS
-# color: a string containing a color value in an unknown format
-# outputFormats: a list containing information necessary for handling conversions, used if format is detected
+# sourceFormat: a string (one of TYPES) indicating the format of the values
+# values: an (N,3) or (N,4) array of validated values (for hex, a sequence of N hex strings)
+# outputFormats: list indicating which conversions to perform
 # RETURNS
-# truth if success, false if failure to detect a format
-def detectColorFormat(color, outputFormats) :
-    if 'rgb' in color.lower() :
-        handleRGB(color, outputFormats)
-        return True
-    elif 'cmyk' in color.lower() :
-        handleCMYK(color, outputFormats)
-        return True
-    elif 'cmy' in color.lower() :
-        handleCMY(color, outputFormats)
-        return True
-    elif 'hsl' in color.lower() :
-        handleHSVorHSL(color, 'hsl', outputFormats)
-        return True
-    elif 'hsv' in color.lower() :
-        handleHSVorHSL(color, 'hsv', outputFormats)
-        return True
-    elif '#' in color :
-        handleHex(color, outputFormats)
-        return True
+# a map of each requested format (and any format converted through on the way) to an array of N
+# converted rows (hex rows are strings)
+def batchConvert(sourceFormat, values, outputFormats = TYPES) :
+    np = loadNumpy()
+
+    if sourceFormat == 'hex' :
+        values = np.asarray(values, dtype=str)
+    elif sourceFormat == 'rgb' :
+        values = np.asarray(values, dtype=np.float64).astype(np.int64)
     else :
-        return False
+        values = np.asarray(values, dtype=np.float64)
 
+    converted = {sourceFormat : values}
+    for source, target, edge in planConversions(sourceFormat, outputFormats) :
+        converted[target] = edge.batchFunction(converted[source])
+    return converted
 
-# Extracts numerical (hex or decimal) values from a string. 
+# batchConvertRows() converts validated colors with batchConvert() and hands back the same
+# results maps convertRows() builds, so they can go straight to printConversions()
 # ARGS
-# color: string containing value(s)
-# numValues: determines how many values to extract (e.g. 3 for RGB, 4 for CMYK)
-# isHex: determines if we're looking for hex rather than decimal
+# sourceFormat: a string (one of TYPES) indicating the format of the values
+# rows: a list of validated values, as returned by the validators
+# outputFormats: list indicating which conversions to perform
 # RETURNS
-# a list of extracted color/number values in string form (or false if faulure to extract)
-def extractValues(color, numValues, isHex = False) :
-    i = 0
-    tempValue = ''
-    extractedValues = []
-
-    if isHex :
-        # search for hex values
-        while i < len(color) :
-            if (color[i].isnumeric()) or (color[i] in HEX_LETTERS) :
-                tempValue += color[i]
-            else :
-                tempValue = ''
-            if len(tempValue) == 6 :
-                extractedValues.append(tempValue)
-                tempValue = ''
-            if len(extractedValues) == numValues :
-                break
-            i = i + 1
+# a list of results maps, one per row
+def batchConvertRows(sourceFormat, rows, outputFormats) :
+    np = loadNumpy()
+    converted = batchConvert(sourceFormat, rows, outputFormats)
+    sources = {target : source for source, target, _ in planConversions(sourceFormat, outputFormats)}
 
-        if (len(extractedValues) != numValues) and (len(tempValue) == 6) :
-            extractedValues.append(tempValue)
+    # the scalar functions return plain ints for a few edge cases, which changes their printed form
+    columns = {}
+    for colorFormat, values in converted.items() :
+        if colorFormat not in outputFormats :
+            continue
+        elif colorFormat == sourceFormat :
+            columns[colorFormat] = rows
+            continue
+        values = values.tolist()
+        if colorFormat == 'cmyk' :
+            if sources['cmyk'] == 'cmy' :
+                black = (converted['cmy'].min(axis=1) / 100) == 1
+            else :
+                black = converted['rgb'].max(axis=1) == 0
+            for i in np.flatnonzero(black).tolist() :
+                values[i] = [0, 0, 0, round(values[i][3], 2)]
+        elif colorFormat in ('hsl', 'hsv') :
+            for i in np.flatnonzero(converted[colorFormat][:, 1] == 0).tolist() :
+                values[i][0] = 0
+        elif colorFormat == 'lch' :
+            for i in np.flatnonzero(converted[colorFormat][:, 1] == 0).tolist() :
+                values[i][2] = 0
+        columns[colorFormat] = values
 
-    else :
-        # search for decimal values
-        while i < len(color) :
-            if color[i].isnumeric() or color[i] == '.' :
-                tempValue += color[i]
-            elif len(tempValue) > 0 and tempValue != '.' :
-                extractedValues.append(tempValue)
-                tempValue = ''
+    resultRows = []
+    for i in range(len(rows)) :
+        results = {}
+        if VERBOSE :
+            if sourceFormat == 'hex' :
+                results['verbose-msg'] = 'CONVERTING HEX: ' + rows[i]
             else :
-                tempValue = ''
-            if len(extractedValues) == numValues :
-                break
-            i = i + 1
+                results['verbose-msg'] = 'CONVERTING ' + sourceFormat.upper() + ': ' + str(rows[i])
+        for colorFormat in TYPES :
+            if colorFormat in columns :
+                results[colorFormat] = columns[colorFormat][i]
+        resultRows.append(results)
+    return resultRows
+
+# Vectorized rgbTo(): takes an (N,3) array of integers, returns an array of converted rows
+def batchRgbTo(colorFormat, rgbValues) :
+    global HEX_PAIRS
+    np = loadNumpy()
+    if colorFormat == 'hex' :
+        if HEX_PAIRS is None :
+            HEX_PAIRS = np.array([RGBtoHEX([i]) for i in range(256)])
+        pairs = HEX_PAIRS
+        return np.char.add(np.char.add(pairs[rgbValues[:, 0]], pairs[rgbValues[:, 1]]), pairs[rgbValues[:, 2]])
 
-        if (len(extractedValues) != numValues) and (len(tempValue) > 0) :
-            extractedValues.append(tempValue)
+    normal = rgbValues / 255
+    normalRed, normalGreen, normalBlue = normal[:, 0], normal[:, 1], normal[:, 2]
 
-    if len(extractedValues) != numValues :
-        print(f'Could not extract the correct number of values from input: "{color}".\n- Number of values required: {numValues}\n- {len(extractedValues)} values successfully extracted: {extractedValues}')
-        return False
+    if colorFormat == 'cmy' :
+        return np.stack([(1 - normalRed) * 100, (1 - normalGreen) * 100, (1 - normalBlue) * 100], axis=1)
+
+    xMax = normal.max(axis=1)
+    if colorFormat == 'cmyk' :
+        black = 1 - xMax
+        x = 1 - black
+        # rows with x == 0 (pure black) are zeroed rather than divided
+        safeX = np.where(x == 0, 1, x)
+        cyan    = np.where(x == 0, 0, (1 - normalRed - black)   / safeX)
+        magenta = np.where(x == 0, 0, (1 - normalGreen - black) / safeX)
+        yellow  = np.where(x == 0, 0, (1 - normalBlue - black)  / safeX)
+        return np.stack([cyan * 100, magenta * 100, yellow * 100, black * 100], axis=1)
+
+    # HSL or HSV, following the same piecewise formula as RGBtoHSVorHSL()
+    xMin = normal.min(axis=1)
+    chroma = xMax - xMin
+    value = xMax
+    lightness = (xMax + xMin) / 2
+
+    safeChroma = np.where(chroma == 0, 1, chroma)
+    hue = np.select(
+        [chroma == 0, value == normalRed, value == normalGreen],
+        [0.0, 60 * (((normalGreen - normalBlue) / safeChroma) % 6), 60 * (((normalBlue - normalRed) / safeChroma) + 2)],
+        60 * (((normalRed - normalGreen) / safeChroma) + 4))
+
+    if colorFormat == 'hsl' :
+        hasSaturation = (lightness != 0) & (lightness != 1)
+        divisor = np.where(hasSaturation, np.minimum(lightness, 1 - lightness), 1)
+        saturation = np.where(hasSaturation, (value - lightness) / divisor, 0.0)
+        return np.stack([hue, saturation * 100, lightness * 100], axis=1)
+    else : # convert to HSV
+        saturation = np.where(value != 0, chroma / np.where(value != 0, value, 1), 0.0)
+        return np.stack([hue, saturation * 100, value * 100], axis=1)
+
+# Vectorized CMYtoRGB(): takes an (N,3) array of floats, returns an (N,3) array of integers
+def batchCMYtoRGB(cmyValues) :
+    return batchSmartRound((1 - (cmyValues / 100)) * 255)
+
+# Vectorized CMYKtoRGB(): takes an (N,4) array of floats, returns an (N,3) array of integers
+def batchCMYKtoRGB(cmykValues) :
+    x = 1 - (cmykValues[:, 3:4] / 100)
+    return batchSmartRound(255 * (1 - (cmykValues[:, :3] / 100)) * x)
+
+# Vectorized HSLorHSVToRGB(): takes an (N,3) array, returns an (N,3) array of integers
+def batchHSLorHSVToRGB(values, convertFrom) :
+    np = loadNumpy()
+    normalSaturation = values[:, 1] / 100
+    normalLorV = values[:, 2] / 100
+
+    if convertFrom == 'hsl' :
+        chroma = (1 - np.abs((2 * normalLorV) - 1)) * normalSaturation
+        m = normalLorV - (chroma / 2)
+    else : # is HSV
+        chroma = normalLorV * normalSaturation
+        m = normalLorV - chroma
+
+    hPrime = values[:, 0] / 60
+    temp = (hPrime % 2) - 1
+    x = chroma * (1 - np.abs(temp))
+
+    # pick (R, G, B) out of (chroma, x, 0) by hue sector, where a hue of exactly 360 falls in the last sector
+    sector = np.minimum(np.floor(hPrime), 5).astype(np.int64)
+    zero = np.zeros_like(chroma)
+    candidates = np.stack([chroma, x, zero], axis=1)
+    order = np.array([[0, 1, 2], [1, 0, 2], [2, 0, 1], [2, 1, 0], [1, 2, 0], [0, 2, 1]])
+    picked = np.take_along_axis(candidates, order[sector], axis=1)
+    return batchSmartRound((picked + m[:, None]) * 255)
+
+# Vectorized HEXtoRGB(): takes a sequence of N hex strings, returns an (N,3) array of integers
+def batchHEXtoRGB(hexCodes) :
+    np = loadNumpy()
+    packed = np.array([int(hexCode, 16) for hexCode in hexCodes], dtype=np.int64).reshape(-1)
+    return np.stack([(packed >> 16) & 255, (packed >> 8) & 255, packed & 255], axis=1)
 
-    return extractedValues
+# Vectorized HSLtoHSV(): takes an (N,3) array, returns an (N,3) array of floats
+def batchHSLtoHSV(hslValues) :
+    np = loadNumpy()
+    normalSaturation = hslValues[:, 1] / 100
+    normalLightness = hslValues[:, 2] / 100
 
+    chroma = (1 - np.abs((2 * normalLightness) - 1)) * normalSaturation
+    value = normalLightness + (chroma / 2)
+    saturation = np.where(value != 0, chroma / np.where(value != 0, value, 1), 0.0)
+    hue = np.where(saturation == 0, 0.0, hslValues[:, 0] % 360)
+    return np.stack([hue, saturation * 100, value * 100], axis=1)
+
+# Vectorized HSVtoHSL(): takes an (N,3) array, returns an (N,3) array of floats
+def batchHSVtoHSL(hsvValues) :
+    np = loadNumpy()
+    normalSaturation = hsvValues[:, 1] / 100
+    normalValue = hsvValues[:, 2] / 100
+
+    chroma = normalValue * normalSaturation
+    lightness = normalValue - (chroma / 2)
+    hasSaturation = (lightness != 0) & (lightness != 1)
+    divisor = np.where(hasSaturation, np.minimum(lightness, 1 - lightness), 1)
+    saturation = np.where(hasSaturation, (normalValue - lightness) / divisor, 0.0)
+    hue = np.where(saturation == 0, 0.0, hsvValues[:, 0] % 360)
+    return np.stack([hue, saturation * 100, lightness * 100], axis=1)
+
+# Vectorized CMYtoCMYK(): takes an (N,3) array, returns an (N,4) array of floats
+def batchCMYtoCMYK(cmyValues) :
+    np = loadNumpy()
+    normal = cmyValues / 100
+    black = normal.min(axis=1)
+    x = 1 - black
+    # rows with x == 0 (pure black) are zeroed rather than divided
+    safeX = np.where(x == 0, 1, x)
+    converted = np.where((x == 0)[:, None], 0.0, ((normal - black[:, None]) / safeX[:, None]) * 100)
+    return np.concatenate([converted, (black * 100)[:, None]], axis=1)
+
+# Vectorized CMYKtoCMY(): takes an (N,4) array, returns an (N,3) array of floats
+def batchCMYKtoCMY(cmykValues) :
+    black = cmykValues[:, 3:4] / 100
+    return (((cmykValues[:, :3] / 100) * (1 - black)) + black) * 100
+
+# Applies a math module function to the elements of 1-D arrays (which it takes one argument from
+# each of), returns an array of floats. numpy's own pow(), arctan2() etc. can differ from the math
+# module's in the last bit, so this is what keeps the CIE conversions exactly equal to the scalar ones.
+def batchMath(function, *arrays) :
+    np = loadNumpy()
+    return np.fromiter(map(function, *[values.tolist() for values in arrays]), dtype=np.float64, count=len(arrays[0]))
+
+# Vectorized RGBtoXYZ(): takes an (N,3) array of integers, returns an (N,3) array of floats
+def batchRGBtoXYZ(rgbValues) :
+    global SRGB_TO_LINEAR_ARRAY
+    np = loadNumpy()
+    if SRGB_TO_LINEAR_ARRAY is None :
+        SRGB_TO_LINEAR_ARRAY = np.array(SRGB_TO_LINEAR)
+    linear = SRGB_TO_LINEAR_ARRAY[rgbValues]
+    red, green, blue = linear[:, 0], linear[:, 1], linear[:, 2]
+    return np.stack([((row[0] * red) + (row[1] * green) + (row[2] * blue)) * 100 for row in XYZ_MATRIX], axis=1)
+
+# Vectorized XYZtoRGB(): takes an (N,3) array of floats, returns an (N,3) array of integers
+def batchXYZtoRGB(xyzValues) :
+    np = loadNumpy()
+    normal = xyzValues / 100
+    x, y, z = normal[:, 0], normal[:, 1], normal[:, 2]
+    return np.stack([np.searchsorted(SRGB_THRESHOLDS, (row[0] * x) + (row[1] * y) + (row[2] * z), side='left')
+                     for row in RGB_MATRIX], axis=1).astype(np.int64)
+
+# Vectorized XYZtoLAB(): takes an (N,3) array of floats, returns an (N,3) array of floats
+def batchXYZtoLAB(xyzValues) :
+    np = loadNumpy()
+    f = xyzValues / np.array(D65_WHITE)
+    cube = f > LAB_DELTA_CUBED
+    f[~cube] = (f[~cube] / LAB_SLOPE) + LAB_OFFSET
+    f[cube] = batchMath(cubeRoot, f[cube])
+    a = 500 * (f[:, 0] - f[:, 1])
+    b = 200 * (f[:, 1] - f[:, 2])
+    return np.stack([(116 * f[:, 1]) - 16, np.where(np.abs(a) < LAB_EPSILON, 0.0, a), np.where(np.abs(b) < LAB_EPSILON, 0.0, b)], axis=1)
+
+# Vectorized LABtoXYZ(): takes an (N,3) array of floats, returns an (N,3) array of floats
+def batchLABtoXYZ(labValues) :
+    np = loadNumpy()
+    fy = (labValues[:, 0] + 16) / 116
+    f = np.stack([fy + (labValues[:, 1] / 500), fy, fy - (labValues[:, 2] / 200)], axis=1)
+    return np.where(f > LAB_DELTA, f * f * f, LAB_SLOPE * (f - LAB_OFFSET)) * np.array(D65_WHITE)
+
+# Vectorized LABtoLCH(): takes an (N,3) array of floats, returns an (N,3) array of floats
+def batchLABtoLCH(labValues) :
+    np = loadNumpy()
+    a = labValues[:, 1]
+    b = labValues[:, 2]
+    chroma = np.sqrt((a * a) + (b * b))
+    hue = batchMath(math.atan2, b, a) * (180 / math.pi)
+    hue = np.where(chroma == 0, 0.0, np.where(hue < 0, hue + 360, hue))
+    return np.stack([labValues[:, 0], chroma, hue], axis=1)
+
+# Vectorized LCHtoLAB(): takes an (N,3) array of floats, returns an (N,3) array of floats
+def batchLCHtoLAB(lchValues) :
+    np = loadNumpy()
+    hue = lchValues[:, 2] * (math.pi / 180)
+    a = lchValues[:, 1] * batchMath(math.cos, hue)
+    b = lchValues[:, 1] * batchMath(math.sin, hue)
+    return np.stack([lchValues[:, 0], np.where(np.abs(a) < LAB_EPSILON, 0.0, a), np.where(np.abs(b) < LAB_EPSILON, 0.0, b)], axis=1)
+
+# Vectorized smartRound(): takes an array of floats, returns an array of the nearest integers
+def batchSmartRound(values) :
+    np = loadNumpy()
+    return np.where((values % 1) > .50, np.ceil(values), np.floor(values)).astype(np.int64)
+
+
+'''
+# CONVERSION GRAPH
+'''
+
+# Conversions between formats are the edges of a graph: the original formats convert to and from RGB,
+# closely related formats (HSL <-> HSV, CMY <-> CMYK) also convert to each other directly, and the
+# CIE formats form a chain (RGB <-> XYZ <-> L*a*b* <-> LCh).
+# planConversions() picks a path to each requested format, preferring paths that don't round to RGB
+# integers on the way (which loses precision), then the fewest conversions, and computes anything
+# several paths go through only once. Each format's path only depends on the source format, so its
+# values are the same whatever other formats are output alongside it (RGB and Hex are the rounded
+# RGB color, the other formats don't pass through it unless they have to).
+
+# an edge of the graph: the scalar and vectorized (numpy) conversion functions, and whether the
+# conversion rounds (to RGB integers)
+ConversionEdge = collections.namedtuple('ConversionEdge', ['function', 'batchFunction', 'rounds'])
+# CONVERSION_EDGES[source format][target format] is a ConversionEdge
+CONVERSION_EDGES = {}
+# the plans planConversions() already made, by (source format, output formats)
+CONVERSION_PLANS = {}
+
+# Adds (or replaces) the edge from one format to another
+def registerConversion(source, target, function, batchFunction, rounds = False) :
+    CONVERSION_EDGES.setdefault(source, {})[target] = ConversionEdge(function, batchFunction, rounds)
+    CONVERSION_PLANS.clear()
 
-# formats and delivers color values to STDOUT or a specified output file
 # ARGS
-# convertedValues: a map of the results from the color translations that were performed on a single color value, 
-#                  where the key indicates the format and the value is a list of raw numeric values
-def printConversions(convertedValues) :    
-    output = []
-    if VERBOSE : 
-        output.append(convertedValues['verbose-msg'])
-    
-    # format converted values into better output strings
-    for colorFormat in TYPES :
-        if convertedValues.get(colorFormat, None) is None :
+# sourceFormat: the format to convert from
+# outputFormats: the formats to convert to
+# RETURNS
+# a list of (source format, target format, ConversionEdge) steps, in an order where the source of
+# each step is either sourceFormat or the target of an earlier step
+def planConversions(sourceFormat, outputFormats) :
+    key = (sourceFormat, tuple(outputFormats))
+    plan = CONVERSION_PLANS.get(key)
+    if plan is not None :
+        return plan
+
+    # cheapest (number of rounding conversions, number of conversions) to reach each format
+    best = {sourceFormat : ((0, 0), None)}
+    frontier = [((0, 0), sourceFormat)]
+    while frontier :
+        cost, colorFormat = heapq.heappop(frontier)
+        if cost > best[colorFormat][0] :
             continue
-        elif colorFormat == 'hex' :
-            hexCode = '#' + convertedValues['hex']
-            output.append(hexCode) 
-        else :
-            # format strings for xyz(a,b,c) type formats
-            colorCode = colorFormat + '('
-            numValues = len(convertedValues[colorFormat])
-            for valueIndex in range(numValues) :
-                value = convertedValues[colorFormat][valueIndex]
-                if type(value) == float :
-                    value = f"{value:.2f}"
-                if valueIndex == numValues - 1 :
-                    colorCode += str(value) + ')'
-                else :
-                    colorCode += str(value) + ', '
-            output.append(colorCode)
-    
-    # deliver formatted output
-    if OUTPUT_DESTINATION != 'stdout' :
-        
-        ''' 
-        TODO FOR EFFICIENCY:
-
-        right now, unless i'm mistaken and there's some hidden python optimization going on, this is 
-        going to open and close the file to write the conversions of each inputted color code.
-        if there's a huge file being used as input, this may get slow, so perhaps the best move is
-        to actually open the file back in main() at the point when we evaluate args, and then close
-        it after everything in main() has ran... food for thought.
-        '''
-        with open(OUTPUT_DESTINATION, 'a', encoding='utf-8') as file :
-            for color in output :
-                file.write(color + '\n')
-            file.write('\n')
-    else :
-        for color in output :
-            print(color)
-        print()
+        for target, edge in CONVERSION_EDGES.get(colorFormat, {}).items() :
+            targetCost = (cost[0] + edge.rounds, cost[1] + 1)
+            if (target not in best) or (targetCost < best[target][0]) :
+                best[target] = (targetCost, colorFormat)
+                heapq.heappush(frontier, (targetCost, target))
+
+    plan = []
+    planned = {sourceFormat}
+    for colorFormat in outputFormats :
+        if colorFormat not in best :
+            raise ColorFormatError(f'No conversion from {sourceFormat} to {colorFormat}')
+        path = []
+        while colorFormat not in planned :
+            previous = best[colorFormat][1]
+            path.append((previous, colorFormat, CONVERSION_EDGES[previous][colorFormat]))
+            planned.add(colorFormat)
+            colorFormat = previous
+        plan.extend(reversed(path))
+
+    CONVERSION_PLANS[key] = plan
+    return plan
+
+# Converts validated values to the given formats, following planConversions()
+# RETURNS
+# a map of each requested format (and any format converted through on the way) to its values
+def convertValues(sourceFormat, values, outputFormats) :
+    converted = {sourceFormat : values}
+    for source, target, edge in planConversions(sourceFormat, outputFormats) :
+        converted[target] = edge.function(converted[source])
+    return converted
+
+registerConversion('hex',  'rgb',  HEXtoRGB,  batchHEXtoRGB)
+registerConversion('rgb',  'hex',  RGBtoHEX,  lambda rgbValues : batchRgbTo('hex', rgbValues))
+registerConversion('rgb',  'cmy',  RGBtoCMY,  lambda rgbValues : batchRgbTo('cmy', rgbValues))
+registerConversion('rgb',  'cmyk', RGBtoCMYK, lambda rgbValues : batchRgbTo('cmyk', rgbValues))
+registerConversion('rgb',  'hsl',  lambda rgbValues : RGBtoHSVorHSL(rgbValues, 'hsl'), lambda rgbValues : batchRgbTo('hsl', rgbValues))
+registerConversion('rgb',  'hsv',  lambda rgbValues : RGBtoHSVorHSL(rgbValues, 'hsv'), lambda rgbValues : batchRgbTo('hsv', rgbValues))
+registerConversion('cmy',  'rgb',  CMYtoRGB,  batchCMYtoRGB, rounds=True)
+registerConversion('cmyk', 'rgb',  CMYKtoRGB, batchCMYKtoRGB, rounds=True)
+registerConversion('hsl',  'rgb',  lambda hslValues : HSLorHSVToRGB(hslValues, 'hsl'), lambda hslValues : batchHSLorHSVToRGB(hslValues, 'hsl'), rounds=True)
+registerConversion('hsv',  'rgb',  lambda hsvValues : HSLorHSVToRGB(hsvValues, 'hsv'), lambda hsvValues : batchHSLorHSVToRGB(hsvValues, 'hsv'), rounds=True)
+registerConversion('hsl',  'hsv',  HSLtoHSV,  batchHSLtoHSV)
+registerConversion('hsv',  'hsl',  HSVtoHSL,  batchHSVtoHSL)
+registerConversion('cmy',  'cmyk', CMYtoCMYK, batchCMYtoCMYK)
+registerConversion('cmyk', 'cmy',  CMYKtoCMY, batchCMYKtoCMY)
+registerConversion('rgb',  'xyz',  RGBtoXYZ,  batchRGBtoXYZ)
+registerConversion('xyz',  'rgb',  XYZtoRGB,  batchXYZtoRGB, rounds=True)
+registerConversion('xyz',  'lab',  XYZtoLAB,  batchXYZtoLAB)
+registerConversion('lab',  'xyz',  LABtoXYZ,  batchLABtoXYZ)
+registerConversion('lab',  'lch',  LABtoLCH,  batchLABtoLCH)
+registerConversion('lch',  'lab',  LCHtoLAB,  batchLCHtoLAB)
+
+
+'''
+# LOOKUP TABLES
+'''
+
+# RGB only has 2^24 possible values, so every RGB -> X conversion can be precomputed into an on-disk
+# table with one fixed-size record per color. Tables are memory-mapped read only, so any number of
+# processes using the same table share a single copy of it through the OS page cache.
+#
+# Each file starts with a header (see LUT_HEADER) followed by the records in RGB order. Numeric
+# records store each value as an unsigned 16-bit integer in hundredths, which is exactly what
+# printConversions() displays. Hex records store the 6 hex characters.
+
+LUT_VERSION = 1
+LUT_MAGIC = b'CCLUT\0\0\0'
+LUT_ENTRIES = 1 << 24
+LUT_DECIMALS = 2
+LUT_TYPES = ['hex', 'cmy', 'cmyk', 'hsl', 'hsv']
+# magic, version, format, decimals, number of entries, probe checksum
+LUT_HEADER = struct.Struct('<8sH8sHII')
+# a fixed spread of colors whose records are compared against freshly converted values when a
+# table is opened, so tables built by a different version of the conversion code are rejected
+LUT_PROBES = list(range(0, LUT_ENTRIES, 4099)) + [LUT_ENTRIES - 1]
+
+# maps formats to their opened table (see openLookupTable()), filled in by loadLookupTables()
+LOOKUP_TABLES = {}
+# every table opened so far, by directory and format, so they're only opened (and checked) once per
+# process (a --serve worker keeps them between requests)
+OPENED_LOOKUP_TABLES = {}
+
+# Returns the file name of the table for conversions from RGB to the given format
+def lookupTablePath(directory, colorFormat) :
+    return os.path.join(directory, f'rgb-to-{colorFormat}.lut')
+
+# Returns the struct used to pack a single record of the given format
+def lookupRecord(colorFormat) :
+    if colorFormat == 'hex' :
+        return struct.Struct('<6s')
+    if colorFormat == 'cmyk' :
+        return struct.Struct('<4H')
+    return struct.Struct('<3H')
+
+# Takes in the converted values for a single color, returns them as they're stored in a table record
+def encodeLookupValues(colorFormat, values) :
+    if colorFormat == 'hex' :
+        return (values.encode('ascii'),)
+    return tuple(int(f'{value:.2f}'.replace('.', '')) for value in values)
+
+# Returns the checksum of the probe records of a table, as computed by the current conversion code
+def lookupProbeChecksum(colorFormat) :
+    record = lookupRecord(colorFormat)
+    checksum = 0
+    for index in LUT_PROBES :
+        rgbValues = [index >> 16, (index >> 8) & 255, index & 255]
+        encoded = record.pack(*encodeLookupValues(colorFormat, rgbTo(colorFormat, rgbValues)))
+        checksum = zlib.crc32(encoded, checksum)
+    return checksum
+
+# Builds the table for conversions from RGB to the given format and writes it to directory
+# (uses the batch conversion engine if numpy is available, which is much faster)
+def buildLookupTable(directory, colorFormat) :
+    record = lookupRecord(colorFormat)
+    np = loadNumpy()
+    os.makedirs(directory, exist_ok=True)
+    path = lookupTablePath(directory, colorFormat)
+
+    # write to a temporary file first so readers never map a half-written table
+    with open(path + '.tmp', 'wb') as file :
+        file.write(LUT_HEADER.pack(LUT_MAGIC, LUT_VERSION, colorFormat.encode('ascii'), LUT_DECIMALS, LUT_ENTRIES, lookupProbeChecksum(colorFormat)))
+        chunkSize = 1 << 18
+        for start in range(0, LUT_ENTRIES, chunkSize) :
+            if np :
+                file.write(encodeLookupChunk(colorFormat, start, chunkSize))
+            else :
+                for index in range(start, start + chunkSize) :
+                    rgbValues = [index >> 16, (index >> 8) & 255, index & 255]
+                    file.write(record.pack(*encodeLookupValues(colorFormat, rgbTo(colorFormat, rgbValues))))
+    os.replace(path + '.tmp', path)
+    return path
+
+# Vectorized encodeLookupValues() for the records of a contiguous range of RGB values
+def encodeLookupChunk(colorFormat, start, count) :
+    np = loadNumpy()
+    indexes = np.arange(start, start + count, dtype=np.int64)
+    rgbValues = np.stack([indexes >> 16, (indexes >> 8) & 255, indexes & 255], axis=1)
+    converted = batchRgbTo(colorFormat, rgbValues)
+    if colorFormat == 'hex' :
+        return converted.astype('S6').tobytes()
+
+    # round to hundredths the way string formatting does, settling near-ties with the formatter itself
+    scaled = converted * 100
+    hundredths = np.rint(scaled)
+    nearTie = np.abs(scaled - np.floor(scaled) - .5) < 1e-6
+    for row, column in zip(*np.nonzero(nearTie)) :
+        hundredths[row, column] = int(f'{converted[row, column]:.2f}'.replace('.', ''))
+    return hundredths.astype('<u2').tobytes()
+
+# Opens and validates the table for the given format
+# ARGS
+# warn: print a warning when the table is stale (worker processes leave that to the main process)
+# RETURNS
+# the opened table as a map, or None if the table is missing or stale
+def openLookupTable(directory, colorFormat, warn = True) :
+    path = lookupTablePath(directory, colorFormat)
+    record = lookupRecord(colorFormat)
+    try :
+        with open(path, 'rb') as file :
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) :
+        return None
+
+    table = {'map': mapped, 'record': record, 'format': colorFormat}
+    if len(mapped) != LUT_HEADER.size + (LUT_ENTRIES * record.size) :
+        if warn :
+            print(f'WARNING: Ignoring lookup table "{path}" (wrong size), rebuild it with --build-lut', file=sys.stderr)
+        return None
+    magic, version, storedFormat, decimals, entries, checksum = LUT_HEADER.unpack_from(mapped, 0)
+    if (magic != LUT_MAGIC) or (version != LUT_VERSION) or (storedFormat.rstrip(b'\0') != colorFormat.encode('ascii')) \
+            or (decimals != LUT_DECIMALS) or (entries != LUT_ENTRIES) :
+        if warn :
+            print(f'WARNING: Ignoring lookup table "{path}" (incompatible header), rebuild it with --build-lut', file=sys.stderr)
+        return None
+
+    # the stored records must match both the header and what the current code computes
+    expected = lookupProbeChecksum(colorFormat)
+    stored = 0
+    for index in LUT_PROBES :
+        stored = zlib.crc32(mapped[LUT_HEADER.size + (index * record.size) : LUT_HEADER.size + ((index + 1) * record.size)], stored)
+    if (checksum != expected) or (stored != expected) :
+        if warn :
+            print(f'WARNING: Ignoring lookup table "{path}" (stale checksum), rebuild it with --build-lut', file=sys.stderr)
+        return None
+
+    return table
+
+# Opens the tables of every requested format found in directory, formats without a usable table
+# keep being computed (warn: see openLookupTable())
+def loadLookupTables(directory, outputFormats, warn = True) :
+    for colorFormat in outputFormats :
+        if colorFormat in LUT_TYPES :
+            key = (os.path.abspath(directory), colorFormat)
+            table = OPENED_LOOKUP_TABLES.get(key) or openLookupTable(directory, colorFormat, warn)
+            if table is not None :
+                OPENED_LOOKUP_TABLES[key] = table
+                LOOKUP_TABLES[colorFormat] = table
+
+# lookupRgbTo() is a drop-in replacement for rgbTo() that answers from a lookup table when one is loaded
+# ARGS
+# colorFormat: a string containing a color format to convert to
+# rgbValues: the rgbValues to convert
+# RETURNS
+# the converted color values in the specified format
+def lookupRgbTo(colorFormat, rgbValues) :
+    table = LOOKUP_TABLES.get(colorFormat)
+    if table is None :
+        return rgbTo(colorFormat, rgbValues)
+
+    red, green, blue = rgbValues
+    index = (red << 16) | (green << 8) | blue
+    record = table['record']
+    values = record.unpack_from(table['map'], LUT_HEADER.size + (index * record.size))
+    if colorFormat == 'hex' :
+        return values[0].decode('ascii')
+
+    # the conversion functions return plain ints for black (CMYK) and grays (hue)
+    if (colorFormat == 'cmyk') and (index == 0) :
+        return [0, 0, 0, values[3] / 100]
+    converted = [value / 100 for value in values]
+    if (colorFormat in ('hsl', 'hsv')) and (red == green == blue) :
+        converted[0] = 0
+    return converted
+
+
+'''
+# CONVERSION CACHE
+'''
+
+# Real inputs tend to repeat the same colors over and over, so the bulk pipeline remembers the
+# formatted output (or error) of recently seen color codes and reuses it for repeats.
+
+# default number of color codes the cache remembers
+CACHE_SIZE = 50000
+
+# A size-limited map that evicts the least recently used entry when full, and counts its hits,
+# misses and evictions
+class ConversionCache :
+    def __init__(self, maxSize = CACHE_SIZE) :
+        self.maxSize = maxSize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Returns the value stored for key (marking it as recently used), or None
+    def get(self, key) :
+        value = self.entries.get(key)
+        if value is None :
+            self.misses += 1
+        else :
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    # Stores value for key, evicting the least recently used entry if the cache is full
+    def put(self, key, value) :
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxSize :
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    # Returns the counters as a tuple of (hits, misses, evictions)
+    def counts(self) :
+        return self.hits, self.misses, self.evictions
+
+    # Adds counters collected elsewhere (e.g. by a worker process) to this cache's counters
+    def addCounts(self, counts) :
+        self.hits += counts[0]
+        self.misses += counts[1]
+        self.evictions += counts[2]
+
+    # Returns a one-line summary of the counters
+    def report(self) :
+        lookups = self.hits + self.misses
+        hitRate = (100 * self.hits / lookups) if lookups else 0.0
+        return f'CACHE: {self.hits} hits, {self.misses} misses ({hitRate:.2f}% hit rate), {self.evictions} evictions, {len(self.entries)}/{self.maxSize} entries'
+
+# the cache used by the bulk pipeline, or None when caching is turned off
+CONVERSION_CACHE = ConversionCache()
+
+
+'''
+# PERSISTENT CACHE
+'''
+
+# With --cache-dir, the output of input files is also kept in an SQLite database in that directory,
+# so converting the same files again (e.g. on every build) reuses it instead of converting them.
+# Files are split into chunks of lines at content-defined boundaries (after a line whose CRC-32 has
+# its low bits clear), so changing a few lines only changes the chunks around them, and the other
+# chunks of a changed file are still reused. Each file (by its hash) remembers its list of chunks, so
+# an unchanged file is only hashed, with no splitting or parsing at all.
+#
+# Entries are keyed by the hash of the contents along with everything that affects the output: the
+# version and source of this script, the override, output formats, output settings and palette
+# (see handleBulk()). A chunk keeps its formatted output, and its errors apart from it (with where
+# they came in the output, and line numbers relative to the chunk), so replaying it gives exactly the
+# output and errors of converting it, wherever the chunk is in the file. Chunks
+# are converted on their own, so their memory use is bounded however big the file is. The least
+# recently used chunks are evicted once the database gets bigger than --cache-dir-size.
+
+# default size limit of the persistent cache in megabytes
+PERSISTENT_CACHE_SIZE = 512
+PERSISTENT_CACHE_FILE = 'color-converter-cache.sqlite3'
+# a chunk ends after a line whose CRC-32 has none of these bits set (~1024 lines on average), or
+# after PERSISTENT_CHUNK_LINES lines
+PERSISTENT_CHUNK_MASK = 0x3ff
+PERSISTENT_CHUNK_LINES = 16384
+PERSISTENT_KEY_SIZE = 16
+# the layout of the tables, databases with another one get emptied
+PERSISTENT_CACHE_SCHEMA = 2
+
+# The cache database and its hit/miss counters. Errors accessing the database are reported once and
+# then turn the cache off, as it's only there to save time.
+class PersistentCache :
+    # ARGS
+    # directory: the directory to keep the database in (created if needed)
+    # maxBytes: how big the cached output can get before the least recently used chunks are evicted
+    # RAISES
+    # OSError or sqlite3.Error if the database can't be opened
+    def __init__(self, directory, maxBytes) :
+        # only needed for --cache-dir
+        import sqlite3
+        self.sqlite3 = sqlite3
+        self.maxBytes = maxBytes
+        os.makedirs(directory, exist_ok=True)
+        self.database = sqlite3.connect(os.path.join(directory, PERSISTENT_CACHE_FILE), timeout=30)
+        # (auto_vacuum only takes effect on a new database, which then shrinks after evictions)
+        self.database.executescript('''
+            PRAGMA auto_vacuum = INCREMENTAL;
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+        ''')
+        if self.database.execute('PRAGMA user_version').fetchone()[0] != PERSISTENT_CACHE_SCHEMA :
+            self.database.executescript(f'''
+                DROP TABLE IF EXISTS files;
+                DROP TABLE IF EXISTS chunks;
+                PRAGMA user_version = {PERSISTENT_CACHE_SCHEMA};
+            ''')
+        self.database.executescript('''
+            CREATE TABLE IF NOT EXISTS files (key BLOB PRIMARY KEY, chunks TEXT NOT NULL, used REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS chunks (key BLOB PRIMARY KEY, output TEXT NOT NULL, errors TEXT NOT NULL,
+                                               lines INTEGER NOT NULL, colors INTEGER NOT NULL,
+                                               size INTEGER NOT NULL, used REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS chunks_used ON chunks (used);
+        ''')
+        with open(__file__, 'rb') as file :
+            self.version = f'{VERSION}:{zlib.crc32(file.read()):08x}'
+        self.used = set()
+        self.fileHits = self.fileMisses = self.chunkHits = self.chunkMisses = 0
+
+    # Deletes the cache database in directory, if there's one
+    @staticmethod
+    def clear(directory) :
+        for suffix in ('', '-wal', '-shm') :
+            try :
+                os.remove(os.path.join(directory, PERSISTENT_CACHE_FILE + suffix))
+            except FileNotFoundError :
+                pass
+
+    # Returns the list of [chunk key (hex), byte length] of the file with the given key, or None
+    def getFile(self, key) :
+        import json
+        row = self.query('SELECT chunks FROM files WHERE key = ?', key)
+        if row is None :
+            self.fileMisses += 1
+            return None
+        self.fileHits += 1
+        self.used.add(('files', key))
+        return json.loads(row[0])
+
+    def putFile(self, key, chunks) :
+        import json
+        self.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', key, json.dumps(chunks), time.time())
+
+    # Returns the entry of the chunk with the given key (see convertCachedChunk()), or None
+    def getChunk(self, key) :
+        import json
+        row = self.query('SELECT output, errors, lines, colors FROM chunks WHERE key = ?', key)
+        if row is None :
+            self.chunkMisses += 1
+            return None
+        self.chunkHits += 1
+        self.used.add(('chunks', key))
+        return {'output': row[0], 'errors': json.loads(row[1]), 'lines': row[2], 'colors': row[3]}
+
+    def putChunk(self, key, entry) :
+        import json
+        errors = json.dumps(entry['errors'])
+        self.execute('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?)', key, entry['output'], errors,
+                     entry['lines'], entry['colors'], len(entry['output']) + len(errors), time.time())
+
+    # Returns the first row of a query, or None
+    def query(self, sql, *parameters) :
+        if self.database is None :
+            return None
+        try :
+            return self.database.execute(sql, parameters).fetchone()
+        except self.sqlite3.Error as error :
+            self.fail(error)
+            return None
+
+    def execute(self, sql, *parameters) :
+        if self.database is None :
+            return
+        try :
+            self.database.execute(sql, parameters)
+        except self.sqlite3.Error as error :
+            self.fail(error)
+
+    # Reports an error accessing the database, and stops using it
+    def fail(self, error) :
+        print(f'WARNING: Not using the persistent cache anymore ({error})', file=sys.stderr)
+        self.database.close()
+        self.database = None
+
+    # Marks the entries used in this run as recently used, evicts the least recently used chunks (and
+    # the files that have lost chunks) if it's too big, and saves everything
+    def close(self) :
+        if self.database is None :
+            return
+        try :
+            now = time.time()
+            for table, key in self.used :
+                self.database.execute(f'UPDATE {table} SET used = ? WHERE key = ?', (now, key))
+            size = self.database.execute('SELECT COALESCE(SUM(size), 0) FROM chunks').fetchone()[0]
+            if size > self.maxBytes :
+                # evict down to 90% of the limit, so it doesn't evict again on the next run
+                excess = size - (self.maxBytes * 0.9)
+                cutoff = None
+                for used, chunkSize in self.database.execute('SELECT used, size FROM chunks ORDER BY used') :
+                    excess -= chunkSize
+                    cutoff = used
+                    if excess <= 0 :
+                        break
+                self.database.execute('DELETE FROM chunks WHERE used <= ?', (cutoff,))
+                self.database.execute('DELETE FROM files WHERE used <= ?', (cutoff,))
+                self.database.commit()
+                # (executescript() runs it to the end, execute() would only free one page)
+                self.database.executescript('PRAGMA incremental_vacuum;')
+            self.database.commit()
+            self.database.close()
+        except self.sqlite3.Error as error :
+            print(f'WARNING: Could not save the persistent cache ({error})', file=sys.stderr)
+        self.database = None
+
+    # Returns a one-line summary of the counters
+    def report(self) :
+        return f'PERSISTENT CACHE: {self.fileHits} files reused, {self.fileMisses} converted; {self.chunkHits} chunks reused, {self.chunkMisses} converted'
+
+# the persistent cache of --cache-dir, or None
+PERSISTENT_CACHE = None
+
+# Handles an input file through PERSISTENT_CACHE: each chunk of it is replayed from the cache, or
+# converted (and cached) if it isn't there
+# ARGS
+# file: the input file, opened in binary mode
+# override: string indicating the format of every color code, or None to detect each one
+# outputFormats: list indicating which conversions to perform
+# RETURNS
+# the number of color codes in the file
+def handleCachedFile(file, override, outputFormats) :
+    # only needed for --cache-dir
+    import hashlib
+    sink = outputSink()
+    # the same settings that make up the key of CONVERSION_CACHE, along with this version of the
+    # script, key the hashes of the contents
+    settings = repr((PERSISTENT_CACHE.version, override, tuple(outputFormats), VERBOSE, sink.cacheKey,
+                     PALETTE_INDEX.key if PALETTE_INDEX is not None else None)).encode('utf-8')
+    settingsKey = hashlib.blake2b(settings, digest_size=32).digest()
+    hashKey = lambda data : hashlib.blake2b(data, digest_size=PERSISTENT_KEY_SIZE, key=settingsKey).digest()
+
+    fileHash = hashlib.blake2b(digest_size=PERSISTENT_KEY_SIZE, key=settingsKey)
+    for block in iter(lambda : file.read(OUTPUT_BUFFER_SIZE), b'') :
+        fileHash.update(block)
+    fileKey = fileHash.digest()
+    known = PERSISTENT_CACHE.getFile(fileKey)
+
+    # an unchanged file's chunks are known, and only read if they have to be converted again
+    file.seek(0)
+    if known is not None :
+        chunks = ((bytes.fromhex(key), length) for key, length in known)
+    else :
+        chunks = ((hashKey(data), data) for data in splitChunks(file))
+
+    firstLine = 1
+    offset = 0
+    colorCodes = 0
+    manifest = []
+    for key, data in chunks :
+        length = data if known is not None else len(data)
+        entry = PERSISTENT_CACHE.getChunk(key)
+        if entry is None :
+            if known is not None :
+                file.seek(offset)
+                data = file.read(length)
+            entry = convertCachedChunk(data, override, outputFormats)
+            PERSISTENT_CACHE.putChunk(key, entry)
+        elif RUN_STATS is not None :
+            RUN_STATS.counts['lines'] += entry['colors']
+        replayChunk(entry, firstLine)
+        manifest.append([key.hex(), length])
+        offset += length
+        firstLine += entry['lines']
+        colorCodes += entry['colors']
+
+    if known is None :
+        PERSISTENT_CACHE.putFile(fileKey, manifest)
+    return colorCodes
+
+# Yields the chunks of an open binary file, see PERSISTENT CACHE
+def splitChunks(file) :
+    chunk = []
+    for line in file :
+        chunk.append(line)
+        if ((zlib.crc32(line) & PERSISTENT_CHUNK_MASK) == 0) or (len(chunk) >= PERSISTENT_CHUNK_LINES) :
+            yield b''.join(chunk)
+            chunk = []
+    if chunk :
+        yield b''.join(chunk)
+
+# Converts a chunk of a file on its own (with line numbers starting at 1)
+# RETURNS
+# the chunk's entry: a map of its formatted output, its errors (see RecordingChannel, with line
+# numbers relative to the chunk), its number of lines and of color codes
+def convertCachedChunk(data, override, outputFormats) :
+    global OUTPUT_SINK, ERROR_CHANNEL
+    sink = outputSink()
+    channel = errorChannel()
+    lines = io.StringIO(data.decode('utf-8'), newline=None).readlines()
+    colorCodes = list(readColorCodes(lines))
+    # (formatted like the sink would, without its header or footer)
+    OUTPUT_SINK = OutputSink(io.StringIO(), False, sink.outputFormat, sink.outputFormats, sink.precision)
+    ERROR_CHANNEL = RecordingChannel(OUTPUT_SINK.file)
+    try :
+        handleBulk(colorCodes, override, outputFormats)
+        return {'output': OUTPUT_SINK.file.getvalue(), 'errors': ERROR_CHANNEL.records,
+                'lines': len(lines), 'colors': len(colorCodes)}
+    finally :
+        OUTPUT_SINK = sink
+        ERROR_CHANNEL = channel
+
+# Writes a chunk's output and errors, as if it had just been converted
+# ARGS
+# entry: the chunk's entry, see convertCachedChunk()
+# firstLine: the line number of the chunk's first line in the file
+def replayChunk(entry, firstLine) :
+    replayOutput(entry['output'], entry['errors'], firstLine - 1)
+
+'''
+# RUN STATISTICS
+'''
+
+# With --stats (or --stats-json), the bulk pipeline records the wall time spent in each stage and
+# counts what it processed. Nothing is timed unless stats are being recorded, and then per-line steps
+# only cost a clock read each (chunked steps are timed per chunk).
+
+# stages of the pipeline, in order (see handleBulk())
+STAT_STAGES = ['read', 'cache', 'detect', 'validate', 'convert', 'format', 'write']
+
+class RunStats :
+    def __init__(self) :
+        # seconds spent per stage
+        self.times = collections.Counter()
+        # lines read, converted per source format, answered from the cache, invalid per error type,
+        # and Hex/RGB conversions answered by the lookup tables or computed
+        self.counts = collections.Counter()
+
+    # Adds times and counts collected elsewhere (e.g. by a worker process)
+    def merge(self, times, counts) :
+        self.times.update(times)
+        self.counts.update(counts)
+
+    # ARGS
+    # wall: the wall time of the whole run, in seconds
+    # cacheCounts: (hits, misses, evictions) of the conversion cache during the run, or None
+    # RETURNS
+    # the statistics as a map (the --stats-json format)
+    def summary(self, wall, cacheCounts = None) :
+        summary = {'wall': wall, 'lines': self.counts['lines'],
+                   'stages': {stage : self.times[stage] for stage in STAT_STAGES},
+                   'converted': {colorFormat : self.counts['converted.' + colorFormat] for colorFormat in TYPES},
+                   'cached': self.counts['cached'],
+                   'invalid': {name[len('invalid.'):] : count for name, count in sorted(self.counts.items()) if name.startswith('invalid.')},
+                   'undetected': self.counts['undetected']}
+        if cacheCounts is not None :
+            summary['cache'] = dict(zip(['hits', 'misses', 'evictions'], cacheCounts))
+        if self.counts['lut.lookups'] or self.counts['lut.computed'] :
+            summary['lut'] = {'lookups': self.counts['lut.lookups'], 'computed': self.counts['lut.computed']}
+        return summary
+
+    # Returns the summary as a table (the --stats format)
+    def report(self, wall, cacheCounts = None) :
+        summary = self.summary(wall, cacheCounts)
+        rate = summary['lines'] / wall if wall else 0.0
+        lines = [f'STATS: {summary["lines"]} lines in {wall:.3f}s ({rate:,.0f} lines/s)',
+                 f'  {"stage":<10} {"seconds":>10} {"share":>7}']
+        # time that isn't in any stage (startup, the pipeline itself, ...)
+        other = wall - sum(summary['stages'].values())
+        for stage, seconds in list(summary['stages'].items()) + [('other', other)] :
+            share = (100 * seconds / wall) if wall else 0.0
+            lines.append(f'  {stage:<10} {seconds:>10.4f} {share:>6.1f}%')
+        lines.append('  converted: ' + ', '.join([f'{colorFormat} {count}' for colorFormat, count in summary['converted'].items()]))
+        lines.append(f'  cached: {summary["cached"]}, undetected: {summary["undetected"]}, invalid: ' +
+                     (', '.join([f'{name} {count}' for name, count in summary['invalid'].items()]) or '0'))
+        if 'cache' in summary :
+            hits, misses = summary['cache']['hits'], summary['cache']['misses']
+            hitRate = (100 * hits / (hits + misses)) if (hits + misses) else 0.0
+            lines.append(f'  cache: {hits} hits, {misses} misses ({hitRate:.2f}% hit rate), {summary["cache"]["evictions"]} evictions')
+        if 'lut' in summary :
+            lookups, computed = summary['lut']['lookups'], summary['lut']['computed']
+            lines.append(f'  lookup tables: {lookups} lookups, {computed} computed ({100 * lookups / (lookups + computed):.2f}% from tables)')
+        return '\n'.join(lines)
+
+# the statistics of the current run, or None when they aren't being recorded
+RUN_STATS = None
+
+# Returns function, wrapped to add the time spent in it to a stage when stats are being recorded
+def stageFunction(function, stage) :
+    if RUN_STATS is None :
+        return function
+    times = RUN_STATS.times
+    perfCounter = time.perf_counter
+
+    def timedFunction(*args) :
+        start = perfCounter()
+        try :
+            return function(*args)
+        finally :
+            times[stage] += perfCounter() - start
+    return timedFunction
+
+# Yields the color codes of an iterable, reading them in chunks to record the time spent reading
+# (and how many there were) without timing every line
+def timedRead(colorCodes, chunkSize) :
+    colorCodes = iter(colorCodes)
+    while True :
+        started = time.perf_counter()
+        chunk = list(itertools.islice(colorCodes, chunkSize))
+        RUN_STATS.times['read'] += time.perf_counter() - started
+        RUN_STATS.counts['lines'] += len(chunk)
+        if not chunk :
+            return
+        yield from chunk
+
+# Counts a color code that failed validation
+def countInvalid(error) :
+    if RUN_STATS is not None :
+        RUN_STATS.counts['invalid.' + type(error).__name__] += 1
+
+# Counts converted colors of a format, and how many of their conversions the lookup tables answered
+def countConverted(colorFormat, count, outputFormats) :
+    RUN_STATS.counts['converted.' + colorFormat] += count
+    if (colorFormat in ('hex', 'rgb')) and LOOKUP_TABLES :
+        for target in outputFormats :
+            if (target != colorFormat) and (target != 'rgb') :
+                RUN_STATS.counts['lut.lookups' if target in LOOKUP_TABLES else 'lut.computed'] += count
+
+# Runs function(*args) under cProfile, saving the profile to path (e.g. for `python -m pstats path`)
+def profileCall(path, function, *args) :
+    # only needed for --profile
+    import cProfile
+    profiler = cProfile.Profile()
+    try :
+        return profiler.runcall(function, *args)
+    finally :
+        profiler.dump_stats(path)
+
+
+'''
+# PARALLEL CONVERSION
+'''
+
+# Input files are split into byte ranges that end on line boundaries, which are converted by a pool
+# of worker processes and written out in their original order, so the output is identical to
+# converting the file in a single process.
+
+# approximate size (in bytes) of the input handed to a worker at a time
+PARALLEL_CHUNK_SIZE = 1 << 22
+# settings a worker process needs to produce the same output as the main process, see initConversionWorker()
+WORKER_OPTIONS = None
+
+# Handles an input file with a pool of worker processes
+# ARGS
+# path: name of the input file
+# override: string indicating the format of every color code, or None to detect each one
+# outputFormats: list indicating which conversions to perform
+# jobs: number of worker processes
+# options: map of the settings the workers need (see initConversionWorker())
+def handleParallel(path, override, outputFormats, jobs, options) :
+    # only needed for --jobs
+    import concurrent.futures
+    options = dict(options, override=override, outputFormats=outputFormats)
+    tasks = iter(findFileChunks(path, PARALLEL_CHUNK_SIZE))
+    # forked workers inherit unflushed buffers, which would otherwise get written out twice
+    OUTPUT_SINK.file.flush()
+    sys.stdout.flush()
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=initConversionWorker, initargs=(options,)) as executor :
+        # keep a bounded number of chunks in flight so memory doesn't grow with the file
+        inFlight = collections.deque()
+        for task in itertools.islice(tasks, jobs * 2) :
+            inFlight.append(executor.submit(convertFileChunk, path, task))
+
+        try :
+            while inFlight :
+                output, errors, cacheCounts, stats = inFlight.popleft().result()
+                if CONVERSION_CACHE is not None :
+                    CONVERSION_CACHE.addCounts(cacheCounts)
+                if stats is not None :
+                    RUN_STATS.merge(*stats)
+                replayOutput(output, errors)
+                for task in itertools.islice(tasks, 1) :
+                    inFlight.append(executor.submit(convertFileChunk, path, task))
+        finally :
+            # (when stopped by --max-errors)
+            for future in inFlight :
+                future.cancel()
+
+# Splits a file into byte ranges of roughly chunkSize bytes that start and end on line boundaries
+# RETURNS
+# a list of (start offset, end offset, line number of the first line) tuples
+def findFileChunks(path, chunkSize) :
+    chunks = []
+    with open(path, 'rb') as file :
+        size = os.fstat(file.fileno()).st_size
+        start = 0
+        firstLine = 1
+        while start < size :
+            file.seek(min(start + chunkSize, size))
+            file.readline()
+            end = min(file.tell(), size)
+            chunks.append((start, end, firstLine))
+
+            file.seek(start)
+            firstLine += file.read(end - start).count(b'\n')
+            start = end
+    return chunks
+
+# Sets up a worker process with the same settings as the main process
+# ARGS
+# options: map containing verbose, lut (a lookup table directory or None), format, precision,
+#          cacheSize (0 for no cache), stats (whether to record RUN_STATS), palette (the --palette
+#          file, or None without --nearest), override and outputFormats
+def initConversionWorker(options) :
+    global WORKER_OPTIONS, VERBOSE, CONVERSION_CACHE, PALETTE_INDEX
+    WORKER_OPTIONS = options
+    VERBOSE = options['verbose']
+    CONVERSION_CACHE = ConversionCache(options['cacheSize']) if options['cacheSize'] else None
+    # (the main process has already saved the palette's index, unless it's serving, so this just opens it)
+    PALETTE_INDEX = loadPaletteIndex(options['palette'], save=False) if options['palette'] else None
+    LOOKUP_TABLES.clear()
+    # (only the tables the main process found usable, and it has already warned about the others)
+    if options['lut'] :
+        loadLookupTables(options['lut'], options['lutFormats'], warn=False)
+
+# Converts one byte range of an input file (in a worker process)
+# RETURNS
+# a tuple of the formatted output, its errors (see RecordingChannel), the chunk's cache counters, and
+# its (times, counts) statistics (or None if they aren't being recorded)
+def convertFileChunk(path, task) :
+    global OUTPUT_SINK, ERROR_CHANNEL, RUN_STATS
+    start, end, firstLine = task
+    with open(path, 'rb') as file :
+        file.seek(start)
+        text = file.read(end - start).decode('utf-8')
+
+    countsBefore = CONVERSION_CACHE.counts() if CONVERSION_CACHE is not None else (0, 0, 0)
+    RUN_STATS = RunStats() if WORKER_OPTIONS['stats'] else None
+    output = io.StringIO()
+    sinkFormats = WORKER_OPTIONS['outputFormats'] + (['nearest'] if PALETTE_INDEX is not None else [])
+    OUTPUT_SINK = OutputSink(output, outputFormat=WORKER_OPTIONS['format'], outputFormats=sinkFormats, precision=WORKER_OPTIONS['precision'])
+    ERROR_CHANNEL = RecordingChannel(output)
+    handleBulk(readColorCodes(io.StringIO(text, newline=None), firstLine), WORKER_OPTIONS['override'], WORKER_OPTIONS['outputFormats'])
+    stageFunction(OUTPUT_SINK.close, 'write')()
+
+    cacheCounts = (0, 0, 0)
+    if CONVERSION_CACHE is not None :
+        cacheCounts = tuple(after - before for after, before in zip(CONVERSION_CACHE.counts(), countsBefore))
+    stats = (dict(RUN_STATS.times), dict(RUN_STATS.counts)) if RUN_STATS is not None else None
+    return output.getvalue(), ERROR_CHANNEL.records, cacheCounts, stats
+
+
+'''
+# MULTIPLE FILES
+'''
+
+# --input takes any number of files, directories (every file under them) and glob patterns. Their
+# output is either merged through OUTPUT_SINK (--output or stdout) one file after the other, or with
+# --output-dir written to a file of the same name per input file, mirroring the layout under the
+# input directories (and glob patterns). Conversion happens on the main thread with handleBulk(),
+# while a pool of threads reads ahead the next files and writes out the output of the previous ones.
+# Only a bounded number of files are read ahead or waiting to be written, and files too big to hold
+# in memory are streamed on the main thread instead. A file that can't be read or written is reported
+# and counted as failed without stopping the rest, and errors say which file they're about.
+
+# number of threads reading and writing files
+FILE_THREADS = 4
+# files of at most this many bytes are read ahead (and have their output written) by the threads,
+# bigger ones are streamed
+FILE_PREFETCH_SIZE = 1 << 22
+# how many files can be read ahead, and how many outputs can be waiting to be written
+FILE_QUEUE_SIZE = FILE_THREADS * 2
+# characters that make an --input a glob pattern
+GLOB_PATTERN = re.compile(r'[*?[]')
+
+# Handles several input files
+# ARGS
+# files: list of (path, path of its output relative to outputDir) tuples, see expandInputs()
+# override: string indicating the format of every color code, or None to detect each one
+# outputFormats: list indicating which conversions to perform
+# outputDir: the directory to write each file's output to, or None to merge it all into OUTPUT_SINK
+# sinkOptions: map of the append, format, sinkFormats and precision settings of --output-dir files
+# RETURNS
+# a tuple of the number of failed files and of color codes converted
+def handleFiles(files, override, outputFormats, outputDir, sinkOptions) :
+    # only needed for several input files
+    import concurrent.futures
+    global OUTPUT_SINK
+    mainSink = outputSink()
+    channel = errorChannel()
+    # (a set, as a file can fail to convert and then fail to be written)
+    failed = set()
+    colorCodes = 0
+    outputPaths = {}
+    pending = iter(files)
+    reads = collections.deque()
+    writes = collections.deque()
+    # (the persistent cache reads the files itself, to only convert what it doesn't have)
+    reader = readSmallFile if PERSISTENT_CACHE is None else (lambda path : None)
+    with concurrent.futures.ThreadPoolExecutor(FILE_THREADS) as executor :
+        def readAhead(count) :
+            for path, relativePath in itertools.islice(pending, count) :
+                reads.append((path, relativePath, executor.submit(reader, path)))
+
+        readAhead(FILE_QUEUE_SIZE)
+        try :
+            while reads :
+                path, relativePath, read = reads.popleft()
+                readAhead(1)
+                outputPath = os.path.join(outputDir, relativePath) if outputDir else None
+                if outputPath in outputPaths :
+                    print(f'ERROR: "{path}" and "{outputPaths[outputPath]}" would both be written to "{outputPath}"', file=sys.stderr)
+                    failed.add(path)
+                    continue
+                elif outputPath is not None :
+                    outputPaths[outputPath] = path
+
+                # errors say which file they're about
+                channel.source = path
+                try :
+                    count, output = convertFile(path, read.result(), outputPath, mainSink, override, outputFormats, sinkOptions)
+                except (OSError, UnicodeDecodeError) as error :
+                    print(f'ERROR: Could not convert "{path}": {describeFileError(error)}', file=sys.stderr)
+                    failed.add(path)
+                    continue
+                finally :
+                    OUTPUT_SINK = mainSink
+                    channel.source = None
+                colorCodes += count
+
+                if output is not None :
+                    writes.append((path, outputPath, executor.submit(writeOutputFile, outputPath, output, sinkOptions)))
+                while len(writes) > FILE_QUEUE_SIZE :
+                    finishWrite(*writes.popleft(), failed)
+            while writes :
+                finishWrite(*writes.popleft(), failed)
+        finally :
+            # don't leave the threads reading files nobody will convert
+            for _, _, read in reads :
+                read.cancel()
+    return len(failed), colorCodes
+
+# Expands the --input arguments into the files to convert, printing an error for each directory or
+# glob pattern with no files, and for each of their files a served request can't read (plain file
+# names are kept as they are, to fail when read)
+# ARGS
+# inputs: list of file names, directories and glob patterns
+# exclude: a directory to leave out (the output directory), or None
+# RETURNS
+# a tuple of a list of (path, path relative to its directory or to the start of its glob pattern)
+# tuples (in a stable order), and the number of directories and patterns that had no files (and
+# files left out)
+def expandInputs(inputs, exclude = None) :
+    # only needed for glob patterns
+    import glob
+    excluded = os.path.realpath(exclude) if exclude else None
+    isExcluded = lambda path : (excluded is not None) and (os.path.realpath(path) + os.sep).startswith(excluded + os.sep)
+    files = []
+    unmatched = 0
+    for pattern in inputs :
+        if os.path.isdir(pattern) :
+            paths = []
+            for root, directories, names in os.walk(pattern) :
+                directories[:] = sorted(name for name in directories if not isExcluded(os.path.join(root, name)))
+                paths.extend(os.path.join(root, name) for name in sorted(names))
+            base = pattern
+        elif GLOB_PATTERN.search(pattern) :
+            paths = sorted(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path) and not isExcluded(path))
+            # the directories before the first wildcard
+            base = pattern
+            while GLOB_PATTERN.search(base) :
+                base = os.path.dirname(base)
+        else :
+            files.append((pattern, os.path.basename(pattern)))
+            continue
+
+        # (a served request's directories and patterns can still lead outside SERVE_ROOT, through links)
+        for path in [path for path in paths if not servedPathAllowed(path)] :
+            print(f'ERROR: Not reading "{path}", requests to a server can only read files under "{SERVE_ROOT}"', file=sys.stderr)
+            paths.remove(path)
+            unmatched += 1
+        if not paths :
+            print(f'ERROR: No files found for "{pattern}"', file=sys.stderr)
+            unmatched += 1
+        files.extend((path, os.path.relpath(path, base or '.')) for path in paths)
+    return files, unmatched
+
+# Converts one of the files of handleFiles()
+# ARGS
+# path: name of the file
+# text: the contents of the file if it was read ahead, or None to stream it
+# outputPath: the file to write its output to, or None to write it to mainSink
+# mainSink: the sink of the merged output
+# RETURNS
+# a tuple of the number of color codes, and the output still to be written to outputPath (None if
+# it's already been written)
+def convertFile(path, text, outputPath, mainSink, override, outputFormats, sinkOptions) :
+    global OUTPUT_SINK
+    buffer = None
+    counts = [0]
+    def countColorCodes(colorCodes) :
+        for colorCode in colorCodes :
+            counts[0] += 1
+            yield colorCode
+
+    # (the persistent cache reads the file as bytes itself)
+    cached = (text is None) and (PERSISTENT_CACHE is not None) and (mainSink.cacheKey is not None)
+    with contextlib.ExitStack() as stack :
+        if cached :
+            source = stack.enter_context(open(path, 'rb'))
+        elif text is None :
+            source = stack.enter_context(open(path, 'r', encoding='utf-8'))
+        else :
+            source = io.StringIO(text, newline=None)
+
+        if outputPath is None :
+            OUTPUT_SINK = mainSink
+        elif text is None :
+            os.makedirs(os.path.dirname(outputPath) or '.', exist_ok=True)
+            OUTPUT_SINK = OutputSink(outputPath, sinkOptions['append'], sinkOptions['format'], sinkOptions['sinkFormats'], sinkOptions['precision'])
+            stack.callback(OUTPUT_SINK.close)
+        else :
+            # the header and footer get added when it's written out, see writeOutputFile()
+            buffer = io.StringIO()
+            OUTPUT_SINK = OutputSink(buffer, False, sinkOptions['format'], sinkOptions['sinkFormats'], sinkOptions['precision'])
+
+        if cached :
+            counts[0] = handleCachedFile(source, override, outputFormats)
+        else :
+            handleBulk(countColorCodes(readColorCodes(source)), override, outputFormats)
+    return counts[0], (buffer.getvalue() if buffer is not None else None)
+
+# Returns the contents of a file if it's small enough to read ahead, or None if it should be streamed
+def readSmallFile(path) :
+    with open(path, 'rb') as file :
+        if os.fstat(file.fileno()).st_size > FILE_PREFETCH_SIZE :
+            return None
+        return file.read().decode('utf-8')
+
+# Writes the output of a file (formatted by a sink with no header or footer) to outputPath, with the
+# header and footer of its format
+def writeOutputFile(outputPath, output, sinkOptions) :
+    os.makedirs(os.path.dirname(outputPath) or '.', exist_ok=True)
+    sink = OutputSink(outputPath, sinkOptions['append'], sinkOptions['format'], sinkOptions['sinkFormats'], sinkOptions['precision'])
+    try :
+        sink.writeFormatted(output)
+    finally :
+        sink.close()
+
+# Waits for the output of a file to be written, reporting it and adding the file to the failed set if
+# it couldn't be
+def finishWrite(path, outputPath, write, failed) :
+    try :
+        write.result()
+    except OSError as error :
+        print(f'ERROR: Could not write "{outputPath}": {describeFileError(error)}', file=sys.stderr)
+        failed.add(path)
+
+# Returns a short description of an error reading or writing a file
+def describeFileError(error) :
+    if isinstance(error, UnicodeDecodeError) :
+        return f'not UTF-8 text (byte {error.start})'
+    return error.strerror or str(error)
+
+
+'''
+# FOLLOWING FILES
+'''
+
+# With --follow, the input file is converted and then checked for appended lines every
+# FOLLOW_INTERVAL seconds (like tail -f), converting only the complete lines (a line still being
+# written waits for its newline) and flushing the output after each batch. If the file shrinks it was
+# truncated, and it's converted again from the start. If the name points to a different file (or to
+# nothing) it was rotated: what's left of the old file is converted (including an unterminated last
+# line), and the new file is converted from the start once it shows up.
+#
+# With --checkpoint, the device, inode, byte offset and line number reached are saved after each
+# batch has been written, so a restarted follower resumes from there (unless the file was replaced or
+# truncated in the meantime). The checkpoint only moves once the output is flushed, so after a crash
+# lines can be converted twice but never skipped.
+
+# seconds between checks for appended lines
+FOLLOW_INTERVAL = 0.5
+# the most bytes of the input converted at once
+FOLLOW_READ_SIZE = 1 << 22
+
+# Converts a file and keeps converting lines appended to it until interrupted (Ctrl-C or SIGTERM)
+# ARGS
+# path: name of the input file
+# override: string indicating the format of every color code, or None to detect each one
+# outputFormats: list indicating which conversions to perform
+# checkpointPath: name of the checkpoint file, or None for no checkpoint
+# RETURNS
+# truth if it was stopped, false if the input couldn't be read
+def handleFollow(path, override, outputFormats, checkpointPath = None) :
+    # only needed for --follow
+    import signal
+    state = {'identity': None, 'offset': 0, 'line': 1}
+    checkpoint = readCheckpoint(checkpointPath) if checkpointPath else None
+    file = None
+    try :
+        file = open(path, 'rb')
+    except OSError as error :
+        print(f'ERROR: Could not read "{path}": {error.strerror or error}', file=sys.stderr)
+        return False
+
+    stopHandler = signal.signal(signal.SIGTERM, lambda signum, frame : sys.exit(0))
+    try :
+        while True :
+            if file is None :
+                file = openRotated(path)
+            if (file is not None) and (state['identity'] is None) :
+                fileStat = os.fstat(file.fileno())
+                state.update(identity=[fileStat.st_dev, fileStat.st_ino], offset=0, line=1)
+                # resume from the checkpoint if it's about the same file and it hasn't been truncated
+                if checkpoint is not None :
+                    if (checkpoint.get('identity') == state['identity']) and (checkpoint.get('offset', 0) <= fileStat.st_size) :
+                        state.update(offset=checkpoint['offset'], line=checkpoint['line'])
+                    else :
+                        print(f'NOTE: "{path}" changed since the checkpoint, converting it from the start', file=sys.stderr)
+                    checkpoint = None
+
+            if file is not None :
+                convertAppended(file, state, override, outputFormats, checkpointPath)
+                if os.fstat(file.fileno()).st_size < state['offset'] :
+                    print(f'NOTE: "{path}" was truncated, converting it from the start', file=sys.stderr)
+                    state.update(offset=0, line=1)
+                    continue
+                elif isRotated(path, state['identity']) :
+                    # the rest of the old file, including a last line without a newline
+                    convertAppended(file, state, override, outputFormats, checkpointPath, final=True)
+                    file.close()
+                    file = None
+                    state['identity'] = None
+                    continue
+            time.sleep(FOLLOW_INTERVAL)
+    except KeyboardInterrupt :
+        return True
+    except UnicodeDecodeError as error :
+        print(f'ERROR: Could not convert "{path}": {describeFileError(error)}', file=sys.stderr)
+        return False
+    finally :
+        signal.signal(signal.SIGTERM, stopHandler)
+        if file is not None :
+            file.close()
+
+# Converts the complete lines appended to a followed file since state['offset'], moving the offset,
+# line number and checkpoint along after each batch
+# ARGS
+# file: the followed file, opened in binary mode
+# state: map of the identity ([device, inode]), offset and line number reached in the file
+# checkpointPath: name of the checkpoint file, or None for no checkpoint
+# final: also convert a last line without a newline (the file won't get any more lines)
+def convertAppended(file, state, override, outputFormats, checkpointPath, final = False) :
+    while True :
+        file.seek(state['offset'])
+        data = file.read(FOLLOW_READ_SIZE)
+        end = data.rfind(b'\n') + 1
+        # a line longer than a whole batch can't wait for its newline
+        if final or (end == 0 and len(data) == FOLLOW_READ_SIZE) :
+            end = len(data)
+        if end == 0 :
+            return
+
+        lines = io.StringIO(data[:end].decode('utf-8'), newline=None).readlines()
+        handleBulk(readColorCodes(lines, state['line']), override, outputFormats)
+        outputSink().flush()
+        errorChannel().flush()
+        state['offset'] += end
+        state['line'] += len(lines)
+        if checkpointPath :
+            writeCheckpoint(checkpointPath, state)
+
+# Returns the followed file opened again after it was rotated, or None if it isn't there (yet)
+def openRotated(path) :
+    try :
+        return open(path, 'rb')
+    except FileNotFoundError :
+        return None
+
+# Returns truth if path no longer names the file with the given [device, inode] identity
+def isRotated(path, identity) :
+    try :
+        pathStat = os.stat(path)
+    except FileNotFoundError :
+        return True
+    return [pathStat.st_dev, pathStat.st_ino] != identity
+
+# Returns the saved state of a --checkpoint file (see convertAppended()), or None if there isn't one
+def readCheckpoint(path) :
+    import json
+    try :
+        with open(path, 'r', encoding='utf-8') as file :
+            return json.load(file)
+    except FileNotFoundError :
+        return None
+    except (OSError, ValueError) as error :
+        print(f'WARNING: Ignoring checkpoint "{path}" ({getattr(error, "strerror", None) or error})', file=sys.stderr)
+        return None
+
+# Saves the state of a followed file to a --checkpoint file, replacing it all at once so an
+# interrupted write can't leave half a checkpoint behind
+def writeCheckpoint(path, state) :
+    import json
+    temporary = path + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as file :
+        json.dump(state, file)
+    os.replace(temporary, path)
+
+
+'''
+# CONVERSION SERVER
+'''
+
+# With --serve, a pool of worker processes answers requests from color-converter-client.py over a
+# Unix socket (or a localhost TCP port), so each request doesn't pay for starting Python. Each worker
+# accepts one connection at a time and runs main() on the forwarded command line, with its stdin,
+# stdout and stderr connected to the client, and keeps its caches and lookup tables between requests.
+#
+# A served command line runs as the user running the server, so it can't write files (see main()), and
+# its working directory has to be the server's or one under it. A Unix socket is only accessible to its
+# owner. A TCP port only listens on localhost, and as anyone on the machine can connect to it, needs a
+# shared token: the server and its clients take it from the SERVE_TOKEN_VARIABLE environment variable,
+# and requests without it are refused before anything runs (it's checked on a Unix socket too, if set).
+#
+# The client sends one line of JSON ({"argv": [...], "cwd": ..., "interactive": ..., "token": ...}) and the server
+# answers with frames of a 1 byte kind, a 4 byte (big-endian) length and the payload:
+#   b'o' stdout, b'e' stderr, b'i' the request started reading stdin (the client then sends it and
+#   shuts down its side of the connection), b'x' the exit status (always the last frame)
+
+# default number of connections waiting to be accepted while every worker is busy (more are refused)
+SERVE_QUEUE_SIZE = 64
+# how much output a served request buffers before sending it to the client
+SERVE_FRAME_SIZE = 1 << 16
+SERVE_FRAME_HEADER = struct.Struct('>cI')
+SERVE_TOKEN_VARIABLE = 'COLOR_CONVERTER_TOKEN'
+# the directory requests (and the files they read) have to be under, and the token they need (or
+# None), set up by serve()
+SERVE_ROOT = None
+SERVE_TOKEN = None
+
+# Answers requests until interrupted (Ctrl-C or SIGTERM), replacing workers that die
+# ARGS
+# address: a Unix socket path, or [host:]port for TCP (host defaults to 127.0.0.1)
+# workers: number of worker processes
+# queueSize: number of connections to hold while every worker is busy
+# lut: a lookup table directory to open before starting the workers (so they share it), or None
+# RETURNS
+# the exit status
+def serve(address, workers, queueSize, lut = None) :
+    # only needed for --serve (as are the imports of the other server functions)
+    import signal
+    import socket
+    import multiprocessing
+    import multiprocessing.connection
+    global SERVE_ROOT, SERVE_TOKEN
+    SERVE_ROOT = os.path.realpath(os.getcwd())
+    SERVE_TOKEN = os.environ.get(SERVE_TOKEN_VARIABLE) or None
+    family, socketAddress = parseServeAddress(address)
+    if (family != getattr(socket, 'AF_UNIX', None)) and not isLoopbackHost(socketAddress[0]) :
+        print(f'ERROR: --serve only listens on localhost (e.g. 127.0.0.1:PORT or a Unix socket), not "{socketAddress[0]}"', file=sys.stderr)
+        return 2
+    elif (family != getattr(socket, 'AF_UNIX', None)) and (SERVE_TOKEN is None) :
+        print(f'ERROR: --serve on a TCP port needs a shared token in the {SERVE_TOKEN_VARIABLE} environment variable (of the server and its clients)', file=sys.stderr)
+        return 2
+    try :
+        listener = openListener(address, queueSize)
+    except OSError as error :
+        print(f'ERROR: Could not listen on "{address}": {error.strerror or error}', file=sys.stderr)
+        return 1
+
+    # load everything the workers would otherwise load on their first request
+    loadNumpy()
+    if lut :
+        loadLookupTables(lut, LUT_TYPES)
+    sys.stdout.flush()
+
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else multiprocessing
+    processes = []
+    signal.signal(signal.SIGTERM, lambda signum, frame : sys.exit(0))
+    print(f'SERVING: {address} ({workers} workers)', file=sys.stderr)
+    try :
+        while True :
+            processes = [process for process in processes if process.is_alive()]
+            while len(processes) < max(workers, 1) :
+                process = context.Process(target=serveConnections, args=(listener,))
+                process.start()
+                processes.append(process)
+            multiprocessing.connection.wait([process.sentinel for process in processes])
+    except KeyboardInterrupt :
+        pass
+    finally :
+        for process in processes :
+            process.terminate()
+        for process in processes :
+            process.join()
+        listener.close()
+        if listener.family == getattr(socket, 'AF_UNIX', None) :
+            os.unlink(address)
+    return 0
+
+# Returns whether a served request can read a path: anything not being served, and otherwise only
+# what's under SERVE_ROOT once symbolic links and '..' are resolved
+def servedPathAllowed(path) :
+    return (SERVE_ROOT is None) or (os.path.commonpath([SERVE_ROOT, os.path.realpath(path)]) == SERVE_ROOT)
+
+# Parses a --serve address (a path containing a '/' or without a port number is a Unix socket)
+# RETURNS
+# a (socket family, socket address) tuple
+def parseServeAddress(address) :
+    import socket
+    host, _, port = address.rpartition(':')
+    if port.isdigit() and ('/' not in host) :
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, address
+
+# Returns whether every address a host name resolves to is a loopback address (of this machine only)
+def isLoopbackHost(host) :
+    import socket
+    import ipaddress
+    try :
+        addresses = [info[4][0] for info in socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)]
+    except OSError :
+        return False
+    return bool(addresses) and all(ipaddress.ip_address(address.split('%')[0]).is_loopback for address in addresses)
+
+# Opens the listening socket of the server (a Unix socket is only accessible by its owner, and
+# replaces a left over socket file that nothing is listening on anymore)
+def openListener(address, queueSize) :
+    import socket
+    family, socketAddress = parseServeAddress(address)
+    if family != socket.AF_UNIX :
+        return socket.create_server(socketAddress, backlog=queueSize)
+
+    if os.path.exists(socketAddress) and stat.S_ISSOCK(os.stat(socketAddress).st_mode) :
+        with socket.socket(socket.AF_UNIX) as probe :
+            try :
+                probe.connect(socketAddress)
+            except ConnectionRefusedError :
+                os.unlink(socketAddress)
+
+    listener = socket.socket(socket.AF_UNIX)
+    umask = os.umask(0o177)
+    try :
+        listener.bind(socketAddress)
+    except OSError :
+        listener.close()
+        raise
+    finally :
+        os.umask(umask)
+    listener.listen(queueSize)
+    return listener
+
+# The loop of a worker process, see serve()
+def serveConnections(listener) :
+    import signal
+    # the server process takes care of stopping the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    while True :
+        connection, _ = listener.accept()
+        with connection :
+            try :
+                serveRequest(connection)
+            except (OSError, ValueError) :
+                # the client went away or didn't send a proper request
+                pass
+
+# Runs one forwarded command line, see serve()
+def serveRequest(connection) :
+    import hmac
+    import json
+    import traceback
+    requestFile = connection.makefile('rb')
+    request = json.loads(requestFile.readline())
+    # (refused before anything of the request is looked at, see serve())
+    if (SERVE_TOKEN is not None) and not hmac.compare_digest(str(request.get('token') or '').encode('utf-8'), SERVE_TOKEN.encode('utf-8')) :
+        refuseRequest(connection, f'ERROR: Wrong or missing token, set {SERVE_TOKEN_VARIABLE} to the server\'s')
+        return
+    cwd = os.path.realpath(str(request.get('cwd')))
+    if (SERVE_ROOT is not None) and (os.path.commonpath([SERVE_ROOT, cwd]) != SERVE_ROOT) :
+        refuseRequest(connection, f'ERROR: The server only answers requests from "{SERVE_ROOT}" and the directories under it')
+        return
+    stdout = FrameWriter(connection, b'o', request.get('interactive', False))
+    stderr = FrameWriter(connection, b'e', True)
+    streams = sys.stdin, sys.stdout, sys.stderr
+    sys.stdin, sys.stdout, sys.stderr = RequestInput(connection, requestFile, request.get('interactive', False)), stdout, stderr
+    try :
+        os.chdir(cwd)
+        status = main(request['argv'], serving=True) or 0
+    except SystemExit as exit :
+        # argparse exits on --help and bad arguments
+        status = exit.code if isinstance(exit.code, int) else (0 if exit.code is None else 1)
+        if type(exit.code) == str :
+            print(exit.code, file=sys.stderr)
+    except (ConnectionError, BrokenPipeError) :
+        return
+    except Exception :
+        traceback.print_exc()
+        status = 1
+    finally :
+        sys.stdin, sys.stdout, sys.stderr = streams
+
+    stdout.flush()
+    stderr.flush()
+    sendFrame(connection, b'x', str(status).encode('ascii'))
+
+# Answers a request that isn't allowed with an error and exit status 2
+def refuseRequest(connection, message) :
+    sendFrame(connection, b'e', (message + '\n').encode('utf-8'))
+    sendFrame(connection, b'x', b'2')
+
+# Sends a frame of data to the client, see serve()
+def sendFrame(connection, kind, data) :
+    connection.sendall(SERVE_FRAME_HEADER.pack(kind, len(data)) + data)
+
+# A text stream that sends what's written to it to the client, as frames of one kind
+class FrameWriter(io.TextIOBase) :
+    # ARGS
+    # connection: the client's socket
+    # kind: the kind of frames to send (b'o' or b'e')
+    # interactive: send everything right away rather than buffering it
+    def __init__(self, connection, kind, interactive) :
+        self.connection = connection
+        self.kind = kind
+        self.interactive = interactive
+        self.pending = []
+        self.size = 0
+
+    def writable(self) :
+        return True
+
+    def write(self, text) :
+        self.pending.append(text)
+        self.size += len(text)
+        if self.interactive or (self.size >= SERVE_FRAME_SIZE) :
+            self.flush()
+        return len(text)
+
+    def flush(self) :
+        if self.pending :
+            data = ''.join(self.pending).encode('utf-8')
+            self.pending = []
+            self.size = 0
+            sendFrame(self.connection, self.kind, data)
+
+# The stdin of a served request, which the client only sends once something starts reading it
+class RequestInput :
+    def __init__(self, connection, requestFile, interactive) :
+        self.connection = connection
+        self.requestFile = requestFile
+        self.interactive = interactive
+        self.text = None
+
+    def isatty(self) :
+        return self.interactive
+
+    # (processes started by the request close their copy of stdin)
+    def close(self) :
+        pass
+
+    def __iter__(self) :
+        if self.text is None :
+            sendFrame(self.connection, b'i', b'')
+            self.text = io.TextIOWrapper(self.requestFile, encoding='utf-8')
+        return iter(self.text)
+
+
+'''
+# INPUT VALIDATION 
+'''
+
+# Takes in a string and the format it's in. Returns the validated values for that format.
+# (tokens: the values tokenizeColor() found in the string, if it has already been tokenized)
+# The validators raise a ColorParseError or ColorRangeError for invalid color codes.
+def validateColor(color, colorFormat, tokens = None) :
+    if colorFormat == 'hex' :
+        return validateHex(color, tokens)
+    if colorFormat == 'rgb' :
+        return validateRGB(color, tokens)
+    if colorFormat == 'cmy' :
+        return validateCMYorCMYK(color, False, tokens)
+    if colorFormat == 'cmyk' :
+        return validateCMYorCMYK(color, True, tokens)
+    if colorFormat in CIE_RANGES :
+        return validateCIE(color, colorFormat, tokens)
+    return validateHSLorHSV(color, tokens)
+
+# Takes in a string. 
+# If string contains a valid Hex color code, it gets returned as a string.
+def validateHex(value, tokens = None) :
+    # attempt to extract hex code
+    hexcode = extractValues(value, 1, 'hex code', True, tokens)
+    return hexcode[0]
+
+# Takes in a string. Returns the values it contains as integers if valid RGB values. 
+def validateRGB(color, tokens = None) :
+    # extract 3 numbers from the provided values
+    rgbValues = extractValues(color, 3, 'RGB', False, tokens)
+
+    intValues = []
+    for value in rgbValues :
+        if value is None :
+            raise ColorParseError('Improper format for RGB (see --help)')
+        value = smartRound(value)
+        if (value < 0) or (value > 255) :
+            raise ColorRangeError(f'Each RBG value must be between 0-255, was {value}')
+        intValues.append(value)
+    
+    return intValues
+
+# Takes in a string. Returns the 3 or 4 values it contains as floats if valid CMY(K) values.
+def validateCMYorCMYK(color, include_K, tokens = None) :
+    k = ''
+    if include_K :
+        k = 'K'
+        values = extractValues(color, 4, 'CMYK', False, tokens)
+    else :
+        values = extractValues(color, 3, 'CMY', False, tokens)
+
+    floatValues = []
+    for value in values :
+        if value is None :
+            raise ColorParseError(f'Improper format for CMY{k} (see --help)')
+        value = float(value)
+        if (value < 0) or (value > 100) :
+            raise ColorRangeError(f'Each CMY{k} value must be between 0.0-100.0, was {value}')
+        floatValues.append(value)
+    
+    return floatValues
+
+# Takes in a string. Returns the values it contains as 1 integer and 2 floats if valid HSL/V values.
+def validateHSLorHSV(color, tokens = None) :
+    color = extractValues(color, 3, 'HSL/V', False, tokens)
+    if None in color :
+        raise ColorParseError('Improper format for HSL/V (see --help)')
+    color[0] = smartRound(color[0])
+    color[1] = float(color[1])
+    color[2] = float(color[2])
+
+    if (color[0] < 0) or (color[0] > 360) :
+        raise ColorRangeError(f'Invalid H value (should be 0-360, was {color[0]})')
+    if (color[1] < 0) or (color[1] > 100) :
+        raise ColorRangeError(f'Invalid S value (should be 0.0-100.0, was {color[1]})')
+    if (color[2] < 0) or (color[2] > 100) :
+        raise ColorRangeError(f'Invalid V/L value (should be 0.0-100.0, was {color[2]})')
+
+    return [color[0], color[1], color[2]]
+
+# the name, lowest and highest value of each value of the CIE formats (the XYZ limits are D65 white,
+# rounded up)
+CIE_RANGES = {
+    'xyz': [('X', 0.0, 95.05), ('Y', 0.0, 100.0), ('Z', 0.0, 108.91)],
+    'lab': [('L', 0.0, 100.0), ('a', -128.0, 127.0), ('b', -128.0, 127.0)],
+    'lch': [('L', 0.0, 100.0), ('C', 0.0, 200.0), ('H', 0.0, 360.0)],
+}
+
+# Takes in a string. Returns the 3 values it contains as floats if valid XYZ, Lab or LCh values
+# (see CIE_RANGES, only a and b of Lab can be negative).
+def validateCIE(color, colorFormat, tokens = None) :
+    if tokens is None :
+        tokens = tokenizeColor(color, colorFormat)[1]
+    values = extractValues(color, 3, colorFormat.upper(), False, tokens)
+
+    floatValues = []
+    for value, (name, lowest, highest) in zip(values, CIE_RANGES[colorFormat]) :
+        if value is None :
+            raise ColorParseError(f'Improper format for {colorFormat.upper()} (see --help)')
+        # (adding 0.0 turns -0.0 into 0.0)
+        value = float(value) + 0.0
+        if (value < lowest) or (value > highest) :
+            raise ColorRangeError(f'Invalid {name} value (should be {lowest}-{highest}, was {value})')
+        floatValues.append(value)
+
+    return floatValues
+
+# Describes a ColorError the way the CLI reports it, e.g. "ERROR: Improper format for RGB (see --help)"
+def describeColorError(error) :
+    message = 'ERROR: ' + str(error) + '\n'
+    if getattr(error, 'detail', None) :
+        message = error.detail + '\n' + message
+    return message
+
+
+'''
+# ERROR CHANNEL
+'''
+
+# Color codes that can't be converted are reported through ERROR_CHANNEL, apart from the output, so
+# the output only ever holds conversions. By default each error is a message on stderr, and with
+# --errors FILE it's a line of JSON instead, e.g.
+#   {"line": 12, "input": "rgb(300, 0, 0)", "error": "ColorRangeError", "reason": "...", "detail": null}
+# (with "file" first when converting several files, and "record" rather than "line" for packed
+# records). Errors travel down the bulk pipeline like conversions do (see parseColors()), so they come
+# out in the order of the input and only cost anything for the lines that fail. With --max-errors N
+# (or --fail-fast, for 1) the run stops at the Nth error, once the output of every line before it has
+# been written.
+
+# the reason given for color codes whose format can't be detected
+UNDETECTED_MESSAGE = 'Could not detect inputted color format and no override format flag was provided. See --help for more information on usage.'
+
+# Raised by ErrorChannel.report() once --max-errors have been reported, and caught by main()
+class ErrorLimitReached(Exception) :
+    pass
+
+# Returns the error record of a ColorError: a tuple of the label and number of where it came from
+# ('line' or 'record', None for a color given as an argument), the color code, the name of the
+# error's class, its reason and its detail (or None)
+def errorRecord(error, number, color, label = 'line') :
+    return (label, number, color, type(error).__name__, str(error), getattr(error, 'detail', None))
+
+class ErrorChannel :
+    # ARGS
+    # destination: None for messages on stderr, or the name of a file to write JSON lines to
+    # append: append to the file rather than overwriting it
+    # maxErrors: how many errors to stop after, or None to never stop
+    # RAISES
+    # OSError if the file can't be opened
+    def __init__(self, destination = None, append = False, maxErrors = None) :
+        self.destination = destination
+        self.maxErrors = maxErrors
+        self.count = 0
+        # the input file the errors are about, when converting several (see handleFiles())
+        self.source = None
+        self.file = None
+        if destination is not None :
+            # only needed for --errors
+            import json
+            self.encode = json.JSONEncoder(ensure_ascii=False).encode
+            self.file = open(destination, 'a' if append else 'w', encoding='utf-8')
+
+    # Reports an error (the fields of an error record, see errorRecord())
+    # RAISES
+    # ErrorLimitReached if that makes maxErrors errors
+    def report(self, label, number, color, kind, reason, detail = None) :
+        self.count += 1
+        if self.file is None :
+            message = 'ERROR: ' + reason + '\n'
+            if detail :
+                message = detail + '\n' + message
+            if number is not None :
+                message = f'{label.capitalize()} {number}: ' + message
+            if self.source is not None :
+                message = f'{self.source}: ' + message
+            sys.stderr.write(message)
+        else :
+            record = {label: number, 'input': color, 'error': kind, 'reason': reason, 'detail': detail}
+            if self.source is not None :
+                record = dict(file=self.source, **record)
+            self.file.write(self.encode(record) + '\n')
+        if (self.maxErrors is not None) and (self.count >= self.maxErrors) :
+            raise ErrorLimitReached(self.count)
+
+    # flushes the errors reported so far out of the buffer
+    def flush(self) :
+        if self.file is not None :
+            self.file.flush()
+
+    def close(self) :
+        if self.file is not None :
+            self.file.close()
+
+# An ErrorChannel that keeps the errors, along with where they came in an output fragment (for a
+# worker process or the PERSISTENT CACHE to hand over, see replayOutput())
+class RecordingChannel(ErrorChannel) :
+    # ARGS
+    # output: the StringIO the output fragment is being written to
+    def __init__(self, output) :
+        super().__init__()
+        self.output = output
+        # lists of [where in the output] + the fields of the error record
+        self.records = []
+
+    def report(self, label, number, color, kind, reason, detail = None) :
+        self.count += 1
+        self.records.append([self.output.tell(), label, number, color, kind, reason, detail])
+
+# the error channel, see errorChannel()
+ERROR_CHANNEL = None
+
+# Writes an output fragment through OUTPUT_SINK and its recorded errors through ERROR_CHANNEL, in the
+# order they came in
+# ARGS
+# output: the formatted output
+# records: its errors, see RecordingChannel
+# lineOffset: what to add to their line numbers
+def replayOutput(output, records, lineOffset = 0) :
+    sink = outputSink()
+    channel = errorChannel()
+    written = 0
+    for position, label, number, *fields in records :
+        if position > written :
+            sink.writeFormatted(output[written:position])
+            written = position
+        channel.report(label, number if number is None else number + lineOffset, *fields)
+    if written < len(output) :
+        sink.writeFormatted(output[written:])
+
+
+'''
+# OUTPUT SINKS
+'''
+
+# size of the buffer used when writing output to a file
+OUTPUT_BUFFER_SIZE = 1 << 20
+# names of each format's values, used as column/field names by the machine-readable formats
+CHANNELS = {
+    'hex':  ['hex'],
+    'rgb':  ['r', 'g', 'b'],
+    'cmy':  ['c', 'm', 'y'],
+    'cmyk': ['c', 'm', 'y', 'k'],
+    'hsl':  ['h', 's', 'l'],
+    'hsv':  ['h', 's', 'v'],
+    'xyz':  ['x', 'y', 'z'],
+    'lab':  ['l', 'a', 'b'],
+    'lch':  ['l', 'c', 'h'],
+}
+
+# An OutputSink delivers converted colors to stdout or a file in one of the OUTPUT_FORMATTERS formats.
+# Files are opened once and written through a large buffer, which is flushed when full and on close().
+class OutputSink :
+    # ARGS
+    # destination: 'stdout', the name of a file, or an already open file to write a fragment of
+    #              the output to (with no header or footer, which the caller takes care of)
+    # append: append to the file rather than overwriting it
+    # outputFormat: one of OUTPUT_FORMATTERS
+    # outputFormats: list of the color formats that will be delivered
+    # precision: number of decimals to display floats with
+    def __init__(self, destination = 'stdout', append = False, outputFormat = 'text', outputFormats = DEFAULT_TYPES, precision = 2) :
+        self.destination = destination
+        self.outputFormat = outputFormat
+        self.outputFormats = outputFormats
+        self.precision = precision
+        header, self.formatColor, self.footer = OUTPUT_FORMATTERS[outputFormat](outputFormats, precision)
+        # identifies output formatted by this sink for CONVERSION_CACHE (CSS output numbers each
+        # color, so it can't be reused)
+        self.cacheKey = None if outputFormat == 'css' else (outputFormat, tuple(outputFormats), precision)
+        if destination == 'stdout' :
+            self.file = sys.stdout
+            isEmpty = True
+        elif not isinstance(destination, str) :
+            self.file = destination
+            isEmpty = False
+            self.footer = None
+        else :
+            self.file = open(destination, 'a' if append else 'w', encoding='utf-8', buffering=OUTPUT_BUFFER_SIZE)
+            isEmpty = self.file.tell() == 0
+
+        # headers only belong at the top of the output, not halfway down an appended file
+        if header and isEmpty :
+            self.file.write(header)
+
+    # formats and writes a map of converted values (see printConversions())
+    def write(self, convertedValues) :
+        self.file.write(self.formatColor(convertedValues))
+
+    # writes output that has already been formatted (e.g. by a worker process)
+    def writeFormatted(self, text) :
+        self.file.write(text)
+
+    # flushes what's been written so far out of the buffer
+    def flush(self) :
+        self.file.flush()
+
+    # writes any footer and flushes everything out
+    def close(self) :
+        if self.footer :
+            self.file.write(self.footer)
+        if isinstance(self.destination, str) and (self.file is not sys.stdout) :
+            self.file.close()
+        else :
+            self.file.flush()
+
+# Returns a function that formats a number with the given amount of decimals if it's a float, and
+# as-is otherwise (the conversion functions return plain ints for some values, e.g. RGB)
+def compileNumberFormat(precision) :
+    floatFormat = ('{:.' + str(precision) + 'f}').format
+    return lambda value : floatFormat(value) if type(value) == float else str(value)
+
+# Each formatter takes a list of color formats and a precision, and returns a (header, formatColor, footer)
+# tuple, where formatColor() turns a map of converted values into the text for that color.
+
+# Human-readable format, e.g. "hsl(138.84, 98.37, 75.88)" per line with a blank line after each color
+def compileTextFormatter(outputFormats, precision) :
+    formatNumber = compileNumberFormat(precision)
+    colorFormats = [colorFormat for colorFormat in TYPES if colorFormat in outputFormats]
+
+    def formatColor(convertedValues) :
+        lines = []
+        if 'verbose-msg' in convertedValues :
+            lines.append(convertedValues['verbose-msg'])
+        if 'count' in convertedValues :
+            lines.append('count: ' + str(convertedValues['count']))
+        for colorFormat in colorFormats :
+            values = convertedValues.get(colorFormat, None)
+            if values is None :
+                continue
+            elif colorFormat == 'hex' :
+                lines.append('#' + values)
+            else :
+                lines.append(colorFormat + '(' + ', '.join([formatNumber(value) for value in values]) + ')')
+        if 'nearest' in convertedValues :
+            nearest, distance = convertedValues['nearest']
+            lines.append('nearest: ' + nearest + ' (distance ' + formatNumber(distance) + ')')
+        lines.append('\n')
+        return '\n'.join(lines)
+
+    return None, formatColor, None
+
+# Delimiter-separated format with a header row and one row per color, e.g. "hex,hsl.h,hsl.s,hsl.l"
+def compileDelimitedFormatter(outputFormats, precision, delimiter) :
+    formatNumber = compileNumberFormat(precision)
+    colorFormats = [colorFormat for colorFormat in TYPES if colorFormat in outputFormats]
+    counted = 'count' in outputFormats
+    matched = 'nearest' in outputFormats
+    header = delimiter.join((['count'] if counted else []) + ['hex' if colorFormat == 'hex' else colorFormat + '.' + channel
+                             for colorFormat in colorFormats for channel in CHANNELS[colorFormat]]
+                            + (['nearest', 'distance'] if matched else [])) + '\n'
+    blanks = {colorFormat : [''] * len(CHANNELS[colorFormat]) for colorFormat in colorFormats}
+
+    def formatColor(convertedValues) :
+        fields = [str(convertedValues.get('count', ''))] if counted else []
+        for colorFormat in colorFormats :
+            values = convertedValues.get(colorFormat, None)
+            if values is None :
+                fields.extend(blanks[colorFormat])
+            elif colorFormat == 'hex' :
+                fields.append('#' + values)
+            else :
+                fields.extend([formatNumber(value) for value in values])
+        if matched :
+            nearest, distance = convertedValues.get('nearest', ('', ''))
+            fields.extend([quoteField(nearest, delimiter), formatNumber(distance)])
+        return delimiter.join(fields) + '\n'
+
+    return header, formatColor, None
+
+# Quotes a field of delimited output if it contains the delimiter or a quote (palette color codes can)
+def quoteField(text, delimiter) :
+    if (delimiter in text) or ('"' in text) :
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+def compileCsvFormatter(outputFormats, precision) :
+    return compileDelimitedFormatter(outputFormats, precision, ',')
+
+def compileTsvFormatter(outputFormats, precision) :
+    return compileDelimitedFormatter(outputFormats, precision, '\t')
+
+# One JSON object per line, e.g. {"hex": "#85feab", "rgb": [133, 254, 171]}
+def compileJsonlFormatter(outputFormats, precision) :
+    # only needed for jsonl output (quoting --nearest palette entries)
+    import json
+    formatNumber = compileNumberFormat(precision)
+    colorFormats = [colorFormat for colorFormat in TYPES if colorFormat in outputFormats]
+
+    def formatColor(convertedValues) :
+        fields = []
+        for colorFormat in colorFormats :
+            values = convertedValues.get(colorFormat, None)
+            if values is None :
+                continue
+            elif colorFormat == 'hex' :
+                fields.append('"hex": "#' + values + '"')
+            else :
+                fields.append('"' + colorFormat + '": [' + ', '.join([formatNumber(value) for value in values]) + ']')
+        if 'nearest' in convertedValues :
+            nearest, distance = convertedValues['nearest']
+            fields.append('"nearest": ' + json.dumps(nearest) + ', "distance": ' + formatNumber(distance))
+        if 'count' in convertedValues :
+            fields.append('"count": ' + str(convertedValues['count']))
+        return '{' + ', '.join(fields) + '}\n'
+
+    return None, formatColor, None
+
+# CSS custom properties, e.g. "--color-1-hsl: hsl(138.84 98.37% 75.88%);" inside a :root block
+# (CMY, HSV and XYZ aren't CSS colors, and CSS lab()/lch() are relative to D50 rather than D65, so
+# those are included as comments)
+def compileCssFormatter(outputFormats, precision) :
+    formatNumber = compileNumberFormat(precision)
+    colorFormats = [colorFormat for colorFormat in TYPES if colorFormat in outputFormats]
+    count = [0]
+
+    def formatColor(convertedValues) :
+        count[0] += 1
+        lines = []
+        if 'count' in convertedValues :
+            lines.append('  /* --color-' + str(count[0]) + ': ' + str(convertedValues['count']) + ' pixels */\n')
+        for colorFormat in colorFormats :
+            values = convertedValues.get(colorFormat, None)
+            if values is None :
+                continue
+            name = '--color-' + str(count[0]) + '-' + colorFormat
+            if colorFormat == 'hex' :
+                lines.append('  ' + name + ': #' + values + ';\n')
+            elif colorFormat == 'rgb' :
+                lines.append('  ' + name + ': rgb(' + ' '.join([str(value) for value in values]) + ');\n')
+            elif colorFormat == 'hsl' :
+                lines.append('  ' + name + ': hsl(' + formatNumber(values[0]) + ' ' + formatNumber(values[1]) + '% ' + formatNumber(values[2]) + '%);\n')
+            elif colorFormat == 'cmyk' :
+                lines.append('  ' + name + ': device-cmyk(' + ' '.join([formatNumber(value) + '%' for value in values]) + ');\n')
+            else :
+                lines.append('  /* ' + name + ': ' + colorFormat + '(' + ', '.join([formatNumber(value) for value in values]) + ') */\n')
+        if 'nearest' in convertedValues :
+            nearest, distance = convertedValues['nearest']
+            lines.append('  /* --color-' + str(count[0]) + ': nearest ' + nearest + ' (distance ' + formatNumber(distance) + ') */\n')
+        return ''.join(lines)
+
+    return ':root {\n', formatColor, '}\n'
+
+OUTPUT_FORMATTERS = {
+    'text':  compileTextFormatter,
+    'csv':   compileCsvFormatter,
+    'tsv':   compileTsvFormatter,
+    'jsonl': compileJsonlFormatter,
+    'css':   compileCssFormatter,
+}
+
+# where printConversions() delivers output, set up in main()
+OUTPUT_SINK = None
+
+
+'''
+# PACKED RECORDS
+'''
+# --in-binary and --out-binary read and write colors as packed records instead of text, for
+# pipelines between programs where parsing and formatting text would be most of the work. A packed
+# stream is a PACKED_HEADER followed by one record per color: 3 bytes for Hex/RGB, and
+# little-endian float32s for the other formats.
+
+PACKED_MAGIC = b'CCPACK\0\0'
+PACKED_VERSION = 1
+# magic, version, (padding), color format, number of records (32 bytes, so float32 records stay aligned)
+PACKED_HEADER = struct.Struct('<8sH6x8sQ')
+# the number of records of output that couldn't be rewound to fill it in (e.g. a pipe), which means
+# the records go on until the end
+PACKED_COUNT_UNKNOWN = (1 << 64) - 1
+# the struct format of each color format's records
+PACKED_RECORDS = {'hex': '<3B', 'rgb': '<3B', 'cmy': '<3f', 'cmyk': '<4f', 'hsl': '<3f', 'hsv': '<3f', 'xyz': '<3f', 'lab': '<3f', 'lch': '<3f'}
+PACKED_FLOAT = struct.Struct('<f')
+# how many decimals widenFloat32() tries before settling for a float32's exact value
+PACKED_DECIMALS = 10
+# how many records are converted at once
+PACKED_CHUNK_SIZE = 1 << 16
+
+# A PackedSink takes the place of the OutputSink for --out-binary, writing each color as a record of
+# a single format. Floats are rounded to the precision first, so the records hold exactly what the
+# text output would show.
+class PackedSink :
+    # ARGS
+    # destination: 'stdout' or the name of a file
+    # append: add records to a file of packed records (of the same format) rather than overwriting it
+    # colorFormat: the format of the records (one of TYPES)
+    # precision: number of decimals to round floats to
+    # RAISES
+    # ColorError if there's no way to write bytes to stdout, or if appending to a file that isn't
+    # packed records of colorFormat
+    def __init__(self, destination = 'stdout', append = False, colorFormat = 'rgb', precision = 2) :
+        self.destination = destination
+        self.colorFormat = colorFormat
+        self.precision = precision
+        self.record = struct.Struct(PACKED_RECORDS[colorFormat])
+        # hex records are the bytes of the RGB values, so that's what arrays get converted to
+        self.convertTo = 'rgb' if colorFormat == 'hex' else colorFormat
+        # the output isn't text, so CONVERSION_CACHE has nothing to reuse
+        self.cacheKey = None
+        self.count = 0
+
+        if destination == 'stdout' :
+            if not hasattr(sys.stdout, 'buffer') :
+                raise ColorFormatError('--out-binary can\'t write to this stdout, use --output')
+            self.file = sys.stdout.buffer
+            self.file.write(PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, colorFormat.encode('ascii'), PACKED_COUNT_UNKNOWN))
+            return
+
+        if append and os.path.exists(destination) and (os.path.getsize(destination) > 0) :
+            existing = readPackedInput(destination)
+            try :
+                existingFormat, self.count = readPackedHeader(existing)
+            finally :
+                existing.close()
+            if existingFormat != colorFormat :
+                raise ColorFormatError(f'Can\'t append {colorFormat.upper()} records to "{destination}", it holds {existingFormat.upper()} records')
+            self.file = open(destination, 'r+b', buffering=OUTPUT_BUFFER_SIZE)
+            # (dropping any partly written record at the end)
+            self.file.seek(PACKED_HEADER.size + (self.count * self.record.size))
+            self.file.truncate()
+        else :
+            self.file = open(destination, 'wb', buffering=OUTPUT_BUFFER_SIZE)
+            self.file.write(PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, colorFormat.encode('ascii'), PACKED_COUNT_UNKNOWN))
+
+    # packs a map of converted values (see printConversions()) into a record
+    def formatColor(self, convertedValues) :
+        if 'verbose-msg' in convertedValues :
+            print(convertedValues['verbose-msg'], file=sys.stderr)
+        values = convertedValues[self.colorFormat]
+        if self.colorFormat == 'hex' :
+            return bytes.fromhex(values)
+        elif self.colorFormat == 'rgb' :
+            return self.record.pack(*values)
+        return self.record.pack(*[roundDecimals(value, self.precision) for value in values])
+
+    # packs and writes a map of converted values
+    def write(self, convertedValues) :
+        self.writeFormatted(self.formatColor(convertedValues))
+
+    # writes records that have already been packed
+    def writeFormatted(self, data) :
+        self.file.write(data)
+        self.count += len(data) // self.record.size
+
+    # writes an array of values converted to self.convertTo (see batchConvert()) as records
+    def writeArray(self, values) :
+        np = loadNumpy()
+        if self.colorFormat in ('hex', 'rgb') :
+            values = values.astype(np.uint8)
+        else :
+            values = batchRoundDecimals(values, self.precision).astype('<f4')
+        self.writeFormatted(values.tobytes())
+
+    # flushes the records written so far out of the buffer
+    def flush(self) :
+        self.file.flush()
+
+    # fills in the number of records (of an output file) and flushes everything out
+    def close(self) :
+        if self.destination == 'stdout' :
+            self.file.flush()
+            return
+        self.file.seek(0)
+        self.file.write(PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, self.colorFormat.encode('ascii'), self.count))
+        self.file.close()
+
+# Returns the contents of a file of packed records (memory-mapped), or of stdin for None/'-'
+def readPackedInput(path) :
+    if path in (None, '-') :
+        if not hasattr(sys.stdin, 'buffer') :
+            raise ColorFormatError('--in-binary can\'t read from this stdin, use --input')
+        return sys.stdin.buffer.read()
+    with open(path, 'rb') as file :
+        if os.fstat(file.fileno()).st_size == 0 :
+            return b''
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+# Reads the header of packed records
+# RETURNS
+# the format of the records and how many there are
+# RAISES
+# ColorError if the header is missing, or describes records that aren't there
+def readPackedHeader(buffer) :
+    if len(buffer) < PACKED_HEADER.size :
+        raise ColorParseError('Input isn\'t packed records (no header)')
+    magic, version, colorFormat, count = PACKED_HEADER.unpack_from(buffer)
+    colorFormat = colorFormat.rstrip(b'\0').decode('ascii', 'replace')
+    if magic != PACKED_MAGIC :
+        raise ColorParseError('Input isn\'t packed records (see --out-binary)')
+    elif version != PACKED_VERSION :
+        raise ColorParseError(f'Unsupported packed records version {version} (expected {PACKED_VERSION})')
+    elif colorFormat not in PACKED_RECORDS :
+        raise ColorFormatError(f'Unknown packed records format: {colorFormat}')
+
+    available = (len(buffer) - PACKED_HEADER.size) // struct.calcsize(PACKED_RECORDS[colorFormat])
+    if count == PACKED_COUNT_UNKNOWN :
+        count = available
+    elif count > available :
+        raise ColorParseError(f'Packed records are cut short ({available} of {count} records)')
+    return colorFormat, count
+
+# Converts packed records (--in-binary). When the output is packed too (and numpy is available),
+# chunks of records are converted as arrays straight out of the memory-mapped input, without making
+# a Python object per color, otherwise they go through the same pipeline as color codes (see handleBulk())
+# ARGS
+# path: name of the input file, or None/'-' for stdin
+# outputFormats: list indicating which conversions to perform
+# RETURNS
+# truth if the input was packed records
+def handlePacked(path, outputFormats) :
+    sink = outputSink()
+    try :
+        buffer = readPackedInput(path)
+        colorFormat, count = readPackedHeader(buffer)
+    except ColorError as error :
+        print(describeColorError(error), end='', file=sys.stderr)
+        return False
+    except OSError as error :
+        print(f'ERROR: Could not read "{path or "stdin"}": {error.strerror or error}', file=sys.stderr)
+        return False
+
+    np = loadNumpy()
+    if not (isinstance(sink, PackedSink) and np) :
+        writeConversions(convertColors(readPackedColors(buffer, colorFormat, count), outputFormats))
+        return True
+
+    record = struct.Struct(PACKED_RECORDS[colorFormat])
+    dtype = np.dtype(np.uint8 if colorFormat in ('hex', 'rgb') else '<f4')
+    width = record.size // dtype.itemsize
+    records = np.frombuffer(buffer, dtype=dtype, count=count * width, offset=PACKED_HEADER.size).reshape(count, width)
+    sourceFormat = 'rgb' if colorFormat == 'hex' else colorFormat
+    for start in range(0, count, PACKED_CHUNK_SIZE) :
+        started = time.perf_counter()
+        chunk = records[start : start + PACKED_CHUNK_SIZE]
+        values, valid = batchValidatePacked(colorFormat, chunk)
+        if not valid.all() :
+            for i in np.flatnonzero(~valid).tolist() :
+                try :
+                    validatePackedRecord(colorFormat, chunk[i].tolist())
+                except ColorError as error :
+                    countInvalid(error)
+                    errorChannel().report(*errorRecord(error, start + i + 1, None, 'record'))
+            values = values[valid]
+
+        validated = time.perf_counter()
+        converted = batchConvert(sourceFormat, values, [sink.convertTo])
+        if RUN_STATS is not None :
+            RUN_STATS.times.update(validate=validated - started, convert=time.perf_counter() - validated)
+            RUN_STATS.counts['lines'] += len(chunk)
+            countConverted(colorFormat, len(values), outputFormats)
+        stageFunction(sink.writeArray, 'write')(converted[sink.convertTo])
+    return True
+
+# Validates packed records one by one, for the bulk pipeline
+# RETURNS
+# yields (format, validated values, None) for valid records and (None, error record, None) for
+# invalid ones, like parseColors()
+def readPackedColors(buffer, colorFormat, count) :
+    record = struct.Struct(PACKED_RECORDS[colorFormat])
+    records = memoryview(buffer)[PACKED_HEADER.size : PACKED_HEADER.size + (count * record.size)]
+    for index, values in enumerate(record.iter_unpack(records), 1) :
+        if RUN_STATS is not None :
+            RUN_STATS.counts['lines'] += 1
+        try :
+            yield colorFormat, validatePackedRecord(colorFormat, values), None
+        except ColorError as error :
+            countInvalid(error)
+            yield None, errorRecord(error, index, None, 'record'), None
+
+# Validates the values of a record like the validators validate the values of a color code
+# RETURNS
+# the validated values (a hex code string for Hex)
+def validatePackedRecord(colorFormat, values) :
+    if colorFormat == 'hex' :
+        return RGBtoHEX(values)
+    elif colorFormat == 'rgb' :
+        return list(values)
+    values = [widenFloat32(value) for value in values]
+    if not all(math.isfinite(value) for value in values) :
+        raise ColorRangeError(f'Each {colorFormat.upper()} value must be a finite number')
+    return validateColor('', colorFormat, values)
+
+# Vectorized validatePackedRecord(): takes an (N,3) or (N,4) array of records, returns an array of
+# their validated values (RGB values for Hex, see batchConvert()) and a mask of the valid ones
+def batchValidatePacked(colorFormat, records) :
+    np = loadNumpy()
+    if colorFormat in ('hex', 'rgb') :
+        return records.astype(np.int64), np.ones(len(records), dtype=bool)
+
+    values = batchWidenFloat32(records)
+    finite = np.isfinite(values).all(axis=1)
+    lower = 0
+    upper = 100
+    if colorFormat in ('hsl', 'hsv') :
+        # (clipping only keeps invalid hues from overflowing)
+        values[:, 0] = batchSmartRound(np.clip(np.where(finite, values[:, 0], 0), -1, 361))
+        upper = np.array([360, 100, 100])
+    elif colorFormat in CIE_RANGES :
+        # (adding 0.0 turns -0.0 into 0.0, like validateCIE())
+        values += 0.0
+        lower = np.array([lowest for _, lowest, _ in CIE_RANGES[colorFormat]])
+        upper = np.array([highest for _, _, highest in CIE_RANGES[colorFormat]])
+    return values, finite & ((values >= lower) & (values <= upper)).all(axis=1)
+
+# float32 can't hold most decimals exactly (12.34 is 12.340000152587891), so a packed value is
+# widened to the float nearest to the shortest decimal that rounds to it, which is what a color code
+# with that decimal would have been parsed as
+def widenFloat32(value) :
+    if math.isfinite(value) :
+        for decimals in range(PACKED_DECIMALS) :
+            rounded = round(value, decimals)
+            if PACKED_FLOAT.unpack(PACKED_FLOAT.pack(rounded))[0] == value :
+                return rounded
+    return value
+
+# Vectorized widenFloat32(): takes an array of float32s, returns an array of floats
+def batchWidenFloat32(values) :
+    np = loadNumpy()
+    exact = values.astype(np.float64)
+    widened = exact.copy()
+    pending = np.isfinite(exact)
+    with np.errstate(over='ignore', invalid='ignore') :
+        for decimals in range(PACKED_DECIMALS) :
+            if not pending.any() :
+                break
+            rounded = np.round(exact, decimals)
+            found = pending & (rounded.astype(np.float32) == values)
+            widened[found] = rounded[found]
+            pending &= ~found
+    return widened
+
+# Returns a float rounded to the given amount of decimals, exactly as the text output shows it
+def roundDecimals(value, precision) :
+    return float(f'{value:.{precision}f}')
+
+# Vectorized roundDecimals(): takes an array of floats, returns an array of floats
+def batchRoundDecimals(values, precision) :
+    np = loadNumpy()
+    rounded = np.round(values, precision)
+    # scaling values that are (almost) halfway between two decimals can round them the wrong way,
+    # so those get rounded one by one
+    halfway = np.abs(((values * (10.0 ** precision)) % 1) - 0.5) < 1e-6
+    for i in np.flatnonzero(halfway).tolist() :
+        rounded.flat[i] = roundDecimals(float(values.flat[i]), precision)
+    return rounded
+
+
+'''
+# IMAGE INPUT
+'''
+# --image reads the pixels of a netpbm image (PPM, PGM or PAM, binary or plain) and converts each
+# distinct color once, along with how many pixels have it, most common first. Counting is done in
+# bulk, so the conversions (and output) only depend on how many distinct colors there are.
+
+# a decoded image: its size, number of samples per pixel (1 gray, 2 gray and alpha, 3 RGB, 4 RGB and
+# alpha), the largest sample value, and a flat sequence of every sample
+Image = collections.namedtuple('Image', ['width', 'height', 'depth', 'maxval', 'samples'])
+# the magic number of each format: (its name, samples per pixel, whether its samples are plain text)
+# (PAM images say how many samples they have in their header)
+IMAGE_FORMATS = {b'P2': ('PGM', 1, True), b'P3': ('PPM', 3, True), b'P5': ('PGM', 1, False),
+                 b'P6': ('PPM', 3, False), b'P7': ('PAM', None, False)}
+# a number in a PPM/PGM header, after whitespace and comments
+IMAGE_HEADER_FIELD = re.compile(rb'(?:\s|#[^\n]*\n)*(\d+)')
+
+# Counts the colors of an image (see Image and IMAGE_FORMATS) and converts each distinct one
+# ARGS
+# path: name of the image file
+# outputFormats: list indicating which conversions to perform
+# top: only convert this many of the most common colors, or None for all of them
+# RETURNS
+# truth if the image could be read
+def handleImage(path, outputFormats, top = None) :
+    try :
+        image = stageFunction(readImage, 'read')(path)
+        colors, counts = stageFunction(imageHistogram, 'read')(image)
+    except ColorError as error :
+        print(describeColorError(error), end='', file=sys.stderr)
+        return False
+    except OSError as error :
+        print(f'ERROR: Could not read image "{path}": {error.strerror or error}', file=sys.stderr)
+        return False
+    if top is not None :
+        colors, counts = colors[:top], counts[:top]
+    if RUN_STATS is not None :
+        RUN_STATS.counts['lines'] += image.width * image.height
+
+    sink = outputSink()
+    for start in range(0, len(colors), BATCH_SIZE) :
+        rows = colors[start : start + BATCH_SIZE]
+        if LOOKUP_TABLES or (not loadNumpy()) :
+            resultRows = stageFunction(convertRows, 'convert')('rgb', rows, outputFormats)
+        else :
+            resultRows = stageFunction(batchConvertRows, 'convert')('rgb', rows, outputFormats)
+        if PALETTE_INDEX is not None :
+            stageFunction(matchNearest, 'convert')('rgb', rows, resultRows)
+        if RUN_STATS is not None :
+            countConverted('rgb', len(rows), outputFormats)
+        for count, results in zip(counts[start : start + BATCH_SIZE], resultRows) :
+            results['count'] = count
+            stageFunction(sink.write, 'write')(results)
+    return True
+
+# Reads a netpbm image
+# RETURNS
+# an Image
+# RAISES
+# ColorError if the file isn't a PPM, PGM or PAM image, or is cut short
+def readImage(path) :
+    with open(path, 'rb') as file :
+        data = file.read()
+    if data[:2] not in IMAGE_FORMATS :
+        raise ColorFormatError(f'"{path}" isn\'t a PPM, PGM or PAM image')
+    formatName, depth, plain = IMAGE_FORMATS[data[:2]]
+
+    if formatName == 'PAM' :
+        fields = {}
+        position = 2
+        while True :
+            end = data.find(b'\n', position)
+            if end < 0 :
+                raise ColorParseError(f'PAM image "{path}" has no ENDHDR line')
+            line = data[position : end].strip()
+            position = end + 1
+            if line == b'ENDHDR' :
+                break
+            elif line and not line.startswith(b'#') :
+                key, _, value = line.partition(b' ')
+                fields[key.decode('ascii', 'replace')] = value.strip()
+        try :
+            width, height, depth, maxval = [int(fields[key]) for key in ['WIDTH', 'HEIGHT', 'DEPTH', 'MAXVAL']]
+        except (KeyError, ValueError) :
+            raise ColorParseError(f'PAM image "{path}" needs WIDTH, HEIGHT, DEPTH and MAXVAL in its header') from None
+        if not (1 <= depth <= 4) :
+            raise ColorParseError(f'PAM image "{path}" has {depth} samples per pixel (only 1-4 are colors)')
+    else :
+        values = []
+        position = 2
+        for _ in range(3) :
+            match = IMAGE_HEADER_FIELD.match(data, position)
+            if match is None :
+                raise ColorParseError(f'{formatName} image "{path}" has an incomplete header')
+            values.append(int(match.group(1)))
+            position = match.end()
+        width, height, maxval = values
+        # (exactly one whitespace character separates the header from the pixels)
+        position += 1
+
+    if not (1 <= maxval <= 65535) :
+        raise ColorParseError(f'{formatName} image "{path}" has a maximum sample value of {maxval} (should be 1-65535)')
+    size = width * height * depth
+    if plain :
+        samples = [int(value) for value in data[position:].split()[:size]]
+    elif maxval < 256 :
+        samples = memoryview(data)[position : position + size]
+    else :
+        # 2 bytes per sample, most significant first
+        samples = array.array('H', data[position : position + (2 * size)])
+        if sys.byteorder == 'little' :
+            samples.byteswap()
+    if len(samples) < size :
+        raise ColorParseError(f'{formatName} image "{path}" is cut short ({len(samples) // depth} of {width * height} pixels)')
+    elif (maxval not in (255, 65535)) and (max(samples, default=0) > maxval) :
+        raise ColorRangeError(f'{formatName} image "{path}" has sample values above its maximum ({maxval})')
+    return Image(width, height, depth, maxval, samples)
+
+# Counts the distinct colors of an image (ignoring alpha), scaled to RGB values (0-255)
+# RETURNS
+# a list of distinct RGB values and a list of how many pixels have each one, most common first
+# (and in RGB order when as common)
+def imageHistogram(image) :
+    if loadNumpy() :
+        return batchImageHistogram(image)
+
+    samples = iter(image.samples)
+    # (counting tuples of samples happens in C, as does zipping them out of the samples)
+    pixels = collections.Counter(zip(*([samples] * image.depth)))
+    scaled = collections.Counter()
+    for pixel, count in pixels.items() :
+        rgbValues = pixel[:3] if image.depth >= 3 else pixel[:1] * 3
+        if image.maxval != 255 :
+            rgbValues = tuple([smartRound(value * 255 / image.maxval) for value in rgbValues])
+        scaled[rgbValues] += count
+
+    ordered = sorted(scaled.items(), key=lambda item : (-item[1], item[0]))
+    return [list(rgbValues) for rgbValues, _ in ordered], [count for _, count in ordered]
+
+# Vectorized imageHistogram()
+def batchImageHistogram(image) :
+    np = loadNumpy()
+    samples = np.asarray(image.samples).reshape(-1, image.depth)
+    # pack each pixel's color into one number, and count those
+    keyType, bits = (np.uint32, 8) if image.maxval < 256 else (np.uint64, 16)
+    if image.depth >= 3 :
+        keys = samples[:, 0].astype(keyType) << (2 * bits)
+        keys |= samples[:, 1].astype(keyType) << bits
+        keys |= samples[:, 2].astype(keyType)
+    else :
+        keys = samples[:, 0]
+    keys, counts = np.unique(keys, return_counts=True)
+    keys = keys.astype(np.int64)
+    if image.depth >= 3 :
+        mask = (1 << bits) - 1
+        rgbValues = np.stack([keys >> (2 * bits), (keys >> bits) & mask, keys & mask], axis=1)
+    else :
+        rgbValues = np.repeat(keys[:, None], 3, axis=1)
+
+    # scaling can map several sample values to the same RGB value, so those get merged
+    if image.maxval != 255 :
+        rgbValues = batchSmartRound((rgbValues * 255) / image.maxval)
+        keys = (rgbValues[:, 0] << 16) | (rgbValues[:, 1] << 8) | rgbValues[:, 2]
+        keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        counts = np.bincount(inverse.reshape(-1), weights=counts).astype(np.int64)
+        rgbValues = rgbValues[first]
+
+    order = np.lexsort((rgbValues[:, 2], rgbValues[:, 1], rgbValues[:, 0], -counts))
+    return rgbValues[order].tolist(), counts[order].tolist()
+
+
+'''
+# PALETTE MATCHING
+'''
+
+# With --palette FILE --nearest, every color is matched to the closest color of a palette (a file of
+# color codes, one per line, in any of the input formats) by their CIE76 distance: the distance
+# between their L*a*b* values. The palette's colors are put in a k-d tree, which finds the nearest
+# one in roughly logarithmic time rather than comparing against every palette color.
+#
+# The tree is saved next to the palette (FILE.kdtree) and reused as long as the palette and the
+# conversion code stay the same. The file is a header (see PALETTE_INDEX_HEADER), the L*a*b* values
+# of the tree's nodes as little-endian float64s, the palette color of each node as uint32s, and the
+# palette's color codes as UTF-8 lines.
+
+PALETTE_INDEX_MAGIC = b'CCKDTREE'
+PALETTE_INDEX_VERSION = 1
+PALETTE_INDEX_SUFFIX = '.kdtree'
+# magic, version, size and CRC-32 of the palette file, number of nodes, probe checksum
+PALETTE_INDEX_HEADER = struct.Struct('<8sHQIII')
+# colors whose L*a*b* values are checked when an index is opened, so an index saved by a different
+# version of the conversion code gets rebuilt
+PALETTE_PROBES = [[0, 0, 0], [255, 255, 255], [133, 254, 171], [18, 52, 86], [250, 189, 47]]
+
+# the index of the --palette file, set up in main()
+PALETTE_INDEX = None
+
+# A k-d tree over the L*a*b* values of a palette's colors, stored flat: the nodes of the subtree at
+# positions lo..hi-1 are split at the node at mid = (lo + hi) // 2, on L, a or b in turn as the tree
+# gets deeper, with the nodes before mid on its lower side and those after it on its upper side
+class PaletteIndex :
+    # ARGS
+    # entries: the color codes of the palette
+    # coordinates: the L*a*b* values of the nodes, flattened ([L, a, b, L, a, b, ...])
+    # nodeEntries: which palette color each node is (an index into entries)
+    # key: the (size, checksum) of the palette file, which tells palettes apart in cache keys
+    def __init__(self, entries, coordinates, nodeEntries, key) :
+        self.entries = entries
+        self.coordinates = coordinates
+        self.nodeEntries = nodeEntries
+        self.key = key
+
+    # Takes in L*a*b* values, returns a tuple of the color code of the nearest palette color and its
+    # distance (the palette color listed first, when several are equally near)
+    def nearest(self, labValues) :
+        point = labValues
+        coordinates = self.coordinates
+        nodeEntries = self.nodeEntries
+        bestDistance = math.inf
+        bestEntry = -1
+
+        # subtrees still to search, as (lo, hi, axis, squared distance from the point to the subtree's
+        # side of its parent's split, which no node in it can be nearer than)
+        pending = [(0, len(nodeEntries), 0, 0.0)]
+        while pending :
+            lo, hi, axis, bound = pending.pop()
+            if (lo >= hi) or (bound > bestDistance) :
+                continue
+            mid = (lo + hi) >> 1
+            base = mid * 3
+            dl = point[0] - coordinates[base]
+            da = point[1] - coordinates[base + 1]
+            db = point[2] - coordinates[base + 2]
+            distance = (dl * dl) + (da * da) + (db * db)
+            if (distance < bestDistance) or ((distance == bestDistance) and (nodeEntries[mid] < bestEntry)) :
+                bestDistance = distance
+                bestEntry = nodeEntries[mid]
+
+            # search the side of the split the point is on first (it's popped next)
+            split = point[axis] - coordinates[base + axis]
+            nextAxis = (axis + 1) % 3
+            if split < 0 :
+                pending.append((mid + 1, hi, nextAxis, split * split))
+                pending.append((lo, mid, nextAxis, 0.0))
+            else :
+                pending.append((lo, mid, nextAxis, split * split))
+                pending.append((mid + 1, hi, nextAxis, 0.0))
+
+        return self.entries[bestEntry], math.sqrt(bestDistance)
+
+# Adds the nearest palette color (see PaletteIndex.nearest()) to the results maps of colors of one format
+# ARGS
+# colorFormat: the format of the colors
+# rows: their validated values
+# resultRows: their results maps (see convertRows())
+def matchNearest(colorFormat, rows, resultRows) :
+    if colorFormat == 'lab' :
+        labRows = rows
+    elif resultRows and ('lab' in resultRows[0]) :
+        labRows = [results['lab'] for results in resultRows]
+    elif loadNumpy() and (len(rows) > 1) :
+        labRows = batchConvert(colorFormat, rows, ['lab'])['lab'].tolist()
+    else :
+        labRows = [convertValues(colorFormat, row, ['lab'])['lab'] for row in rows]
+
+    for results, labValues in zip(resultRows, labRows) :
+        results['nearest'] = PALETTE_INDEX.nearest(labValues)
+
+# Opens the saved index of a palette file, or builds (and saves) it if there's no up to date one
+# ARGS
+# path: the palette file
+# save: whether to save an index it had to build (next to the palette, see PALETTE_INDEX_SUFFIX)
+# RETURNS
+# a PaletteIndex
+# RAISES
+# OSError if the palette can't be read, ColorError if it has no valid colors
+def loadPaletteIndex(path, save = True) :
+    with open(path, 'rb') as file :
+        data = file.read()
+    key = (len(data), zlib.crc32(data))
+    indexPath = path + PALETTE_INDEX_SUFFIX
+
+    index = readPaletteIndex(indexPath, key)
+    if index is None :
+        index = buildPaletteIndex(data.decode('utf-8'), key, path)
+        if not save :
+            return index
+        try :
+            writePaletteIndex(indexPath, index)
+        except OSError as error :
+            print(f'WARNING: Could not save the palette index "{indexPath}": {error.strerror or error}', file=sys.stderr)
+    return index
+
+# Parses the colors of a palette and builds their k-d tree, palette lines that aren't valid colors
+# are reported to stderr and skipped
+# ARGS
+# text: the contents of the palette file
+# key: see PaletteIndex
+# path: the name of the palette file, for messages
+# RETURNS
+# a PaletteIndex
+# RAISES
+# ColorError if there are no valid colors
+def buildPaletteIndex(text, key, path = 'palette') :
+    entries = []
+    points = []
+    for lineNumber, color in readColorCodes(io.StringIO(text, newline=None)) :
+        colorFormat, tokens = tokenizeColor(color)
+        if colorFormat is None :
+            print(f'Palette line {lineNumber}: ERROR: Could not detect the color format of "{color}"', file=sys.stderr)
+            continue
+        try :
+            validated = validateColor(color, colorFormat, tokens)
+        except ColorError as error :
+            print(f'Palette line {lineNumber}: ' + describeColorError(error), end='', file=sys.stderr)
+            continue
+        labValues = convertValues(colorFormat, validated, ['lab'])['lab']
+        points.append((labValues[0], labValues[1], labValues[2], len(entries)))
+        entries.append(color)
+    if not entries :
+        raise ColorParseError(f'No valid colors in palette "{path}"')
+
+    # each subtree's points are sorted on its axis and split at the median (ties in palette order,
+    # so the tree only depends on the palette)
+    nodes = [None] * len(points)
+    pending = [(0, len(points), 0, points)]
+    while pending :
+        lo, hi, axis, subtree = pending.pop()
+        if not subtree :
+            continue
+        subtree = sorted(subtree, key=lambda point : (point[axis], point[3]))
+        half = len(subtree) >> 1
+        nodes[lo + half] = subtree[half]
+        pending.append((lo, lo + half, (axis + 1) % 3, subtree[:half]))
+        pending.append((lo + half + 1, hi, (axis + 1) % 3, subtree[half + 1:]))
+
+    coordinates = [value for node in nodes for value in node[:3]]
+    return PaletteIndex(entries, coordinates, [node[3] for node in nodes], key)
+
+# Returns the checksum of the L*a*b* values of PALETTE_PROBES, as computed by the current conversion code
+def paletteProbeChecksum() :
+    probes = [convertValues('rgb', probe, ['lab'])['lab'] for probe in PALETTE_PROBES]
+    return zlib.crc32(struct.pack(f'<{len(probes) * 3}d', *[value for labValues in probes for value in labValues]))
+
+# Writes an index to a file (through a temporary file, so a half-written index is never read)
+def writePaletteIndex(path, index) :
+    coordinates = array.array('d', index.coordinates)
+    nodeEntries = array.array('I', index.nodeEntries)
+    if sys.byteorder == 'big' :
+        coordinates.byteswap()
+        nodeEntries.byteswap()
+
+    temporaryPath = f'{path}.{os.getpid()}.tmp'
+    try :
+        with open(temporaryPath, 'wb') as file :
+            file.write(PALETTE_INDEX_HEADER.pack(PALETTE_INDEX_MAGIC, PALETTE_INDEX_VERSION, index.key[0], index.key[1],
+                                                 len(index.nodeEntries), paletteProbeChecksum()))
+            file.write(coordinates.tobytes())
+            file.write(nodeEntries.tobytes())
+            file.write('\n'.join(index.entries).encode('utf-8'))
+        os.replace(temporaryPath, path)
+    except OSError :
+        with contextlib.suppress(OSError) :
+            os.remove(temporaryPath)
+        raise
+
+# Reads an index written by writePaletteIndex()
+# RETURNS
+# a PaletteIndex, or None if there's no index or it isn't for this palette (key) and conversion code
+def readPaletteIndex(path, key) :
+    try :
+        with open(path, 'rb') as file :
+            data = file.read()
+    except OSError :
+        return None
+    if len(data) < PALETTE_INDEX_HEADER.size :
+        return None
+    magic, version, size, checksum, count, probeChecksum = PALETTE_INDEX_HEADER.unpack_from(data)
+    if (magic != PALETTE_INDEX_MAGIC) or (version != PALETTE_INDEX_VERSION) or ((size, checksum) != key) :
+        return None
+    if probeChecksum != paletteProbeChecksum() :
+        return None
+
+    coordinates = array.array('d')
+    nodeEntries = array.array('I')
+    start = PALETTE_INDEX_HEADER.size
+    middle = start + (count * 3 * coordinates.itemsize)
+    end = middle + (count * nodeEntries.itemsize)
+    if len(data) < end :
+        return None
+    coordinates.frombytes(data[start:middle])
+    nodeEntries.frombytes(data[middle:end])
+    if sys.byteorder == 'big' :
+        coordinates.byteswap()
+        nodeEntries.byteswap()
+    entries = data[end:].decode('utf-8').split('\n')
+    if max(nodeEntries, default=0) >= len(entries) :
+        return None
+    return PaletteIndex(entries, coordinates.tolist(), nodeEntries.tolist(), key)
+
+
+'''
+# COLOR TABLES
+'''
+
+# A ColorTable holds converted colors column by column, in one array per channel of each format
+# (named like the CSV columns, e.g. 'hsl.h', with Hex codes as 24-bit integers), so a color takes a
+# few bytes per channel rather than a results map of lists. It answers unique(), sortBy() and where()
+# queries with views that share its columns. Sorting and range filters go through a sorted index of
+# the column (its rows ordered by value), which is built the first time a query needs it and reused
+# after, and the filters find their range in it with a binary search. NumPy builds the indexes and
+# runs the queries on whole columns when it's available.
+#
+# --unique, --sort and --where collect the colors into a table through a TableSink, and once the input
+# is done write out the rows the query selects through the real sink, formatted exactly as they would
+# have been otherwise. Formats only used by the query get converted but not output.
+
+# each channel's column, e.g. 'hsl.h': ('hsl', 0)
+TABLE_COLUMNS = {('hex' if colorFormat == 'hex' else colorFormat + '.' + channel) : (colorFormat, i)
+                 for colorFormat in TYPES for i, channel in enumerate(CHANNELS[colorFormat])}
+# array type codes of the columns of a format (Hex codes as integers, and RGB as bytes)
+TABLE_TYPECODES = {'hex': 'L', 'rgb': 'B'}
+# a --where condition, e.g. "hsv.v < 20"
+WHERE_PATTERN = re.compile(r'\s*([a-z]+(?:\.[a-z])?)\s*(<=|>=|==|!=|<|>|=)\s*(\S+)\s*$')
+
+class ColorTable :
+    # ARGS
+    # formats: the formats the table holds (results maps appended to it need every one of them)
+    def __init__(self, formats = TYPES) :
+        self.formats = [colorFormat for colorFormat in TYPES if colorFormat in formats]
+        self.names = [name for name, (colorFormat, _) in TABLE_COLUMNS.items() if colorFormat in self.formats]
+        self.columns = {name : array.array(TABLE_TYPECODES.get(TABLE_COLUMNS[name][0], 'd')) for name in self.names}
+        self.formatColumns = [(colorFormat, [self.columns[name] for name in self.names if TABLE_COLUMNS[name][0] == colorFormat])
+                              for colorFormat in self.formats]
+        # a bit per float channel (in order) set when its value was an int, as they're output differently
+        self.intFlags = array.array('L')
+        # the other keys of the results maps (e.g. 'count' or 'nearest'), as lists with None for rows
+        # that didn't have them
+        self.extras = {}
+        self.length = 0
+        # (shared with the views, see index() and ranks())
+        self.indexes = {}
+        self.rankings = {}
+        # the rows of this view in order, or None for every row
+        self.selection = None
+
+    def __len__(self) :
+        return self.length if self.selection is None else len(self.selection)
+
+    # Adds a color
+    # ARGS
+    # results: a results map (see convertRows()) with every format of the table
+    def append(self, results) :
+        flags = 0
+        bit = 1
+        for colorFormat, columns in self.formatColumns :
+            values = results[colorFormat]
+            if colorFormat == 'hex' :
+                columns[0].append(int(values, 16))
+                continue
+            for column, value in zip(columns, values) :
+                column.append(value)
+                if colorFormat != 'rgb' :
+                    if type(value) is int :
+                        flags |= bit
+                    bit <<= 1
+        self.intFlags.append(flags)
+
+        for key, column in self.extras.items() :
+            column.append(results.get(key))
+        if len(results) > len(self.formats) + len(self.extras) :
+            for key, value in results.items() :
+                if (key not in self.extras) and (key not in TABLE_COLUMNS) and (key not in COLOR_TYPES) :
+                    self.extras[key] = [None] * self.length + [value]
+        self.length += 1
+        if self.indexes or self.rankings :
+            self.indexes.clear()
+            self.rankings.clear()
+
+    # Returns the results map of a row, as it was appended
+    def row(self, row) :
+        results = {}
+        flags = self.intFlags[row]
+        bit = 1
+        for colorFormat, columns in self.formatColumns :
+            if colorFormat == 'hex' :
+                results['hex'] = '%06x' % columns[0][row]
+            elif colorFormat == 'rgb' :
+                results['rgb'] = [column[row] for column in columns]
+            else :
+                values = []
+                for column in columns :
+                    values.append(int(column[row]) if flags & bit else column[row])
+                    bit <<= 1
+                results[colorFormat] = values
+        for key, column in self.extras.items() :
+            if column[row] is not None :
+                results[key] = column[row]
+        return results
+
+    # Yields the results map of each row of the view, in order
+    def rows(self) :
+        rows = self.selectedRows()
+        # (plain ints index the columns faster than NumPy's)
+        for row in (rows.tolist() if hasattr(rows, 'tolist') else rows) :
+            yield self.row(row)
+
+    # Returns the row numbers of the view (a list, or an array with NumPy)
+    def selectedRows(self) :
+        if self.selection is not None :
+            return self.selection
+        np = loadNumpy()
+        return np.arange(self.length) if np else range(self.length)
+
+    # Returns the values of a column for the rows of the view, in order (a list, or an array with NumPy)
+    def selectedColumn(self, name) :
+        column = self.columns[name]
+        np = loadNumpy()
+        if np :
+            values = np.frombuffer(column, dtype=column.typecode) if self.length else np.zeros(0, dtype=column.typecode)
+            return values if self.selection is None else values[np.asarray(self.selection, dtype=np.int64)]
+        return list(column) if self.selection is None else [column[row] for row in self.selection]
+
+    # Returns a view of the given rows, in the given order
+    def select(self, rows) :
+        view = ColorTable.__new__(ColorTable)
+        view.__dict__ = dict(self.__dict__, selection=rows)
+        return view
+
+    # Returns the sorted index of a column: its rows in order of value (rows with the same value in
+    # their original order), and the values in that order
+    def index(self, name) :
+        if name not in self.indexes :
+            column = self.columns[name]
+            np = loadNumpy()
+            if np :
+                values = np.frombuffer(column, dtype=column.typecode) if self.length else np.zeros(0)
+                order = np.argsort(values, kind='stable')
+                self.indexes[name] = (order, values[order])
+            else :
+                order = sorted(range(self.length), key=column.__getitem__)
+                self.indexes[name] = (order, [column[row] for row in order])
+        return self.indexes[name]
+
+    # Returns the dense rank of each row in a column (equal values get the same rank), from its index
+    def ranks(self, name) :
+        if name not in self.rankings :
+            order, values = self.index(name)
+            np = loadNumpy()
+            if np :
+                steps = np.empty(len(values), dtype=np.int64)
+                steps[:1] = 0
+                steps[1:] = values[1:] != values[:-1]
+                ranks = np.empty(len(values), dtype=np.int64)
+                ranks[order] = np.cumsum(steps)
+            else :
+                ranks = [0] * self.length
+                rank = 0
+                for i, row in enumerate(order) :
+                    if i and (values[i] != values[i - 1]) :
+                        rank += 1
+                    ranks[row] = rank
+            self.rankings[name] = ranks
+        return self.rankings[name]
+
+    # Returns a view of the rows whose value in a column compares to value with op (one of <, <=, >,
+    # >=, == and !=), in the order of this view
+    def where(self, name, op, value) :
+        order, values = self.index(name)
+        np = loadNumpy()
+        if np :
+            low, high = int(np.searchsorted(values, value, 'left')), int(np.searchsorted(values, value, 'right'))
+        else :
+            low, high = bisect.bisect_left(values, value), bisect.bisect_right(values, value)
+        ranges = {'<': [(0, low)], '<=': [(0, high)], '>': [(high, len(values))], '>=': [(low, len(values))],
+                  '==': [(low, high)], '!=': [(0, low), (high, len(values))]}[op]
+
+        if np :
+            matched = np.zeros(self.length, dtype=bool)
+            for start, end in ranges :
+                matched[order[start:end]] = True
+            rows = np.asarray(self.selectedRows())
+            return self.select(rows[matched[rows]])
+        matched = bytearray(self.length)
+        for start, end in ranges :
+            for row in order[start:end] :
+                matched[row] = 1
+        return self.select([row for row in self.selectedRows() if matched[row]])
+
+    # Returns a view of the first row (in the order of this view) of each distinct color
+    # ARGS
+    # names: the columns that make a color distinct, or None for all of them
+    def unique(self, names = None) :
+        names = names or self.names
+        rows = self.selectedRows()
+        np = loadNumpy()
+        if np :
+            rows = np.asarray(rows)
+            if len(rows) == 0 :
+                return self.select(rows)
+            # (adding 0.0 turns -0.0 into 0.0, which compares equal to it but isn't the same bytes)
+            colors = np.column_stack([np.frombuffer(self.columns[name], dtype=self.columns[name].typecode)[rows].astype(np.float64) + 0.0 for name in names])
+            _, first = np.unique(colors, axis=0, return_index=True)
+            return self.select(rows[np.sort(first)])
+        seen = set()
+        unique = []
+        columns = [self.columns[name] for name in names]
+        for row in rows :
+            color = tuple(column[row] for column in columns)
+            if color not in seen :
+                seen.add(color)
+                unique.append(row)
+        return self.select(unique)
+
+    # Returns a view of the rows sorted by one or more columns (a '-' in front of a column's name sorts
+    # it in descending order), rows that are equal keep the order of this view
+    def sortBy(self, *keys) :
+        keys = [(key[1:], True) if key.startswith('-') else (key, False) for key in keys]
+        if (len(keys) == 1) and (not keys[0][1]) and (self.selection is None) :
+            return self.select(self.index(keys[0][0])[0])
+        rows = self.selectedRows()
+        np = loadNumpy()
+        if np :
+            rows = np.asarray(rows)
+            # (lexsort sorts by its last key first)
+            sortKeys = [-self.ranks(name)[rows] if descending else self.ranks(name)[rows] for name, descending in reversed(keys)]
+            return self.select(rows[np.lexsort(sortKeys)] if len(rows) else rows)
+        rankings = [(self.ranks(name), -1 if descending else 1) for name, descending in keys]
+        return self.select(sorted(rows, key=lambda row : tuple(sign * ranks[row] for ranks, sign in rankings)))
+
+# Parses --unique, --sort and --where into the steps of a table query: where each condition, then
+# unique, then sort
+# ARGS
+# unique: keep only the first of each distinct color (by the output formats' columns)
+# sort: comma separated column names to sort by ('-' in front for descending), or None
+# conditions: list of conditions like "hsv.v < 20" (a Hex code for the 'hex' column), or None
+# outputFormats: list of the formats that will be output
+# RETURNS
+# a tuple of the list of steps (method name, arguments), and the list of formats the query needs
+# RAISES
+# ColorParseError for an unknown column or a malformed condition
+def parseTableQuery(unique, sort, conditions, outputFormats) :
+    steps = []
+    names = []
+    for condition in conditions or [] :
+        match = WHERE_PATTERN.match(condition.lower())
+        if match is None :
+            raise ColorParseError(f'Improper --where condition: "{condition}" (should be like "hsv.v < 20")')
+        name, op, value = match.groups()
+        try :
+            value = int(value.lstrip('#'), 16) if (name == 'hex') and HEX_PATTERN.fullmatch(value.lstrip('#')) else float(value)
+        except ValueError :
+            raise ColorParseError(f'Improper --where value: "{condition}" (should be a number, or a Hex code for hex)')
+        steps.append(('where', (name, '==' if op == '=' else op, value)))
+        names.append(name)
+    if unique :
+        steps.append(('unique', ([name for name, (colorFormat, _) in TABLE_COLUMNS.items() if colorFormat in outputFormats],)))
+    if sort :
+        keys = [key.strip() for key in sort.lower().split(',')]
+        steps.append(('sortBy', tuple(keys)))
+        names.extend(key.lstrip('-') for key in keys)
+
+    for name in names :
+        if name not in TABLE_COLUMNS :
+            raise ColorParseError(f'Unknown column: "{name}" (one of {", ".join(TABLE_COLUMNS)})')
+    formats = [colorFormat for colorFormat in TYPES if (colorFormat in outputFormats) or any(TABLE_COLUMNS[name][0] == colorFormat for name in names)]
+    return steps, formats
+
+# A TableSink takes the place of the output sink for a table query, collecting the colors into a
+# ColorTable, and writes the rows the query selects through the real sink when it's closed
+class TableSink :
+    # ARGS
+    # sink: the sink to write the selected rows through
+    # formats: the formats the table holds
+    # steps: the steps of the query, see parseTableQuery()
+    def __init__(self, sink, formats, steps) :
+        self.sink = sink
+        self.table = ColorTable(formats)
+        self.steps = steps
+        # there's no formatted output for CONVERSION_CACHE to reuse
+        self.cacheKey = None
+
+    # adds a map of converted values to the table
+    def write(self, convertedValues) :
+        self.table.append(convertedValues)
+
+    # (the bulk pipeline formats and then writes, so this adds the color and leaves nothing to write)
+    def formatColor(self, convertedValues) :
+        self.table.append(convertedValues)
+        return None
+
+    def writeFormatted(self, text) :
+        pass
+
+    # (nothing is written until the table is complete)
+    def flush(self) :
+        pass
+
+    # Returns the view of the table the query selects
+    def query(self) :
+        table = self.table
+        for method, arguments in self.steps :
+            table = getattr(table, method)(*arguments)
+        return table
+
+    # runs the query, writes the selected rows and closes the real sink
+    def close(self) :
+        try :
+            for results in self.query().rows() :
+                self.sink.write(results)
+        finally :
+            self.sink.close()
+
+
+'''
+# CONTRAST
+'''
+
+# --contrast audits a palette for accessibility: it outputs the WCAG 2 contrast ratio of every pair of
+# its colors, (L1 + 0.05) / (L2 + 0.05) where L1 is the relative luminance of the lighter one. The
+# colors are read and converted to RGB like any other input (collected into a ColorTable, so --where,
+# --unique and --sort pick and order them), and the luminance of each is worked out once, through
+# SRGB_TO_LINEAR. The ratios are then computed a block of rows at a time (with NumPy, as whole
+# arrays) and written out before the next block, so memory only grows with the number of colors, not
+# the number of pairs. The output is CSV: the whole matrix, or with --min-ratio R only the pairs whose
+# ratio is at least R.
+
+# WCAG's weights of the linear red, green and blue channels in the relative luminance
+LUMINANCE_WEIGHTS = (0.2126, 0.7152, 0.0722)
+# how many ratios are computed (and formatted) at once
+CONTRAST_BLOCK_SIZE = 1 << 20
+
+# A TableSink that writes the contrast matrix (or pairs) of the selected colors when it's closed,
+# rather than the colors
+class ContrastSink(TableSink) :
+    # ARGS
+    # sink: a text OutputSink to write the CSV through
+    # formats: the formats the table holds (Hex, RGB and any the query needs)
+    # steps: the steps of the query, see parseTableQuery()
+    # minRatio: only output the pairs with at least this ratio, or None for the whole matrix
+    # precision: number of decimals to write the ratios with
+    def __init__(self, sink, formats, steps, minRatio, precision) :
+        super().__init__(sink, formats, steps)
+        self.minRatio = minRatio
+        self.precision = precision
+
+    def close(self) :
+        try :
+            table = self.query()
+            codes = table.selectedColumn('hex')
+            labels = ['#%06x' % code for code in (codes.tolist() if hasattr(codes, 'tolist') else codes)]
+            luminance = tableLuminance(table)
+            if self.minRatio is None :
+                writeContrastMatrix(self.sink, labels, luminance, self.precision)
+            else :
+                writeContrastPairs(self.sink, labels, luminance, self.minRatio, self.precision)
+        finally :
+            self.sink.close()
+
+# Returns the relative luminance of each selected row of a table (a list, or an array with NumPy)
+def tableLuminance(table) :
+    np = loadNumpy()
+    red, green, blue = [table.selectedColumn(name) for name in ('rgb.r', 'rgb.g', 'rgb.b')]
+    redWeight, greenWeight, blueWeight = LUMINANCE_WEIGHTS
+    if np :
+        global SRGB_TO_LINEAR_ARRAY
+        if SRGB_TO_LINEAR_ARRAY is None :
+            SRGB_TO_LINEAR_ARRAY = np.array(SRGB_TO_LINEAR)
+        linear = SRGB_TO_LINEAR_ARRAY
+        return (redWeight * linear[red]) + (greenWeight * linear[green]) + (blueWeight * linear[blue])
+    linear = SRGB_TO_LINEAR
+    return [(redWeight * linear[r]) + (greenWeight * linear[g]) + (blueWeight * linear[b]) for r, g, b in zip(red, green, blue)]
+
+# Yields the contrast ratios of a few rows of colors at a time against every color
+# ARGS
+# luminance: the relative luminance of each color, see tableLuminance()
+# RETURNS
+# yields (first row, block) tuples, where block is a list of rows of ratios (an array with NumPy)
+def contrastBlocks(luminance) :
+    count = len(luminance)
+    rows = max(CONTRAST_BLOCK_SIZE // max(count, 1), 1)
+    np = loadNumpy()
+    for start in range(0, count, rows) :
+        block = luminance[start : start + rows]
+        if np :
+            lighter = np.maximum(block[:, None], luminance[None, :])
+            darker = np.minimum(block[:, None], luminance[None, :])
+            yield start, (lighter + 0.05) / (darker + 0.05)
+        else :
+            yield start, [[(max(a, b) + 0.05) / (min(a, b) + 0.05) for b in luminance] for a in block]
+
+# Writes the contrast ratio of every pair of colors as a CSV matrix, with the colors as the first row
+# and column
+def writeContrastMatrix(sink, labels, luminance, precision) :
+    sink.writeFormatted(','.join([''] + labels) + '\n')
+    # (a single % formats a whole row of ratios)
+    template = '%s,' + ','.join([f'%.{precision}f'] * len(labels)) + '\n'
+    for start, block in contrastBlocks(luminance) :
+        rows = block.tolist() if hasattr(block, 'tolist') else block
+        sink.writeFormatted(''.join([template % (labels[start + i], *ratios) for i, ratios in enumerate(rows)]))
+
+# Writes each pair of colors with a contrast ratio of at least minRatio (once, with the first color
+# in input order as the foreground) as CSV
+def writeContrastPairs(sink, labels, luminance, minRatio, precision) :
+    sink.writeFormatted('foreground,background,ratio\n')
+    template = f'%s,%s,%.{precision}f\n'
+    np = loadNumpy()
+    for start, block in contrastBlocks(luminance) :
+        if np :
+            # (only pairs above the diagonal, so each pair comes once)
+            rows, columns = np.nonzero((block >= minRatio) & (np.arange(len(labels))[None, :] > np.arange(start, start + len(block))[:, None]))
+            pairs = zip((rows + start).tolist(), columns.tolist(), block[rows, columns].tolist())
+        else :
+            pairs = ((start + i, j, ratio) for i, ratios in enumerate(block) for j, ratio in enumerate(ratios)
+                     if (j > start + i) and (ratio >= minRatio))
+        sink.writeFormatted(''.join([template % (labels[i], labels[j], ratio) for i, j, ratio in pairs]))
+
+
+'''
+# QUANTIZATION
+'''
+
+# --quantize K reduces the input colors to a palette of K representative colors. The colors are
+# only counted as they stream by, in a ColorHistogram of their 24-bit RGB codes, so memory depends on
+# how many distinct colors there are (at most 2^24) rather than on how many were read. The palette
+# is then worked out from the histogram, in CIE L*a*b* (where distances follow perceived
+# differences), with each distinct color weighted by its count:
+#   median-cut  repeatedly splits the box of colors with the most variance in two at the weighted
+#               median of its widest axis, then takes the weighted mean of each box
+#   kmeans      mini-batch k-means: seeds the centers with k-means++, then moves them towards
+#               batches of colors sampled by count, so each iteration costs the same however big
+#               the histogram is, and finally assigns every distinct color to its nearest center
+# Each palette color is output (most common first) in the requested formats, with how many input
+# colors it stands for as its count. NumPy does the work on whole arrays when it's available.
+
+QUANTIZE_METHODS = ['median-cut', 'kmeans']
+# how many colors the histogram takes before merging them into its counts (with NumPy)
+QUANTIZE_BUFFER_SIZE = 1 << 20
+# colors per mini-batch, number of mini-batches, and colors sampled to seed the centers from
+KMEANS_BATCH_SIZE = 4096
+KMEANS_ITERATIONS = 100
+KMEANS_SEED_SAMPLE = 16384
+# the random seed, so the same input always gives the same palette
+KMEANS_SEED = 0
+# how many colors are assigned to their nearest center at once
+KMEANS_BLOCK_SIZE = 1 << 16
+
+# The distinct colors seen and how many times, as 24-bit RGB codes. With NumPy they're kept as sorted
+# arrays, and new colors are buffered and merged in QUANTIZE_BUFFER_SIZE at a time.
+class ColorHistogram :
+    def __init__(self) :
+        np = loadNumpy()
+        self.counter = None if np else collections.Counter()
+        self.codes = np.zeros(0, dtype=np.int64) if np else None
+        self.counts = np.zeros(0, dtype=np.int64) if np else None
+        self.pendingCodes = array.array('L')
+        self.pendingCounts = array.array('L')
+
+    # Counts a color
+    # ARGS
+    # code: its 24-bit RGB code
+    # count: how many times it was seen
+    def add(self, code, count = 1) :
+        if self.counter is not None :
+            self.counter[code] += count
+            return
+        self.pendingCodes.append(code)
+        self.pendingCounts.append(count)
+        if len(self.pendingCodes) >= QUANTIZE_BUFFER_SIZE :
+            self.merge()
+
+    # Counts many colors at once
+    # ARGS
+    # codes: a sequence (or array) of 24-bit RGB codes
+    # counts: how many times each was seen, or None for once
+    def addCodes(self, codes, counts = None) :
+        np = loadNumpy()
+        if self.counter is not None :
+            if counts is None :
+                self.counter.update(codes)
+            else :
+                for code, count in zip(codes, counts) :
+                    self.counter[code] += count
+            return
+        codes = np.asarray(codes, dtype=np.int64)
+        self.merge(codes, np.ones(len(codes), dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64))
+
+    # Merges the buffered colors (and any others given) into the counts
+    def merge(self, codes = None, counts = None) :
+        np = loadNumpy()
+        allCodes = [self.codes, np.frombuffer(self.pendingCodes, dtype=self.pendingCodes.typecode).astype(np.int64) if self.pendingCodes else self.codes[:0]]
+        allCounts = [self.counts, np.frombuffer(self.pendingCounts, dtype=self.pendingCounts.typecode).astype(np.int64) if self.pendingCounts else self.counts[:0]]
+        if codes is not None :
+            allCodes.append(codes)
+            allCounts.append(counts)
+        self.codes, inverse = np.unique(np.concatenate(allCodes), return_inverse=True)
+        self.counts = np.bincount(inverse.reshape(-1), weights=np.concatenate(allCounts), minlength=len(self.codes)).astype(np.int64)
+        self.pendingCodes = array.array('L')
+        self.pendingCounts = array.array('L')
+
+    # Returns the distinct codes, in ascending order, and their counts (lists, or arrays with NumPy)
+    def items(self) :
+        if self.counter is not None :
+            codes = sorted(self.counter)
+            return codes, [self.counter[code] for code in codes]
+        if self.pendingCodes :
+            self.merge()
+        return self.codes, self.counts
+
+# Works out the palette of a histogram
+# ARGS
+# histogram: a ColorHistogram
+# k: the number of palette colors (fewer if there aren't that many distinct colors)
+# method: one of QUANTIZE_METHODS
+# RETURNS
+# a list of (L*a*b* values, number of colors) tuples, most common first
+def quantizeColors(histogram, k, method) :
+    codes, counts = histogram.items()
+    if len(codes) == 0 :
+        return []
+    np = loadNumpy()
+    if np :
+        rgb = np.stack([(codes >> 16) & 255, (codes >> 8) & 255, codes & 255], axis=1)
+        points = batchConvert('rgb', rgb, ['lab'])['lab']
+        weights = counts.astype(np.float64)
+        centers, populations = (batchMedianCut if method == 'median-cut' else batchKMeans)(points, weights, k)
+        clusters = list(zip(centers.tolist(), np.rint(populations).astype(np.int64).tolist()))
+    else :
+        points = [convertValues('rgb', [code >> 16, (code >> 8) & 255, code & 255], ['lab'])['lab'] for code in codes]
+        clusters = (medianCut if method == 'median-cut' else kMeans)(points, counts, k)
+    return sorted(clusters, key=lambda cluster : -cluster[1])
+
+# Median cut of weighted points (lists of 3 values), in ascending order of their colors
+# RETURNS
+# a list of (weighted mean, total weight) tuples, one per box
+def medianCut(points, weights, k) :
+    def box(indices) :
+        total = sum(weights[i] for i in indices)
+        mean = [sum(points[i][axis] * weights[i] for i in indices) / total for axis in range(3)]
+        variance = [sum(weights[i] * (points[i][axis] - mean[axis]) ** 2 for i in indices) for axis in range(3)]
+        return (-sum(variance), len(indices), indices, variance, mean, total)
+
+    heap = [box(list(range(len(points))))]
+    done = []
+    while heap and (len(heap) + len(done) < k) :
+        negativeVariance, count, indices, variance, mean, total = heapq.heappop(heap)
+        if (count < 2) or (negativeVariance == 0) :
+            done.append((mean, total))
+            continue
+        axis = variance.index(max(variance))
+        # (ties on the axis go by color, so the boxes don't depend on the input order)
+        ordered = sorted(indices, key=lambda i : (points[i][axis], i))
+        cumulative = list(itertools.accumulate(weights[i] for i in ordered))
+        split = min(max(bisect.bisect_left(cumulative, cumulative[-1] / 2) + 1, 1), count - 1)
+        heapq.heappush(heap, box(ordered[:split]))
+        heapq.heappush(heap, box(ordered[split:]))
+    return done + [(entry[4], entry[5]) for entry in heap]
+
+# Vectorized medianCut(): takes an (N,3) array of points and an array of N weights
+# RETURNS
+# a tuple of a (K,3) array of the boxes' weighted means, and an array of their total weights
+def batchMedianCut(points, weights, k) :
+    np = loadNumpy()
+    boxes = itertools.count()
+    def box(indices) :
+        boxWeights = weights[indices]
+        boxPoints = points[indices]
+        total = boxWeights.sum()
+        mean = (boxPoints * boxWeights[:, None]).sum(axis=0) / total
+        variance = (((boxPoints - mean) ** 2) * boxWeights[:, None]).sum(axis=0)
+        # (the counter breaks ties, as arrays can't be compared)
+        return (-variance.sum(), next(boxes), indices, variance, mean, total)
+
+    heap = [box(np.arange(len(points)))]
+    done = []
+    while heap and (len(heap) + len(done) < k) :
+        negativeVariance, _, indices, variance, mean, total = heapq.heappop(heap)
+        if (len(indices) < 2) or (negativeVariance == 0) :
+            done.append((mean, total))
+            continue
+        ordered = indices[np.lexsort((indices, points[indices, int(np.argmax(variance))]))]
+        cumulative = np.cumsum(weights[ordered])
+        split = min(max(int(np.searchsorted(cumulative, cumulative[-1] / 2)) + 1, 1), len(ordered) - 1)
+        heapq.heappush(heap, box(ordered[:split]))
+        heapq.heappush(heap, box(ordered[split:]))
+    done += [(entry[4], entry[5]) for entry in heap]
+    return np.array([mean for mean, _ in done]), np.array([total for _, total in done])
+
+# Mini-batch k-means of weighted points (lists of 3 values)
+# RETURNS
+# a list of (center, total weight of its points) tuples, leaving out centers with no points
+def kMeans(points, weights, k) :
+    rand = random.Random(KMEANS_SEED)
+    population = range(len(points))
+    cumulative = list(itertools.accumulate(weights))
+    distance = lambda point, center : sum((point[axis] - center[axis]) ** 2 for axis in range(3))
+    nearest = lambda point : min(range(len(centers)), key=lambda c : distance(point, centers[c]))
+
+    # k-means++ on a sample of the colors (drawn by count, so they're weighted alike)
+    sample = [points[i] for i in rand.choices(population, cum_weights=cumulative, k=KMEANS_SEED_SAMPLE)]
+    centers = [list(rand.choice(sample))]
+    distances = [distance(point, centers[0]) for point in sample]
+    while len(centers) < min(k, len(points)) :
+        total = sum(distances)
+        if total <= 0 :
+            break
+        center = sample[bisect.bisect_left(list(itertools.accumulate(distances)), rand.random() * total)]
+        centers.append(list(center))
+        distances = [min(d, distance(point, center)) for d, point in zip(distances, sample)]
+
+    seen = [0] * len(centers)
+    for _ in range(KMEANS_ITERATIONS) :
+        for i in rand.choices(population, cum_weights=cumulative, k=KMEANS_BATCH_SIZE) :
+            point = points[i]
+            c = nearest(point)
+            seen[c] += 1
+            centers[c] = [value + ((point[axis] - value) / seen[c]) for axis, value in enumerate(centers[c])]
+
+    sums = [[0.0, 0.0, 0.0] for _ in centers]
+    totals = [0] * len(centers)
+    for point, weight in zip(points, weights) :
+        c = nearest(point)
+        totals[c] += weight
+        for axis in range(3) :
+            sums[c][axis] += point[axis] * weight
+    return [([value / total for value in pointSum], total) for pointSum, total in zip(sums, totals) if total]
+
+# Vectorized kMeans(): takes an (N,3) array of points and an array of N weights
+# RETURNS
+# a tuple of a (K,3) array of centers, and an array of the total weight of their points
+def batchKMeans(points, weights, k) :
+    np = loadNumpy()
+    rng = np.random.default_rng(KMEANS_SEED)
+    probabilities = weights / weights.sum()
+
+    sample = points[rng.choice(len(points), size=KMEANS_SEED_SAMPLE, p=probabilities)]
+    centers = [sample[rng.integers(len(sample))]]
+    distances = ((sample - centers[0]) ** 2).sum(axis=1)
+    while len(centers) < min(k, len(points)) :
+        total = distances.sum()
+        if total <= 0 :
+            break
+        centers.append(sample[rng.choice(len(sample), p=distances / total)])
+        distances = np.minimum(distances, ((sample - centers[-1]) ** 2).sum(axis=1))
+    centers = np.array(centers)
+
+    # (each center moves by the mean of its batch colors, weighted by how many it's seen in all)
+    seen = np.zeros(len(centers))
+    for _ in range(KMEANS_ITERATIONS) :
+        batch = points[rng.choice(len(points), size=KMEANS_BATCH_SIZE, p=probabilities)]
+        labels = nearestCenters(batch, centers)
+        sizes = np.bincount(labels, minlength=len(centers))
+        sums = np.stack([np.bincount(labels, weights=batch[:, axis], minlength=len(centers)) for axis in range(3)], axis=1)
+        seen += sizes
+        moved = sizes > 0
+        centers[moved] += (sums[moved] - (sizes[moved, None] * centers[moved])) / seen[moved, None]
+
+    totals = np.zeros(len(centers))
+    sums = np.zeros((len(centers), 3))
+    for start in range(0, len(points), KMEANS_BLOCK_SIZE) :
+        block = points[start : start + KMEANS_BLOCK_SIZE]
+        blockWeights = weights[start : start + KMEANS_BLOCK_SIZE]
+        labels = nearestCenters(block, centers)
+        totals += np.bincount(labels, weights=blockWeights, minlength=len(centers))
+        sums += np.stack([np.bincount(labels, weights=block[:, axis] * blockWeights, minlength=len(centers)) for axis in range(3)], axis=1)
+    used = totals > 0
+    return sums[used] / totals[used, None], totals[used]
+
+# Returns the index of the nearest center to each of an (N,3) array of points
+def nearestCenters(points, centers) :
+    np = loadNumpy()
+    distances = (points * points).sum(axis=1)[:, None] - (2 * (points @ centers.T)) + (centers * centers).sum(axis=1)[None, :]
+    return np.argmin(distances, axis=1)
+
+# A QuantizeSink takes the place of the output sink for --quantize, counting the colors in a
+# ColorHistogram, and writes the palette through the real sink when it's closed
+class QuantizeSink :
+    # ARGS
+    # sink: the sink to write the palette through (with 'count' among its formats)
+    # k: the number of palette colors
+    # method: one of QUANTIZE_METHODS
+    # outputFormats: the formats to output the palette colors in
+    def __init__(self, sink, k, method, outputFormats) :
+        self.sink = sink
+        self.k = k
+        self.method = method
+        self.outputFormats = outputFormats
+        self.histogram = ColorHistogram()
+        # there's no formatted output for CONVERSION_CACHE to reuse
+        self.cacheKey = None
+
+    # counts a map of converted values (image colors come with their pixel count)
+    def write(self, convertedValues) :
+        red, green, blue = convertedValues['rgb']
+        self.histogram.add((red << 16) | (green << 8) | blue, convertedValues.get('count', 1))
+
+    # (the bulk pipeline formats and then writes, so this counts the color and leaves nothing to write)
+    def formatColor(self, convertedValues) :
+        self.write(convertedValues)
+        return None
+
+    def writeFormatted(self, text) :
+        pass
+
+    # (nothing is written until the palette is worked out)
+    def flush(self) :
+        pass
+
+    # works out the palette, writes it and closes the real sink
+    def close(self) :
+        try :
+            clusters = quantizeColors(self.histogram, self.k, self.method)
+            resultRows = convertRows('lab', [center for center, _ in clusters], self.outputFormats)
+            for results, (_, population) in zip(resultRows, clusters) :
+                results['count'] = population
+                self.sink.write(results)
+        finally :
+            self.sink.close()
+
+
+'''
+# DOCUMENT REWRITING
+'''
+
+# --rewrite FILE --to FORMAT converts the color literals inside a document (CSS, SVG, HTML, JSON or any
+# other UTF-8 text) and writes it back with only those spans changed. A literal is a hex code ("#" and 6
+# hex digits) or a format name followed by numbers in parentheses, like "rgb(12, 34, 56)" or
+# "hsl(210 50% 40%)". Literals with more values than their format has channels (e.g. an alpha), units
+# (e.g. "0.5turn") or percentages for RGB are left as they are. The document is read and written
+# REWRITE_READ_SIZE characters at a time to a temporary file, which replaces it once it's all been
+# rewritten, so memory doesn't depend on the size of the document and a run that stops (e.g. at
+# --max-errors) leaves it untouched. The replacement of each distinct literal is kept in
+# CONVERSION_CACHE, so repeated literals are only converted once. RGB and HSL are written in CSS
+# syntax, the other formats as in the text output.
+
+REWRITE_READ_SIZE = 1 << 20
+# how much of the end of each block is held back in case a literal continues into the next block (more
+# than the longest literal REWRITE_PATTERN matches, and the character after a hex code it looks at)
+REWRITE_OVERLAP = 80
+# how many characters before each block REWRITE_PATTERN looks behind at
+REWRITE_CONTEXT = 4
+# (hex codes can't follow "&", "#" or "url(", so "&#123456;" and "url(#abcdef)" are left alone)
+REWRITE_PATTERN = re.compile(r'(?<![\w&#-])(?<!url\()#[0-9a-f]{6}(?![\w-])|(?<![\w-])(?:rgb|cmyk|cmy|hsl|hsv|xyz|lab|lch)\([-+\d.,%\s]{0,64}\)', re.IGNORECASE)
+
+# Rewrites the color literals of a document in place (see above)
+# ARGS
+# path: the name of the document
+# toFormat: the format to convert the literals to (one of TYPES)
+# precision: number of decimals to write
+# RETURNS
+# false if the document couldn't be read or written, None otherwise
+def rewriteDocument(path, toFormat, precision) :
+    started = time.perf_counter()
+    formatNumber = compileNumberFormat(precision)
+    channel = errorChannel()
+    literals = 0
+    converted = 0
+    temporaryPath = f'{path}.{os.getpid()}.tmp'
+    try :
+        with open(path, 'r', encoding='utf-8', errors='surrogateescape', newline='') as document, \
+             open(temporaryPath, 'w', encoding='utf-8', errors='surrogateescape', newline='') as rewritten :
+            # (after the first block, the text starts with the REWRITE_CONTEXT characters before where the
+            # block starts, for the pattern to look behind at)
+            pending = ''
+            start = 0
+            # the line number at counted in text (only worked out as far as an error, or the end of a block)
+            line = 1
+            counted = 0
+            while True :
+                block = document.read(REWRITE_READ_SIZE)
+                text = pending + block
+                end = max(len(text) - REWRITE_OVERLAP, start) if block else len(text)
+                written = start
+                for match in REWRITE_PATTERN.finditer(text, start) :
+                    if match.start() >= end :
+                        break
+                    literals += 1
+                    literal = match.group()
+                    key = ('rewrite', toFormat, precision, literal)
+                    cached = CONVERSION_CACHE.get(key) if CONVERSION_CACHE is not None else None
+                    if cached is None :
+                        try :
+                            cached = (False, rewriteLiteral(literal, toFormat, formatNumber))
+                        except ColorError as error :
+                            cached = (True, errorRecord(error, None, literal)[3:])
+                        if CONVERSION_CACHE is not None :
+                            CONVERSION_CACHE.put(key, cached)
+                    failed, replacement = cached
+                    if failed :
+                        line += text.count('\n', counted, match.start())
+                        counted = match.start()
+                        channel.report('line', line, literal, *replacement)
+                    elif replacement is not None :
+                        rewritten.write(text[written : match.start()])
+                        rewritten.write(replacement)
+                        written = match.end()
+                        converted += 1
+                # (a literal can end past the held back part)
+                done = max(written, end)
+                rewritten.write(text[written : done])
+                if not block :
+                    break
+                line += text.count('\n', counted, done)
+                pending = text[max(done - REWRITE_CONTEXT, 0) :]
+                start = min(done, REWRITE_CONTEXT)
+                counted = start
+        os.chmod(temporaryPath, stat.S_IMODE(os.stat(path).st_mode))
+        os.replace(temporaryPath, path)
+    except OSError as error :
+        with contextlib.suppress(OSError) :
+            os.remove(temporaryPath)
+        print(f'ERROR: Could not rewrite "{path}": {error.strerror or error}', file=sys.stderr)
+        return False
+    except BaseException :
+        # (e.g. ErrorLimitReached or an interrupt, which leave the document as it was)
+        with contextlib.suppress(OSError) :
+            os.remove(temporaryPath)
+        raise
+    print(f'REWRITE: {converted:,} of {literals:,} color literals converted to {toFormat.upper()} in "{path}" in {time.perf_counter() - started:.3f}s', file=sys.stderr)
+
+# Converts a color literal found in a document
+# RETURNS
+# the text to replace it with, or None to leave it as it is
+# RAISES
+# ColorError if it can't be converted
+def rewriteLiteral(literal, toFormat, formatNumber) :
+    # (hex codes are read in lowercase, which documents often don't use)
+    color = literal.lower() if literal[0] == '#' else literal
+    colorFormat, tokens = tokenizeColor(color)
+    if (len(tokens) != len(CHANNELS[colorFormat])) or ((colorFormat == 'rgb') and ('%' in color)) :
+        return None
+    values = validateColor(color, colorFormat, tokens)
+    values = convertValues(colorFormat, values, [toFormat])[toFormat]
+    if toFormat == 'hex' :
+        return '#' + values
+    elif toFormat == 'rgb' :
+        return 'rgb(' + ', '.join([formatNumber(value) for value in values]) + ')'
+    elif toFormat == 'hsl' :
+        return 'hsl(' + formatNumber(values[0]) + ', ' + formatNumber(values[1]) + '%, ' + formatNumber(values[2]) + '%)'
+    return toFormat + '(' + ', '.join([formatNumber(value) for value in values]) + ')'
+
+
+'''
+# GENERAL UTILITIES
+'''
+
+# ARGS
+# color: a string containing a color value in an unknown format
+# RETURNS
+# the detected format (one of TYPES), or None if no format was indicated
+def identifyColorFormat(color) :
+    lowered = color.lower()
+    if 'rgb' in lowered :
+        return 'rgb'
+    elif 'cmyk' in lowered :
+        return 'cmyk'
+    elif 'cmy' in lowered :
+        return 'cmy'
+    elif 'hsl' in lowered :
+        return 'hsl'
+    elif 'hsv' in lowered :
+        return 'hsv'
+    elif '#' in color :
+        return 'hex'
+    elif 'xyz' in lowered :
+        return 'xyz'
+    elif 'lab' in lowered :
+        return 'lab'
+    elif 'lch' in lowered :
+        return 'lch'
+    return None
+
+# precompiled patterns for tokenizeColor()
+# values are runs of digits and dots (signs are ignored, which is what lets "rGb-50 .   )100^200"
+# work). Runs of only dots are malformed values, except for a lone '.' in the middle of a color code,
+# which is skipped.
+NUMBER_PATTERN = re.compile(r'[\d.]*\d[\d.]*|\.\.+|\.$')
+# a and b of L*a*b* can be negative, so its values keep a leading '-'
+SIGNED_NUMBER_PATTERN = re.compile(r'-?[\d.]*\d[\d.]*|\.\.+|\.$')
+HEX_PATTERN = re.compile(r'[0-9a-f]{6}')
+
+# Detects the format of a color code (unless it's given) and extracts its values with precompiled patterns.
+# ARGS
+# color: a string containing a color value
+# colorFormat: the format of the color, or None to detect it
+# RETURNS
+# a tuple of the format (None if it couldn't be detected) and a list of every value found in the
+# color code: floats for decimal formats (None for malformed numbers like "1.2.3"), or the hex code
+# string for hex
+def tokenizeColor(color, colorFormat = None) :
+    if colorFormat is None :
+        colorFormat = identifyColorFormat(color)
+        if colorFormat is None :
+            return None, []
+    if colorFormat == 'hex' :
+        return colorFormat, HEX_PATTERN.findall(color)[:1]
+
+    numbers = (SIGNED_NUMBER_PATTERN if colorFormat == 'lab' else NUMBER_PATTERN).findall(color)
+    try :
+        return colorFormat, list(map(float, numbers))
+    except ValueError :
+        return colorFormat, [parseNumber(number) for number in numbers]
+
+# Takes in a string, returns it as a float (or None if it isn't a valid number)
+def parseNumber(number) :
+    try :
+        return float(number)
+    except ValueError :
+        return None
+
+# Extracts numerical (hex or decimal) values from a string. 
+# ARGS
+# color: string containing value(s)
+# numValues: determines how many values to extract (e.g. 3 for RGB, 4 for CMYK)
+# formatName: the name of the format being extracted, for the error (e.g. 'RGB')
+# isHex: determines if we're looking for hex rather than decimal
+# tokens: the values tokenizeColor() found in color, if it has already been tokenized
+# RETURNS
+# a list of extracted color/number values, as floats (or the hex code string)
+# RAISES
+# ColorParseError if there are too few values
+def extractValues(color, numValues, formatName, isHex = False, tokens = None) :
+    if tokens is None :
+        tokens = tokenizeColor(color, 'hex' if isHex else 'rgb')[1]
+
+    if len(tokens) < numValues :
+        extractedValues = tokens if isHex else NUMBER_PATTERN.findall(color)
+        detail = f'Could not extract the correct number of values from input: "{color}".\n- Number of values required: {numValues}\n- {len(extractedValues)} values successfully extracted: {extractedValues}'
+        raise ColorParseError(f'Improper format for {formatName} (see --help)', detail)
+
+    return tokens[:numValues]
+
+
+# formats and delivers color values to STDOUT or a specified output file (through OUTPUT_SINK)
+# ARGS
+# convertedValues: a map of the results from the color translations that were performed on a single color value, 
+#                  where the key indicates the format and the value is a list of raw numeric values
+def printConversions(convertedValues) :
+    outputSink().write(convertedValues)
+
+# Returns OUTPUT_SINK, setting up a default one (text to stdout) if there isn't one yet
+def outputSink() :
+    global OUTPUT_SINK
+    if OUTPUT_SINK is None :
+        OUTPUT_SINK = OutputSink()
+    return OUTPUT_SINK
+
+# Returns ERROR_CHANNEL, setting up a default one (messages on stderr) if there isn't one yet
+def errorChannel() :
+    global ERROR_CHANNEL
+    if ERROR_CHANNEL is None :
+        ERROR_CHANNEL = ErrorChannel()
+    return ERROR_CHANNEL
 
 # Takes in a float, returns the nearest integer
 def smartRound(value) :
@@ -681,8 +5073,7 @@ def smartRound(value) :
 def hex(number) :
     number = int(number)
     if number > 16 :
-        print("ERROR: Decimal to Hexidecimal conversion failed")
-        return "ERROR: Decimal to Hexidecimal conversion failed" 
+        raise ColorRangeError('Decimal to Hexidecimal conversion failed')
     if number < 10 :
         return str(number)
     return HEX_LETTERS[number % 10]
@@ -691,4 +5082,9 @@ def hex(number) :
 
 ''' init '''
 if __name__ == '__main__' :
-    main()
+    try :
+        sys.exit(main())
+    except BrokenPipeError :
+        # whatever we were piped into (e.g. `head`) stopped reading, so quietly stop writing
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)